@@ -1,73 +1,81 @@
 import logging
+import numpy as np
+
+# Layout of an account's state: one row per holding, (basis, balance) per row. PortfolioTemplate
+# uses the same layout so AccountManager can hold all accounts in one array.
+HOLDINGS = ('cash', 'stocks', 'bonds')
+FIELDS = ('basis', 'balance')
+HOLDING_INDEX = {h: i for i, h in enumerate(HOLDINGS)}
+BASIS, BALANCE = 0, 1
+
 
 class Account:
     THRESHOLD = 5
 
-    def __init__(self, acct_def, tax_manager, year=-1):
+    __slots__ = ('_name', '_type', '_state', '_tax_manager', '_year')
+
+    def __init__(self, acct_def, tax_manager, year=-1, state=None):
         logging.debug(acct_def)
         self._name = acct_def['name']
-        self._info = acct_def
-        if 'cash' not in self._info['holdings']:
-            self._info['holdings']['cash'] = {'basis': 0, 'balance': 0}
-        if 'stocks' not in self._info['holdings']:
-            self._info['holdings']['stocks'] = {'basis': 0, 'balance': 0}
-        if 'bonds' not in self._info['holdings']:
-            self._info['holdings']['bonds'] = {'basis': 0, 'balance': 0}
+        # Holdings live in the state array only; the definition's copy would go stale
+        self._type = acct_def['type']
+        if state is None:
+            # Stand-alone account: own the state instead of viewing into an AccountManager's array
+            state = np.zeros((len(HOLDINGS), len(FIELDS)), dtype=np.float64)
+            for h, holding in acct_def['holdings'].items():
+                state[HOLDING_INDEX[h]] = (holding['basis'], holding['balance'])
+        self._state = state
         self._tax_manager = tax_manager
         self._year = year
 
     def get_name(self):
         return self._name
 
+    def get_type(self):
+        return self._type
+
     def get_year_available(self):
         return self._year
 
     def get_values(self):
-        # print(self._info['holdings'])
-        retval = {}
-        for t in ['cash', 'stocks', 'bonds']:
-            retval[t] = self._info['holdings'][t]['balance']
-        return retval
+        return dict(zip(HOLDINGS, self._state[:, BALANCE].tolist()))
 
     def get_value(self, holding_type):
-        return self._info['holdings'][holding_type]['balance']
+        return self._state[HOLDING_INDEX[holding_type], BALANCE]
 
     def get_total_value(self):
-        return sum([self.get_value(h) for h in ['cash', 'stocks', 'bonds']])
+        return self._state[:, BALANCE].sum()
 
     def set_value(self, holding_type, value):
-        self._info['holdings'][holding_type]['balance'] = round(value, 2)
+        self._state[HOLDING_INDEX[holding_type], BALANCE] = round(value, 2)
 
     def withdraw_pre(self, amount_requested_pre):
         # Iterate through the asset types to withdraw
         total_post = 0
         total_tax = 0
-        holdings = self._info['holdings']
-        for h in ['cash', 'stocks', 'bonds']:
-            amount_of_type_pre = min(holdings[h]['balance'], amount_requested_pre)
-            holdings[h]['balance'] -= amount_of_type_pre
+        state = self._state
+        for h in range(len(HOLDINGS)):
+            amount_of_type_pre = min(state[h, BALANCE], amount_requested_pre)
+            state[h, BALANCE] -= amount_of_type_pre
             amount_requested_pre -= amount_of_type_pre
-            post_tax, tax = self._tax_manager.split_it(self._info['type'], amount_of_type_pre)
+            post_tax, tax = self._tax_manager.split_it(self._type, amount_of_type_pre)
             total_post += post_tax
             total_tax += tax
         return total_post, total_tax
 
     def withdraw(self, amount_requested_post):
-        total_balance_pre = self.get_total_value()
-        amount_requested_pre = self._tax_manager.how_much_pretax(self._info['type'], amount_requested_post)
+        amount_requested_pre = self._tax_manager.how_much_pretax(self._type, amount_requested_post)
         total_post, total_tax = self.withdraw_pre(amount_requested_pre)
 
         # Some sanity checks
-        holdings = self._info['holdings']
         remaining_amount_post = amount_requested_post - total_post
         if remaining_amount_post < -self.THRESHOLD:
             raise RuntimeError('Badness: {}, {}, {}'.format(amount_requested_post, total_post, remaining_amount_post))
         if total_post - amount_requested_post > self.THRESHOLD:
             raise RuntimeError('Withholding more than asked: {}, {}'.format(amount_requested_post, total_post))
-        if remaining_amount_post > self.THRESHOLD and \
-                len([h for h in ['cash', 'stocks', 'bonds'] if holdings[h]['balance'] > 0]) > 0:
+        if remaining_amount_post > self.THRESHOLD and (self._state[:, BALANCE] > 0).any():
             # If there is more needed, then we should have cleaned out this account
-            raise RuntimeError('Money still remaining: {}, {}'.format(remaining_amount_post, holdings))
+            raise RuntimeError('Money still remaining: {}, {}'.format(remaining_amount_post, self.get_values()))
 
         # Return post-tax dollars and tax paid
         return total_post, total_tax
@@ -1,12 +1,14 @@
 import locale
 import logging
 import csv
-from account import Account
+import numpy as np
+from account import Account, HOLDINGS, FIELDS, HOLDING_INDEX, BALANCE
 from brokerage import Brokerage
 from four_01k import FourOhOneKay
 from rollover_ira import RolloverIRA
 from roth_ira import RothIRA
 from trad_ira import TradIRA
+from portfolio_template import PortfolioTemplate
 
 
 class AccountManager:
@@ -44,11 +46,25 @@ class AccountManager:
         self.tax_manager = tax_manager
         self.logging_enabled = False
         self.accounts = []
+        # Account by name, so withdrawals don't scan the list for every strategy entry
+        self._by_name = {}
         self.data = []
+        self.template = None
+        self._set_state(np.zeros((0, len(HOLDINGS), len(FIELDS)), dtype=np.float64))
 
     def clear(self):
         self.accounts = []
+        self._by_name = {}
         self.data = []
+        self._set_state(np.zeros((0, len(HOLDINGS), len(FIELDS)), dtype=np.float64))
+
+    def _set_state(self, state):
+        # (accounts, holdings, {basis, balance}); every Account is a view into one row of it.
+        # Keep views of the columns that change every year so updating them allocates nothing.
+        self.state = state
+        self._balances = state[:, :, BALANCE]
+        self._stocks = state[:, HOLDING_INDEX['stocks'], BALANCE]
+        self._bonds = state[:, HOLDING_INDEX['bonds'], BALANCE]
 
     def get_data(self):
         return self.data
@@ -56,33 +72,58 @@ class AccountManager:
     def toggle_logging(self):
         self.logging_enabled = not self.logging_enabled
 
+    def get_balances(self):
+        # (accounts, holdings) view of the current balances
+        return self._balances
+
     def get_total_value(self):
-        return round(sum([item for a in self.accounts for item in list(a.get_values().values())]))
+        return round(self._balances.sum())
 
     def get_accounts_values(self):
         return [{**{'Name': a.get_name()}, **a.get_values()} for a in self.accounts]
 
     def get_account_by_name(self, name):
-        return [a for a in self.accounts if a.get_name() == name][0]
+        return self._by_name[name]
 
     def apply_stock_return(self, stock_return: float):
-        for acct in self.accounts:
-            acct.set_value('stocks', acct.get_value('stocks') * (1 + stock_return))
+        np.multiply(self._stocks, 1 + stock_return, out=self._stocks)
+        np.round(self._stocks, 2, out=self._stocks)
 
     def apply_bond_return(self, bond_return: float):
-        for acct in self.accounts:
-            acct.set_value('bonds', acct.get_value('bonds') * (1 + bond_return))
+        np.multiply(self._bonds, 1 + bond_return, out=self._bonds)
+        np.round(self._bonds, 2, out=self._bonds)
 
     def apply_inflation(self, inflation: float):
-        for acct in self.accounts:
-            acct.set_value('stocks', acct.get_value('stocks') / (1 + inflation))
-            acct.set_value('bonds', acct.get_value('bonds') / (1 + inflation))
+        for holding in [self._stocks, self._bonds]:
+            np.divide(holding, 1 + inflation, out=holding)
+            np.round(holding, 2, out=holding)
 
     @staticmethod
     def _stof(string):
         return round(locale.atof(string))
 
     def load_accounts(self, filename):
+        self.load_template(self.parse_accounts(filename))
+
+    def load_template(self, template: PortfolioTemplate):
+        # Build the actual accounts from an already parsed portfolio
+        self.clear()
+        self.template = template
+        self.data = template.get_account_defs()
+        self._set_state(template.snapshot.reshape(len(template), len(HOLDINGS), len(FIELDS)).copy())
+        self._build_accounts()
+
+    def reset(self):
+        # Restore the starting balances without going back to the file
+        np.copyto(self.state.reshape(-1), self.template.snapshot)
+
+    def clone(self):
+        account_manager = AccountManager(self.tax_manager)
+        account_manager.logging_enabled = self.logging_enabled
+        account_manager.load_template(self.template)
+        return account_manager
+
+    def parse_accounts(self, filename) -> PortfolioTemplate:
         # Clear out old account info
         self.clear()
         # Open the file
@@ -117,24 +158,27 @@ class AccountManager:
         else:
             raise RuntimeError('Invalid first line: {}'.format(first_line))
 
-        # Build the actual accounts
-        self._build_accounts()
+        return PortfolioTemplate(self.data)
 
     def _build_accounts(self):
-        for the_data in self.data:
+        for i, the_data in enumerate(self.data):
+            state = self.state[i]
             match the_data['type']:
                 case 'Brokerage':
-                    self.accounts.append(Brokerage(the_data, self.tax_manager))
+                    self.accounts.append(Brokerage(the_data, self.tax_manager, state=state))
                 case '401k':
-                    self.accounts.append(FourOhOneKay(the_data, self.tax_manager, year=60))
+                    self.accounts.append(FourOhOneKay(the_data, self.tax_manager, year=60, state=state))
                 case 'RolloverIRA':
-                    self.accounts.append(RolloverIRA(the_data, self.tax_manager, year=60))
+                    self.accounts.append(RolloverIRA(the_data, self.tax_manager, year=60, state=state))
                 case 'RothIRA':
-                    self.accounts.append(RothIRA(the_data, self.tax_manager, year=60))
+                    self.accounts.append(RothIRA(the_data, self.tax_manager, year=60, state=state))
                 case 'TradIRA':
-                    self.accounts.append(TradIRA(the_data, self.tax_manager, year=60))
+                    self.accounts.append(TradIRA(the_data, self.tax_manager, year=60, state=state))
                 case _:
                     raise RuntimeError('Unknown account type: {}'.format(the_data['type']))
+        # The first account wins if two share a name, as the list scan this replaced did
+        for account in reversed(self.accounts):
+            self._by_name[account.get_name()] = account
 
     def _load_accounts_cost_basis(self, lines):
         # Parse the lines
@@ -0,0 +1,57 @@
+import logging
+import queue
+import threading
+from result_aggregator import ResultAggregator
+
+
+class Cancelled(Exception):
+    pass
+
+
+class BackgroundRun:
+    # Runs target(*args, on_chunk=...) on a worker thread so a Tk window stays responsive. The
+    # target calls on_chunk(aggregator) as results come in; each call queues a copy of the partial
+    # aggregator for the window to pick up with poll(), and raises Cancelled once cancel() has been
+    # called, which unwinds the run at the next chunk.
+    def __init__(self, target, *args):
+        self.target = target
+        self.args = args
+        self._messages = queue.Queue()
+        self._cancel = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def cancel(self):
+        self._cancel.set()
+
+    def poll(self):
+        # Everything queued since the last poll, as (kind, payload) with kind one of:
+        #   progress   a copy of the partial aggregator
+        #   done       the final result
+        #   cancelled  None
+        #   error      the exception that ended the run
+        messages = []
+        while True:
+            try:
+                messages.append(self._messages.get_nowait())
+            except queue.Empty:
+                return messages
+
+    def _on_chunk(self, aggregator):
+        if self._cancel.is_set():
+            raise Cancelled()
+        # The worker keeps adding to its aggregator, so hand over a copy
+        self._messages.put(('progress', ResultAggregator.from_arrays(aggregator.to_arrays())))
+
+    def _run(self):
+        try:
+            result = self.target(*self.args, on_chunk=self._on_chunk)
+        except Cancelled:
+            self._messages.put(('cancelled', None))
+        except Exception as e:
+            logging.exception("Background run failed")
+            self._messages.put(('error', e))
+        else:
+            self._messages.put(('done', result))
@@ -0,0 +1,255 @@
+import logging
+import numpy as np
+from account import Account, HOLDINGS, HOLDING_INDEX
+from simulator import create_rate_generator
+
+# The asset class axis of the balance arrays uses the same order as AccountManager's state
+CASH, STOCKS, BONDS = [HOLDING_INDEX[h] for h in HOLDINGS]
+# Iterations simulated together when streaming; bounds memory at O(CHUNK_SIZE * years)
+CHUNK_SIZE = 10000
+# Share of a year's iterations that must be idle before the withdrawal skips them
+IDLE_FRACTION = 0.25
+# Totals this close to half a dollar are re-summed in the scalar engine's order before rounding
+TIE_TOLERANCE = 1e-6
+
+
+def build_portfolio_arrays(account_manager, withdraw_alg, tax_manager):
+    # Starting balances as (accounts, asset_class), one tax rate per account, and the
+    # account slots in the order the withdraw strategy drains them
+    accounts = account_manager.accounts
+    balances = account_manager.get_balances().copy()
+    tax_rates = np.array([tax_manager.get_rate(a.get_type()) for a in accounts], dtype=np.float64)
+    names = [a.get_name() for a in accounts]
+    order = [names.index(name) for name in withdraw_alg.get_account_names()]
+    return balances, tax_rates, order
+
+
+class WithdrawalPlan:
+    # The withdraw strategy compiled against one portfolio, once per run instead of looking accounts
+    # up by name every year: the account slots in the order they are drained, with their flat tax
+    # rates and income kinds. Accounts are visited in order, since what each one is asked for
+    # includes the rounding the one before left over, but each visit covers every iteration at once.
+    def __init__(self, tax_rates, order, income_kinds, tax_manager):
+        self.order = list(order)
+        self.slots = np.asarray(self.order, dtype=np.int64)
+        self.slot_rates = [float(tax_rates[slot]) for slot in order]
+        self.income_kinds = income_kinds
+        self.tax_manager = tax_manager
+        # Visits to an account the strategy comes back to later in the year. What such a visit left
+        # is gone by the end of the cascade, so for these the check that an account which fell
+        # short was emptied uses whether it still held money right after the visit.
+        self.revisited = [k for k, slot in enumerate(self.order) if slot in self.order[k + 1:]]
+
+    def withdraw(self, balances, amount_requested):
+        # balances is (accounts, asset_class, iterations) and is updated in place;
+        # returns (post-tax amount withdrawn, tax paid) per iteration
+        # Iterations that have run dry have nothing to move unless they are paying something in, so
+        # they are left out once there are enough of them; in a failing scenario that is most of
+        # them by the later years
+        idle = (amount_requested >= 0) & ~balances.reshape(-1, len(amount_requested)).any(axis=0)
+        if np.count_nonzero(idle) < IDLE_FRACTION * len(idle):
+            # Too few to be worth copying the rest out and back
+            return self._cascade(balances, amount_requested)
+        withdrawal = np.zeros_like(amount_requested)
+        total_tax_paid = np.zeros_like(amount_requested)
+        live = np.flatnonzero(~idle)
+        if len(live):
+            subset = balances[:, :, live]
+            withdrawal[live], total_tax_paid[live] = self._cascade(subset, amount_requested[live])
+            balances[:, :, live] = subset
+        return withdrawal, total_tax_paid
+
+    def _cascade(self, balances, amount_requested):
+        if self.tax_manager.is_progressive():
+            withdrawal, total_tax_paid, left, unmet, held = _withdraw_progressive(
+                balances, self.income_kinds, self.order, amount_requested, self.tax_manager, self.revisited)
+        else:
+            withdrawal, total_tax_paid, left, unmet, held = _withdraw(balances, self.slot_rates, self.order,
+                                                                      amount_requested, self.revisited)
+        self._check(left, unmet, balances, held)
+        return withdrawal, total_tax_paid
+
+    def _check(self, left, unmet, balances, held):
+        # Account.withdraw's sanity checks for every (slot, iteration) at once. left[k] is what slot k
+        # was asked for minus what it gave, so below zero means it gave more than asked.
+        if left.min() < -Account.THRESHOLD:
+            k, i = np.argwhere(left < -Account.THRESHOLD)[0]
+            raise RuntimeError('Withholding more than asked: {}, {} over'.format(self.order[k], -left[k, i]))
+        # Falling short is only fine once the account is empty. One that still owed some of its
+        # pre-tax amount was emptied on the way, so only those that covered theirs yet fell short
+        # need their balances looked at; one pass over both arrays finds whether there are any.
+        if np.minimum(left - Account.THRESHOLD, -unmet).max() >= 0:
+            k, i = np.nonzero((left > Account.THRESHOLD) & (unmet <= 0))
+            remaining = balances[self.slots[k], :, i]
+            has_money = (remaining > 0).any(axis=1)
+            for visit, visit_held in held.items():
+                at = k == visit
+                has_money[at] = visit_held[i[at]]
+            stranded = np.flatnonzero(has_money)
+            if len(stranded):
+                j = stranded[0]
+                raise RuntimeError('Money still remaining: {}, {}'.format(
+                    left[k[j], i[j]], dict(zip(HOLDINGS, remaining[j].tolist()))))
+
+
+def _withdraw(balances, slot_rates, order, amount_requested, revisited=()):
+    # Vectorized version of WithdrawAlgo.withdraw/Account.withdraw across all iterations. For the
+    # sanity checks it also returns, per (slot, iteration), what was still wanted after the slot
+    # and the pre-tax amount the slot couldn't cover; both are kept as they're computed. held maps
+    # each revisited slot to whether its account still had money right after that visit.
+    left = np.empty((len(order), len(amount_requested)))
+    unmet = np.empty_like(left)
+    held = {}
+    amount_remaining = amount_requested
+    total_tax_paid = np.zeros_like(amount_requested)
+    for k, (slot, rate) in enumerate(zip(order, slot_rates)):
+        amount_pre = np.round(amount_remaining / (1 - rate), out=unmet[k])
+        total_post = np.zeros_like(amount_requested)
+        for h in range(len(HOLDINGS)):
+            amount_of_type_pre = np.minimum(balances[slot, h], amount_pre)
+            balances[slot, h] -= amount_of_type_pre
+            amount_pre -= amount_of_type_pre
+            tax = np.round(rate * amount_of_type_pre)
+            total_post += amount_of_type_pre - tax
+            total_tax_paid += tax
+        amount_remaining = np.subtract(amount_remaining, total_post, out=left[k])
+        if k in revisited:
+            held[k] = (balances[slot] > 0).any(axis=0)
+    return amount_requested - amount_remaining, total_tax_paid, left, unmet, held
+
+
+def _withdraw_progressive(balances, income_kinds, order, amount_requested, tax_manager, revisited=()):
+    # Same cascade with bracket taxes on the income taken out so far this year, for every iteration
+    # at once, returning the same check arrays as _withdraw
+    left = np.empty((len(order), len(amount_requested)))
+    unmet = np.empty_like(left)
+    held = {}
+    amount_remaining = amount_requested
+    total_tax_paid = np.zeros_like(amount_requested)
+    income = np.zeros((2, len(amount_requested)))
+    for k, slot in enumerate(order):
+        kind = income_kinds[slot]
+        amount_pre = np.round(tax_manager.pretax_for(kind, income, amount_remaining), out=unmet[k])
+        total_post = np.zeros_like(amount_requested)
+        for h in range(len(HOLDINGS)):
+            amount_of_type_pre = np.minimum(balances[slot, h], amount_pre)
+            balances[slot, h] -= amount_of_type_pre
+            amount_pre -= amount_of_type_pre
+            tax = np.round(tax_manager.tax_on(kind, income, amount_of_type_pre))
+            if kind is not None:
+                income[kind] += amount_of_type_pre
+            total_post += amount_of_type_pre - tax
+            total_tax_paid += tax
+        amount_remaining = np.subtract(amount_remaining, total_post, out=left[k])
+        if k in revisited:
+            held[k] = (balances[slot] > 0).any(axis=0)
+    return amount_requested - amount_remaining, total_tax_paid, left, unmet, held
+
+
+def _apply_returns(balances, stock_returns, bond_returns, inflations):
+    # One year's returns then inflation, per iteration, rounded to cents like AccountManager does
+    balances[:, STOCKS] = np.round(balances[:, STOCKS] * (1 + stock_returns), 2)
+    balances[:, BONDS] = np.round(balances[:, BONDS] * (1 + bond_returns), 2)
+    balances[:, STOCKS] = np.round(balances[:, STOCKS] / (1 + inflations), 2)
+    balances[:, BONDS] = np.round(balances[:, BONDS] / (1 + inflations), 2)
+
+
+def _total_values(balances):
+    # Each iteration's total rounded to dollars, the same as AccountManager.get_total_value. Summing
+    # across accounts row by row adds in a different order than its sum over one contiguous
+    # portfolio, which can tip a total that is close to half a dollar the other way, so those few
+    # are summed again the way it does.
+    flat = balances.reshape(-1, balances.shape[-1])
+    totals = flat.sum(axis=0)
+    close = np.flatnonzero(np.abs(totals - np.floor(totals) - 0.5) < TIE_TOLERANCE)
+    if len(close):
+        totals[close] = np.ascontiguousarray(flat[:, close].T).sum(axis=1)
+    return np.round(totals)
+
+
+def run_batch_simulation(iterations, years, account_manager, how_much_alg, withdraw_alg, tax_manager,
+                         seed, first_iteration=0, rate_generator=None, jit=False):
+    rg = rate_generator if rate_generator is not None else create_rate_generator()
+    rates = rg.generate_matrices(iterations, len(years), seed, first_iteration)
+    return _simulate(years, account_manager, how_much_alg, withdraw_alg, tax_manager, rates, jit=jit)
+
+
+def iterate_batch_chunks(iterations, years, account_manager, how_much_alg, withdraw_alg, tax_manager,
+                         seed, first_iteration=0, chunk_size=CHUNK_SIZE, rate_generator=None, control=None,
+                         jit=False):
+    # Yields (first_iteration, values, controls) one chunk at a time so callers never hold every path.
+    # controls is None unless a ControlVariate is given. jit runs the year loop compiled where it can.
+    rg = rate_generator if rate_generator is not None else create_rate_generator()
+    end = first_iteration + iterations
+    for first in range(first_iteration, end, chunk_size):
+        count = min(chunk_size, end - first)
+        values, inflations, stocks, bonds = run_batch_simulation(count, years, account_manager, how_much_alg,
+                                                                 withdraw_alg, tax_manager, seed, first, rg, jit)
+        yield first, values, control.evaluate(inflations, stocks, bonds) if control is not None else None
+
+
+def trace_batch_iterations(iteration_ids, years, account_manager, how_much_alg, withdraw_alg, tax_manager,
+                           seed, trace, rate_generator=None):
+    # Re-run just the selected iterations (their random streams reproduce them exactly) and record them
+    rg = rate_generator if rate_generator is not None else create_rate_generator()
+    rates = rg.generate_matrices_for(iteration_ids, len(years), seed)
+    _simulate(years, account_manager, how_much_alg, withdraw_alg, tax_manager, rates, trace, iteration_ids)
+
+
+def _simulate(years, account_manager, how_much_alg, withdraw_alg, tax_manager, rates,
+              trace=None, iteration_ids=None, jit=False):
+    inflations, stock_returns, bond_returns = rates
+    iterations, num_years = inflations.shape
+    start_balances, tax_rates, order = build_portfolio_arrays(account_manager, withdraw_alg, tax_manager)
+    income_kinds = [tax_manager.get_income_kind(a.get_type()) for a in account_manager.accounts]
+    plan = WithdrawalPlan(tax_rates, order, income_kinds, tax_manager)
+
+    # The compiled year loop doesn't keep trace records; it gives up (None) when Numba is missing
+    # or it doesn't cover this drawdown or tax model, and the loop below runs instead
+    if jit and trace is None:
+        from jit_kernel import run_year_loop
+
+        values = run_year_loop(start_balances, plan, how_much_alg, rates)
+        if values is not None:
+            return values, inflations, stock_returns, bond_returns
+
+    # (accounts, asset_class, iterations): iterations last, so each account's holding is one
+    # contiguous row for the withdrawal cascade and the returns
+    balances = np.repeat(start_balances[:, :, np.newaxis], iterations, axis=2)
+    values = np.empty((iterations, num_years))
+    if trace is not None:
+        columns = {name: np.empty((iterations, num_years))
+                   for name in ['withdraw_request', 'withdraw_actual', 'tax_paid']}
+        account_balances = np.empty((iterations, num_years) + start_balances.shape)
+
+    logging.info("Running {} iterations over {} years on {} accounts"
+                 .format(iterations, num_years, len(start_balances)))
+    prev_withdrawals = np.zeros(iterations)
+    prev_inflations = np.zeros(iterations)
+    for y in range(num_years):
+        total_values = _total_values(balances)
+        values[:, y] = total_values
+
+        if y == 0:
+            how_much_state = how_much_alg.start(total_values)
+        requested_dollars = how_much_alg.withdraw(how_much_state, total_values, prev_withdrawals, prev_inflations)
+        prev_withdrawals = requested_dollars
+        prev_inflations = inflations[:, y]
+        withdrawal, tax_paid = plan.withdraw(balances, requested_dollars)
+        if trace is not None:
+            columns['withdraw_request'][:, y] = requested_dollars
+            columns['withdraw_actual'][:, y] = withdrawal
+            columns['tax_paid'][:, y] = tax_paid
+            account_balances[:, y] = balances.transpose(2, 0, 1)
+
+        _apply_returns(balances, stock_returns[:, y], bond_returns[:, y], inflations[:, y])
+
+    failures = np.count_nonzero(values[:, -1] < 1)
+    logging.info("Batch finished: {} of {} iterations failed".format(failures, iterations))
+
+    if trace is not None:
+        columns.update({'total_value': values, 'inflation': inflations,
+                        'stock_return': stock_returns, 'bond_return': bond_returns})
+        trace.record(iteration_ids, years, columns, account_balances)
+
+    return values, inflations, stock_returns, bond_returns
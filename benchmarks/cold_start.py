@@ -0,0 +1,51 @@
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import click
+
+from synthetic import write_balances, write_withdraws
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+# Best-of-N wall time for a fresh `retire --headless` process on a tiny run. Measured at ~0.25s
+# on a dev box, most of it importing numpy and click (importing matplotlib/Tk alone took ~1s).
+TARGET_SECONDS = 0.5
+
+
+def _run(args, env, cwd):
+    start = time.perf_counter()
+    subprocess.run(args, env=env, cwd=cwd, check=True, stdout=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+@click.command()
+@click.option('--repeat', default=5, help='Best of this many runs')
+@click.option('--target', default=TARGET_SECONDS, help='Fail if the best run is slower than this')
+def cold_start(repeat, target):
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    with tempfile.TemporaryDirectory() as tmp:
+        balances = os.path.join(tmp, 'balances.tsv')
+        withdraws = os.path.join(tmp, 'withdraws.json')
+        write_balances(balances, 5)
+        write_withdraws(withdraws, 5)
+
+        # Headless runs must not pull in the GUI stack
+        subprocess.run([sys.executable, '-c', "import sys, retire; "
+                        "assert 'matplotlib' not in sys.modules and 'tkinter' not in sys.modules, "
+                        "'GUI modules imported at startup'"], env=env, cwd=tmp, check=True)
+
+        cmd = [sys.executable, os.path.join(ROOT, 'retire.py'), balances, withdraws,
+               '--headless', '--iterations', '10', '--seed', '1']
+        best_cli = min(_run(cmd, env, tmp) for _ in range(repeat))
+        best_python = min(_run([sys.executable, '-c', 'pass'], env, tmp) for _ in range(repeat))
+
+    print('interpreter alone:   {:.3f}s'.format(best_python))
+    print('retire --headless:   {:.3f}s (target {:.3f}s)'.format(best_cli, target))
+    if best_cli > target:
+        sys.exit('Cold start is over target')
+
+
+if __name__ == '__main__':
+    cold_start()
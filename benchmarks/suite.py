@@ -0,0 +1,247 @@
+import contextlib
+import io
+import json
+import logging
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import click
+import numpy as np
+
+from synthetic import register_names, write_balances, write_withdraws
+from account_manager import AccountManager
+from drawdown_const_percentage import DrawdownConstPercentage
+from drawdown_factory import DRAWDOWN_CODES
+from jit_kernel import available as jit_available
+from loader_withdraw import WithdrawAlgo
+from retire import Options, howmuch_algo_chooser, run_simulator_and_plot_results
+from simulator import run_simulation
+from tax_manager import GAINS, ORDINARY, TaxManager
+
+ACCOUNT_COUNTS = [5, 50, 500]
+HORIZONS = [30, 60]
+# Each case repeats until it has run for at least this long
+MIN_SECONDS = 0.5
+# A case counts as a regression when its throughput falls this far below the baseline
+REGRESSION_THRESHOLD = 0.2
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), 'baselines', 'baseline.json')
+START_AGE = 50
+SEED = 1
+
+
+class Portfolio:
+    # Synthetic balances (both file formats) and withdraw strategy for one account count
+    def __init__(self, directory, num_accounts):
+        register_names(num_accounts)
+        self.num_accounts = num_accounts
+        self.files = {}
+        for file_format in ['cost_basis', 'asset_alloc']:
+            self.files[file_format] = os.path.join(directory, '{}_{}.tsv'.format(file_format, num_accounts))
+            write_balances(self.files[file_format], num_accounts, file_format)
+        self.withdraws = os.path.join(directory, 'withdraws_{}.json'.format(num_accounts))
+        write_withdraws(self.withdraws, num_accounts)
+
+    def load(self, tax_manager=None):
+        account_manager = AccountManager(tax_manager or TaxManager())
+        account_manager.toggle_logging()
+        account_manager.load_accounts(self.files['cost_basis'])
+        return account_manager
+
+
+# Each case builder returns (name, unit, run) where run() does one round of work and returns how many
+# units it did
+
+def load_case(portfolio, file_format):
+    def run():
+        account_manager = AccountManager(TaxManager())
+        account_manager.toggle_logging()
+        account_manager.load_accounts(portfolio.files[file_format])
+        return 1
+    return 'load_accounts/{}/{}acct'.format(file_format, portfolio.num_accounts), 'loads', run
+
+
+def run_simulation_case(portfolio, num_years):
+    account_manager = portfolio.load()
+    withdraw_algo = WithdrawAlgo(portfolio.withdraws)
+    the_years = range(START_AGE, START_AGE + num_years)
+    counter = iter(range(sys.maxsize))
+
+    def run():
+        account_manager.reset()
+        run_simulation(next(counter), the_years, account_manager, DrawdownConstPercentage(4.0), withdraw_algo,
+                       account_manager.tax_manager, SEED)
+        return num_years
+    return 'run_simulation/{}acct/{}y'.format(portfolio.num_accounts, num_years), 'iteration-years', run
+
+
+def withdraw_case(portfolio):
+    account_manager = portfolio.load()
+    withdraw_algo = WithdrawAlgo(portfolio.withdraws)
+    # Enough to drain a few accounts, as a late year would
+    amount = round(account_manager.get_total_value() * 0.04)
+
+    def run():
+        account_manager.reset()
+        withdraw_algo.withdraw(account_manager, amount)
+        return 1
+    return 'withdraw/{}acct'.format(portfolio.num_accounts), 'withdrawals', run
+
+
+def tax_case(model):
+    tax_manager = TaxManager(model)
+    account_types = ['Brokerage', '401k', 'RothIRA', 'TradIRA', 'RolloverIRA']
+
+    def run():
+        tax_manager.start_year()
+        for account_type in account_types:
+            pretax = tax_manager.how_much_pretax(account_type, 20000)
+            tax_manager.split_it(account_type, pretax)
+        return 2 * len(account_types)
+    return 'tax_manager/{}'.format(model), 'calls', run
+
+
+def batch_tax_case():
+    tax_manager = TaxManager('progressive')
+    amounts = np.random.default_rng(SEED).uniform(0, 200000, 10000)
+    income = np.zeros((2, len(amounts)))
+
+    def run():
+        for kind in [ORDINARY, GAINS]:
+            tax_manager.pretax_for(kind, income, amounts)
+            tax_manager.tax_on(kind, income, amounts)
+        return 4 * len(amounts)
+    return 'tax_manager/progressive_batch', 'amounts', run
+
+
+def drawdown_case(code, iterations=10000, num_years=30):
+    # One year's how-much decision for a batch at a time, on made up values, so the rules compare
+    drawdown = howmuch_algo_chooser((code, 60000 if code == 'c$' else 4.0))
+    rng = np.random.default_rng(SEED)
+    values = rng.uniform(0, 2e6, (num_years, iterations)).round()
+    inflations = rng.normal(0.03, 0.013, (num_years, iterations))
+
+    def run():
+        state = drawdown.start(values[0])
+        withdrawals = np.zeros(iterations)
+        inflation = np.zeros(iterations)
+        for y in range(num_years):
+            withdrawals = drawdown.withdraw(state, values[y], withdrawals, inflation)
+            inflation = inflations[y]
+        return iterations * num_years
+    return 'drawdown/{}'.format(code), 'iteration-years', run
+
+
+def end_to_end_case(portfolio, num_years, iterations=2000, engine='batch'):
+    def run():
+        options = Options(START_AGE, START_AGE + num_years, iterations, ('c%', 4.0), engine, seed=SEED)
+        with contextlib.redirect_stdout(io.StringIO()):
+            run_simulator_and_plot_results(None, portfolio.files['cost_basis'], portfolio.withdraws, options)
+        return iterations * num_years
+    name = 'end_to_end' if engine == 'batch' else 'end_to_end_{}'.format(engine)
+    return '{}/{}acct/{}y'.format(name, portfolio.num_accounts, num_years), 'iteration-years', run
+
+
+def build_cases(directory, account_counts, horizons):
+    cases = [tax_case('flat'), tax_case('progressive'), batch_tax_case()]
+    cases += [drawdown_case(code) for code in DRAWDOWN_CODES]
+    for num_accounts in account_counts:
+        portfolio = Portfolio(directory, num_accounts)
+        cases += [load_case(portfolio, 'cost_basis'), load_case(portfolio, 'asset_alloc'), withdraw_case(portfolio)]
+        for num_years in horizons:
+            cases += [run_simulation_case(portfolio, num_years), end_to_end_case(portfolio, num_years)]
+            # Only with Numba installed; otherwise the jit engine is the batch one and would just repeat it
+            if jit_available():
+                cases.append(end_to_end_case(portfolio, num_years, engine='jit'))
+    return cases
+
+
+def measure(run, min_seconds):
+    # Throughput (units per second) over repeated rounds, and the peak memory of one round
+    run()
+    units = 0
+    start = time.perf_counter()
+    while True:
+        units += run()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_seconds:
+            break
+    tracemalloc.start()
+    try:
+        run()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return units / elapsed, peak
+
+
+@contextlib.contextmanager
+def working_directory(path):
+    # contextlib.chdir, which needs Python 3.11
+    previous = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(previous)
+
+
+def parse_int_list(ctx, param, value):
+    try:
+        return [int(v) for v in value.split(',')]
+    except ValueError:
+        raise click.BadParameter('expected comma separated integers')
+
+
+@click.command()
+@click.option('--accounts', callback=parse_int_list, default=','.join(map(str, ACCOUNT_COUNTS)),
+              help='Synthetic portfolio sizes')
+@click.option('--years', callback=parse_int_list, default=','.join(map(str, HORIZONS)), help='Horizons in years')
+@click.option('--filter', 'name_filter', default='', help='Only run cases whose name contains this')
+@click.option('--min-seconds', default=MIN_SECONDS, help='Minimum time per case')
+@click.option('--save-baseline', type=click.Path(), default=None,
+              help='Write the results here (e.g. {})'.format(os.path.relpath(DEFAULT_BASELINE)))
+@click.option('--compare', type=click.Path(exists=True), default=None,
+              help='Compare against a saved baseline (e.g. {}); exits non-zero on a regression'
+              .format(os.path.relpath(DEFAULT_BASELINE)))
+@click.option('--threshold', default=REGRESSION_THRESHOLD, help='Throughput drop that counts as a regression')
+def suite(accounts, years, name_filter, min_seconds, save_baseline, compare, threshold):
+    # Paths running dry log a warning each; that would swamp the report and time the logging
+    logging.disable(logging.WARNING)
+    baseline = {}
+    if compare:
+        with open(compare) as fp:
+            baseline = json.load(fp)['cases']
+
+    results = {}
+    regressions = []
+    print('{:<40} {:>14} {:<16} {:>9} {:>9}'.format('case', 'throughput', 'unit', 'peak MB', 'change'))
+    with tempfile.TemporaryDirectory() as tmp, working_directory(tmp):
+        for name, unit, run in build_cases(tmp, accounts, years):
+            if name_filter not in name:
+                continue
+            throughput, peak = measure(run, min_seconds)
+            results[name] = {'throughput': throughput, 'unit': unit, 'peak_bytes': peak}
+            change = ''
+            if name in baseline:
+                ratio = throughput / baseline[name]['throughput']
+                change = '{:+.0%}'.format(ratio - 1)
+                if ratio < 1 - threshold:
+                    regressions.append(name)
+                    change += ' !'
+            print('{:<40} {:>14,.1f} {:<16} {:>9.1f} {:>9}'.format(name, throughput, unit, peak / 2 ** 20, change))
+
+    if save_baseline:
+        os.makedirs(os.path.dirname(os.path.abspath(save_baseline)), exist_ok=True)
+        with open(save_baseline, 'w') as fp:
+            json.dump({'python': platform.python_version(), 'numpy': np.__version__,
+                       'machine': platform.machine(), 'cases': results}, fp, indent=2)
+    if regressions:
+        sys.exit('Slower than the baseline by more than {:.0%}: {}'.format(threshold, ', '.join(regressions)))
+
+
+if __name__ == '__main__':
+    suite()
@@ -0,0 +1,70 @@
+import json
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from account_manager import AccountManager
+
+TYPES = ['Brokerage', 'RothIRA', 'RolloverIRA', 'TradIRA', '401k']
+FUNDS = ['-Cash-', 'Vanguard Total Stock Mkt Idx Adm', 'Vanguard Total Bond Mkt Index Adm', 'Vanguard REIT ETF']
+
+
+def account_names(num_accounts):
+    # The real account names when they are enough, otherwise made up ones (see register_names)
+    names = list(AccountManager.NAMES_TO_TYPES)
+    if num_accounts <= len(names):
+        return names[:num_accounts]
+    return ['Synthetic {} {}'.format(TYPES[i % len(TYPES)], i) for i in range(num_accounts)]
+
+
+def register_names(num_accounts):
+    # AccountManager only knows the household's accounts; teach it the made up ones
+    for i, name in enumerate(account_names(num_accounts)):
+        AccountManager.NAMES_TO_TYPES.setdefault(name, TYPES[i % len(TYPES)])
+
+
+def write_balances(path, num_accounts, file_format='cost_basis', seed=1):
+    rnd = random.Random(seed)
+    if file_format == 'cost_basis':
+        lines = ['Cost Basis Report', 'Account\tBasis\tBalance']
+    else:
+        lines = ['Asset Allocation Report', 'Account\tBasis\tShares\tBalance']
+    for name in account_names(num_accounts):
+        lines.append(name)
+        total_basis = total_balance = 0
+        for fund in FUNDS:
+            basis = rnd.randint(1000, 300000)
+            balance = int(basis * rnd.uniform(0.8, 1.6))
+            total_basis += basis
+            total_balance += balance
+            if file_format == 'cost_basis':
+                lines.append('{}\t{}\t{}'.format(fund, basis, balance))
+            else:
+                lines.append('{}\t{}\t{}\t{}'.format(fund, basis, rnd.randint(1, 1000), balance))
+        if file_format == 'cost_basis':
+            lines.append('TOTAL\t{}\t{}'.format(total_basis, total_balance))
+        else:
+            lines.append('TOTAL\t{}\t0\t{}'.format(total_basis, total_balance))
+        lines.append('')
+    lines += ['TOTAL Investments\t0\t0', 'End of Report']
+    with open(path, 'w') as fp:
+        fp.write('\n'.join(lines) + '\n')
+
+
+def write_withdraws(path, num_accounts):
+    with open(path, 'w') as fp:
+        json.dump([{'account': name} for name in account_names(num_accounts)], fp, indent=2)
+
+
+def write_history(path, num_years=100, seed=1):
+    # Made up annual returns in the layout historical_returns reads; not real market data
+    rnd = random.Random(seed)
+    lines = ['year,stocks,bonds,inflation']
+    inflation = 0.03
+    for year in range(1926, 1926 + num_years):
+        inflation = 0.6 * inflation + 0.4 * 0.03 + rnd.gauss(0, 0.015)
+        lines.append('{},{:.4f},{:.4f},{:.4f}'.format(year, rnd.gauss(0.09, 0.18), rnd.gauss(0.045, 0.06), inflation))
+    with open(path, 'w') as fp:
+        fp.write('\n'.join(lines) + '\n')
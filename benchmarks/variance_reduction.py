@@ -0,0 +1,80 @@
+import os
+import tempfile
+import time
+
+import click
+import numpy as np
+
+from synthetic import write_balances, write_withdraws
+from account_manager import AccountManager
+from batch_simulator import iterate_batch_chunks
+from control_variate import build_control_variate
+from loader_withdraw import WithdrawAlgo
+from rate_generator import SAMPLING_MODES
+from result_aggregator import aggregate_chunks
+from retire import howmuch_algo_chooser
+from simulator import create_rate_generator
+from tax_manager import TaxManager
+
+# (sampling, control variate) combinations compared against plain random sampling
+SCHEMES = [(mode, False) for mode in SAMPLING_MODES] + [(mode, True) for mode in SAMPLING_MODES]
+
+
+def _estimate(aggregator, control_variate):
+    if control_variate:
+        return aggregator.control_variate_estimate()[0]
+    return (aggregator.iterations - aggregator.failures) / aggregator.iterations
+
+
+@click.command()
+@click.option('--accounts', default=5, help='Synthetic accounts in the portfolio')
+@click.option('--years', default=30, help='Years simulated')
+@click.option('--iterations', default=2000, help='Iterations per estimate')
+@click.option('--replicates', default=40,
+              help='Independent seeds per scheme; the spread of their estimates is measured')
+@click.option('--how-much', '-hm', nargs=2, default=('c%', 4.5), help='Withdrawal rule, as for retire')
+def variance_reduction(accounts, years, iterations, replicates, how_much):
+    # The variance reduction factor of a scheme is the variance of plain random estimates of the
+    # success rate divided by the scheme's, at the same iteration count: how many times fewer
+    # iterations it needs for the same standard error.
+    tax_manager = TaxManager()
+    with tempfile.TemporaryDirectory() as tmp:
+        balances = os.path.join(tmp, 'balances.tsv')
+        withdraws = os.path.join(tmp, 'withdraws.json')
+        write_balances(balances, accounts)
+        write_withdraws(withdraws, accounts)
+        account_manager = AccountManager(tax_manager)
+        account_manager.load_accounts(balances)
+        withdraw_algo = WithdrawAlgo(withdraws)
+    howmuch_algo = howmuch_algo_chooser(how_much)
+    the_years = range(2025, 2025 + years)
+
+    results = {}
+    for sampling, control_variate in SCHEMES:
+        rate_generator = create_rate_generator(sampling)
+        control = None
+        if control_variate:
+            control = build_control_variate(the_years, account_manager, howmuch_algo, withdraw_algo, tax_manager,
+                                            rate_generator)
+        estimates = []
+        start = time.perf_counter()
+        for seed in range(1, replicates + 1):
+            chunks = iterate_batch_chunks(iterations, the_years, account_manager, howmuch_algo, withdraw_algo,
+                                          tax_manager, seed, rate_generator=rate_generator, control=control)
+            aggregator, _ = aggregate_chunks(chunks, len(the_years))
+            estimates.append(_estimate(aggregator, control_variate))
+        results[(sampling, control_variate)] = (np.array(estimates), time.perf_counter() - start)
+
+    baseline = results[('random', False)][0].var(ddof=1)
+    print('{} iterations x {} seeds, {} accounts, {} years'.format(iterations, replicates, accounts, years))
+    print('{:<30} {:>9} {:>10} {:>8} {:>9}'.format('scheme', 'success', 'std error', 'factor', 'seconds'))
+    for (sampling, control_variate), (estimates, seconds) in results.items():
+        name = sampling + (' + control variate' if control_variate else '')
+        variance = estimates.var(ddof=1)
+        factor = baseline / variance if variance > 0 else float('inf')
+        print('{:<30} {:>8.2f}% {:>9.3f}% {:>8.2f} {:>9.2f}'.format(name, 100 * estimates.mean(),
+                                                                  100 * np.sqrt(variance), factor, seconds))
+
+
+if __name__ == '__main__':
+    variance_reduction()
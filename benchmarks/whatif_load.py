@@ -0,0 +1,95 @@
+import http.client
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import click
+import numpy as np
+
+from synthetic import register_names, write_balances, write_withdraws
+from whatif_server import create_server
+
+# The dashboard's budget for one answer, checked against the 99th percentile once the paths are cached
+TARGET_SECONDS = 0.1
+PERCENTILES = [50, 95, 99]
+
+
+def post(host, port, body):
+    connection = http.client.HTTPConnection(host, port)
+    try:
+        connection.request('POST', '/whatif', json.dumps(body), {'Content-Type': 'application/json'})
+        response = connection.getresponse()
+        payload = json.loads(response.read())
+    finally:
+        connection.close()
+    if response.status != 200:
+        raise RuntimeError('What-if failed ({}): {}'.format(response.status, payload.get('error')))
+    return payload
+
+
+def client(host, port, base, amounts, latencies):
+    # "Change withdrawal to X" requests, one after another
+    for amount in amounts:
+        start = time.perf_counter()
+        post(host, port, {'base': base, 'delta': {'how_much': ['c%', amount]}})
+        latencies.append(time.perf_counter() - start)
+
+
+@click.command()
+@click.option('--requests', 'num_requests', default=200, help='Requests after the first (cold) one')
+@click.option('--concurrency', default=os.cpu_count() or 1, help='Clients sending requests at once')
+@click.option('--accounts', default=5, help='Synthetic portfolio size')
+@click.option('--iterations', default=2000, help='Iterations per what-if')
+@click.option('--years', default=40, help='Horizon in years')
+@click.option('--target', default=TARGET_SECONDS, help='Fail if the warm p99 latency is slower than this')
+def whatif_load(num_requests, concurrency, accounts, iterations, years, target):
+    register_names(accounts)
+    with tempfile.TemporaryDirectory() as tmp:
+        balances = os.path.join(tmp, 'balances.tsv')
+        withdraws = os.path.join(tmp, 'withdraws.json')
+        write_balances(balances, accounts)
+        write_withdraws(withdraws, accounts)
+        base = {'balances': balances, 'withdraws': withdraws, 'start': 50, 'end': 50 + years,
+                'iterations': iterations, 'how_much': ['c%', 4.0]}
+
+        server = create_server(port=0)
+        host, port = server.server_address[:2]
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            # The first request parses the portfolio and draws the returns; the rest reuse them
+            start = time.perf_counter()
+            post(host, port, base)
+            cold = time.perf_counter() - start
+
+            amounts = np.linspace(3.0, 6.0, num_requests)
+            latencies = []
+            clients = [threading.Thread(target=client, args=(host, port, base, amounts[i::concurrency], latencies))
+                       for i in range(concurrency)]
+            start = time.perf_counter()
+            for c in clients:
+                c.start()
+            for c in clients:
+                c.join()
+            elapsed = time.perf_counter() - start
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    if len(latencies) != num_requests:
+        sys.exit('Only {} of {} requests succeeded'.format(len(latencies), num_requests))
+    percentiles = np.percentile(latencies, PERCENTILES)
+    print('cold request:        {:.3f}s'.format(cold))
+    print('throughput:          {:.1f} requests/s ({} requests, {} clients)'
+          .format(num_requests / elapsed, num_requests, concurrency))
+    print('latency:             ' + ', '.join('p{}: {:.3f}s'.format(p, v) for p, v in zip(PERCENTILES, percentiles))
+          + ', max: {:.3f}s'.format(max(latencies)))
+    if percentiles[-1] > target:
+        sys.exit('p99 latency {:.3f}s is over the {:.3f}s target'.format(percentiles[-1], target))
+
+
+if __name__ == '__main__':
+    whatif_load()
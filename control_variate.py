@@ -0,0 +1,63 @@
+import numpy as np
+from account import HOLDING_INDEX
+from batch_simulator import _simulate
+
+CASH, STOCKS, BONDS = HOLDING_INDEX['cash'], HOLDING_INDEX['stocks'], HOLDING_INDEX['bonds']
+
+
+class ControlVariate:
+    # A control for the success rate whose expectation is known: the first-order change in the
+    # final balance from each year's return surprises, weighted by the dollars the deterministic
+    # (every return at its mean) run has in stocks and bonds that year. It is zero on average and
+    # moves with how lucky an iteration's returns were, especially early on, so regressing the
+    # success indicator on it takes out most of the variance that comes from the returns.
+    # Antithetic and Sobol sampling already balance this linear part (the control's sample mean is
+    # about zero), so on top of them it changes little.
+    def __init__(self, means, coefficients):
+        # means is (inflation, stocks, bonds); coefficients is (3, years) in the same order
+        self.means = np.asarray(means, dtype=np.float64)
+        self.coefficients = np.asarray(coefficients, dtype=np.float64)
+
+    def evaluate(self, inflations, stock_returns, bond_returns):
+        # (iterations,) control values for (iterations, years) rate matrices
+        controls = np.zeros(len(inflations))
+        for col, rates in enumerate([inflations, stock_returns, bond_returns]):
+            controls += (np.asarray(rates) - self.means[col]) @ self.coefficients[col]
+        return controls
+
+
+class _DeterministicPath:
+    # Trace stand-in that just keeps the balances of the single deterministic iteration
+    def record(self, iteration_ids, years, columns, account_balances):
+        # (years, asset_class) after each year's withdrawal, summed over accounts
+        self.holdings = account_balances[0].sum(axis=1)
+
+
+def build_control_variate(years, account_manager, how_much_alg, withdraw_alg, tax_manager, rate_generator):
+    rates = rate_generator.mean_matrices(len(years))
+    path = _DeterministicPath()
+    _simulate(years, account_manager, how_much_alg, withdraw_alg, tax_manager, rates, path, [0])
+    holdings = path.holdings
+    inflation, stocks, bonds = [r[0, 0] for r in rates]
+
+    # Stocks and bonds grow and are deflated each year, cash does neither
+    invested = holdings[:, STOCKS] * (1 + stocks) + holdings[:, BONDS] * (1 + bonds)
+    totals = holdings.sum(axis=1)
+    growth = np.where(totals > 0, (holdings[:, CASH] + invested / (1 + inflation)) / np.maximum(totals, 1), 1)
+
+    # A dollar gained in year t compounds at the deterministic growth of the years after it up to the
+    # start of the final year, which is the value success is judged on. The final year's returns
+    # don't reach it at all.
+    num_years = len(years)
+    carry = np.zeros(num_years)
+    for t in range(num_years - 2, -1, -1):
+        carry[t] = 1 if t == num_years - 2 else carry[t + 1] * growth[t + 1]
+
+    # Scaled by the starting value so the controls are O(1)
+    scale = carry / max(totals[0], 1)
+    coefficients = np.array([
+        -invested / (1 + inflation) ** 2 * scale,
+        holdings[:, STOCKS] / (1 + inflation) * scale,
+        holdings[:, BONDS] / (1 + inflation) * scale,
+    ])
+    return ControlVariate((inflation, stocks, bonds), coefficients)
@@ -0,0 +1,45 @@
+import math
+from statistics import NormalDist
+
+# Iterations between convergence checks. Fixed (rather than tied to the worker count) so an
+# adaptive run stops at the same iteration however it is spread across processes.
+ADAPTIVE_CHUNK_SIZE = 1000
+
+
+def wilson_interval(successes, n, confidence=0.95):
+    # Wilson score interval for a binomial proportion; behaves well near 0% and 100%
+    if n == 0:
+        return 0.0, 1.0
+    z = NormalDist().inv_cdf(0.5 + confidence / 2)
+    p = successes / n
+    denominator = 1 + z * z / n
+    center = (p + z * z / (2 * n)) / denominator
+    half_width = z * math.sqrt(p * (1 - p) / n + z * z / (4 * n * n)) / denominator
+    return max(0.0, center - half_width), min(1.0, center + half_width)
+
+
+def success_interval(aggregator, confidence=0.95):
+    # Confidence interval on the success fraction: from the control variate estimate when the run
+    # collected controls, otherwise the Wilson interval. Antithetic and Sobol runs still get the
+    # plain interval, which overstates their error; the benchmarks measure their actual gain.
+    estimate = aggregator.control_variate_estimate()
+    if estimate is None:
+        return wilson_interval(aggregator.iterations - aggregator.failures, aggregator.iterations, confidence)
+    rate, std_error = estimate
+    half_width = NormalDist().inv_cdf(0.5 + confidence / 2) * std_error
+    return max(0.0, rate - half_width), min(1.0, rate + half_width)
+
+
+class ConvergenceCheck:
+    # Stop once the confidence interval on the success rate is narrower than +/- target_half_width
+    # (a fraction, e.g. 0.005 for +/-0.5%)
+    def __init__(self, target_half_width, confidence=0.95, min_iterations=ADAPTIVE_CHUNK_SIZE):
+        self.target_half_width = target_half_width
+        self.confidence = confidence
+        self.min_iterations = min_iterations
+
+    def __call__(self, aggregator):
+        if aggregator.iterations < self.min_iterations:
+            return False
+        low, high = success_interval(aggregator, self.confidence)
+        return (high - low) / 2 <= self.target_half_width
@@ -1,6 +1,48 @@
-class Drawdown:
+import logging
+import numpy as np
+from abc import ABC, abstractmethod
+
+
+def as_fraction(percentage):
+    # Rates may be given as 4 or 0.04
+    if percentage > 1:
+        logging.info("Auto-adjusting percentage from {:.2}%".format(percentage))
+        return percentage / 100
+    return percentage
+
+
+class Drawdown(ABC):
+    # How much to withdraw each year, decided for a whole batch of iterations at once. Balances are
+    # in today's dollars (the simulation deflates them every year), so an amount that stays the same
+    # keeps its spending power.
+    #
+    # Anything a strategy remembers about an iteration lives in the state start() returns, a dict of
+    # per-iteration arrays the caller keeps for the run, never on the strategy itself. One strategy
+    # can then serve any number of iterations, chunks and engines.
     def __init__(self, *args, **kwargs):
         pass
 
-    def withdraw(self, balance):
+    def start(self, total_values):
+        # State for iterations starting out with these total values
+        return {}
+
+    @abstractmethod
+    def withdraw(self, state, total_values, prev_withdrawals, inflations):
+        # Amount to withdraw this year per iteration, given each iteration's total value now, what
+        # it withdrew last year (0 in the first year) and last year's inflation (0 in the first year)
         pass
+
+    def kernel_rule(self):
+        # (--how-much code, parameters) for jit_kernel's compiled year loop to run this rule
+        # itself, or None to keep to the NumPy engine. Only the built-in rules have one.
+        return None
+
+    def start_one(self, total_value):
+        # State for a single iteration, as the scalar engine runs them
+        return self.start(np.array([total_value], dtype=np.float64))
+
+    def withdraw_one(self, state, total_value, prev_withdrawal, inflation):
+        # This year's amount for a single iteration with state from start_one
+        return float(self.withdraw(state, np.array([total_value], dtype=np.float64),
+                                   np.array([prev_withdrawal], dtype=np.float64),
+                                   np.array([inflation], dtype=np.float64))[0])
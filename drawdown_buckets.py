@@ -1,15 +1,35 @@
-from typing import List
-from drawdown import Drawdown
+import logging
+import numpy as np
+from drawdown import Drawdown, as_fraction
 
-
-class DrawdownBuckets(Drawdown):
-    def __init__(self, *args, **kwargs):
-        super().__init__(args, kwargs)
-        self._bucket1 = kwargs['bucket1']
-        self._bucket2 = kwargs['bucket2']
-        self._bucket3 = kwargs['bucket3']
+# (share of the planned spending, how much of its starting value the portfolio must still be worth
+# for it to be paid): needs are always paid, wants while the portfolio is within 20% of where it
+# started, wishes only while it is at least there
+NEEDS = (0.6, 0.0)
+WANTS = (0.3, 0.8)
+WISHES = (0.1, 1.0)
 
 
+class DrawdownBuckets(Drawdown):
+    # Spending planned as a percentage of the starting value, like the constant percentage rule, but
+    # split into buckets that are only paid while the portfolio is funded well enough for them
+    def __init__(self, percentage, bucket1=NEEDS, bucket2=WANTS, bucket3=WISHES):
+        super().__init__()
+        self._percentage = as_fraction(percentage)
+        self._buckets = [bucket1, bucket2, bucket3]
+        if abs(sum(share for share, _ in self._buckets) - 1) > 1e-9:
+            raise RuntimeError('Bucket shares must add up to 1: {}'.format(self._buckets))
+        logging.info("Drawdown buckets %age = {:.4} in {}".format(self._percentage, self._buckets))
 
+    def kernel_rule(self):
+        return 'bk', [self._percentage] + [value for bucket in self._buckets for value in bucket]
 
+    def start(self, total_values):
+        total_values = np.asarray(total_values, dtype=np.float64)
+        return {'planned': self._percentage * total_values, 'start_value': total_values.copy()}
 
+    def withdraw(self, state, total_values, prev_withdrawals, inflations):
+        withdrawal = np.zeros_like(total_values, dtype=np.float64)
+        for share, funded in self._buckets:
+            withdrawal += np.where(total_values >= funded * state['start_value'], share * state['planned'], 0)
+        return withdrawal
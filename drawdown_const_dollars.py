@@ -0,0 +1,15 @@
+import numpy as np
+from drawdown import Drawdown
+
+
+class DrawdownConstDollars(Drawdown):
+    # The same amount every year
+    def __init__(self, amount):
+        super().__init__()
+        self._amount = amount
+
+    def kernel_rule(self):
+        return 'c$', [float(self._amount)]
+
+    def withdraw(self, state, total_values, prev_withdrawals, inflations):
+        return np.full(len(total_values), float(self._amount))
@@ -1,11 +1,21 @@
-from typing import List
-from drawdown import Drawdown
+import logging
+import numpy as np
+from drawdown import Drawdown, as_fraction
 
 
 class DrawdownConstPercentage(Drawdown):
+    # The classic rule: a percentage of the starting value in the first year, then the same amount
+    # every year after
     def __init__(self, percentage):
         super().__init__()
-        self._percentage = percentage
+        self._percentage = as_fraction(percentage)
+        logging.info("Drawdown %age = {:.4}".format(self._percentage))
 
+    def kernel_rule(self):
+        return 'c%', [self._percentage]
 
+    def start(self, total_values):
+        return {'withdrawal': self._percentage * np.asarray(total_values, dtype=np.float64)}
 
+    def withdraw(self, state, total_values, prev_withdrawals, inflations):
+        return state['withdrawal']
@@ -1,9 +1,9 @@
 from enum import Enum
 from drawdown import Drawdown
 from drawdown_const_percentage import DrawdownConstPercentage
-# from drawdown_const_dollars import DrawdownConstDollars
-# from drawdown_guardrails import DrawdownGuardrails
-# from drawdown_mad_fientist import DrawdownMadFientist
+from drawdown_const_dollars import DrawdownConstDollars
+from drawdown_guardrails import DrawdownGuardrails
+from drawdown_mad_fientist import DrawdownMadFientist
 from drawdown_buckets import DrawdownBuckets
 
 
@@ -15,22 +15,29 @@ class DrawdownTypes(Enum):
     BUCKETS = 5
 
 
+# The short names --how-much takes
+DRAWDOWN_CODES = {
+    'c%': DrawdownTypes.CONST_PERCENT,
+    'c$': DrawdownTypes.CONST_DOLLARS,
+    'gr': DrawdownTypes.GUARD_RAILS,
+    'mf': DrawdownTypes.MAD_FIENTIST,
+    'bk': DrawdownTypes.BUCKETS,
+}
+
+
 def create_drawdown(drawdown: DrawdownTypes, *args, **kwargs) -> Drawdown:
     drawdown_obj = None
 
     if drawdown == DrawdownTypes.CONST_PERCENT:
-        drawdown_obj = DrawdownConstPercentage(args, kwargs)
+        drawdown_obj = DrawdownConstPercentage(*args, **kwargs)
     elif drawdown == DrawdownTypes.CONST_DOLLARS:
-        # drawdown_obj = DrawdownConstDollars(args, kwargs)
-        pass
+        drawdown_obj = DrawdownConstDollars(*args, **kwargs)
     elif drawdown == DrawdownTypes.GUARD_RAILS:
-        # drawdown_obj = DrawdownGuardrails(args, kwargs)
-        pass
+        drawdown_obj = DrawdownGuardrails(*args, **kwargs)
     elif drawdown == DrawdownTypes.MAD_FIENTIST:
-        # drawdown_obj = DrawdownMadFientist(args, kwargs)
-        pass
+        drawdown_obj = DrawdownMadFientist(*args, **kwargs)
     elif drawdown == DrawdownTypes.BUCKETS:
-        drawdown_obj = DrawdownBuckets(args, kwargs)
+        drawdown_obj = DrawdownBuckets(*args, **kwargs)
     else:
         raise RuntimeError(f"Invalid drawdown option: {drawdown}")
 
@@ -0,0 +1,42 @@
+import logging
+import numpy as np
+from drawdown import Drawdown, as_fraction
+
+# Guyton-Klinger style guardrails: once the current withdrawal rate strays this far (relative) from
+# the starting rate, the withdrawal is cut or raised by ADJUSTMENT
+GUARD_BAND = 0.2
+ADJUSTMENT = 0.1
+
+
+class DrawdownGuardrails(Drawdown):
+    # Starts like the constant percentage rule and keeps last year's amount, with three adjustments:
+    #   - no raise for inflation after a year the portfolio lost money, so the amount falls by
+    #     that year's inflation in today's dollars
+    #   - a cut when the amount has grown past the upper guardrail as a share of what is left
+    #   - a raise when it has fallen below the lower one
+    def __init__(self, percentage, band=GUARD_BAND, adjustment=ADJUSTMENT):
+        super().__init__()
+        self._percentage = as_fraction(percentage)
+        self._band = band
+        self._adjustment = adjustment
+        logging.info("Drawdown guardrails %age = {:.4} +/- {:.0%}".format(self._percentage, self._band))
+
+    def kernel_rule(self):
+        return 'gr', [self._percentage, self._band, self._adjustment]
+
+    def start(self, total_values):
+        total_values = np.asarray(total_values, dtype=np.float64)
+        return {'withdrawal': self._percentage * total_values, 'last_value': total_values.copy()}
+
+    def withdraw(self, state, total_values, prev_withdrawals, inflations):
+        withdrawal = state['withdrawal']
+        # What last year's withdrawal left to grow, against what it grew to in that year's dollars
+        lost = total_values * (1 + inflations) < state['last_value'] - prev_withdrawals
+        withdrawal = np.where(lost, withdrawal / (1 + inflations), withdrawal)
+        # Compared as amounts rather than rates so an empty portfolio needs no special case
+        over = withdrawal > self._percentage * (1 + self._band) * total_values
+        under = withdrawal < self._percentage * (1 - self._band) * total_values
+        withdrawal = withdrawal * np.where(over, 1 - self._adjustment, np.where(under, 1 + self._adjustment, 1))
+        state['withdrawal'] = withdrawal
+        state['last_value'] = total_values
+        return withdrawal
@@ -0,0 +1,18 @@
+import logging
+from drawdown import Drawdown, as_fraction
+
+
+class DrawdownMadFientist(Drawdown):
+    # The flexible rule the Mad Fientist argues for: withdraw a percentage of whatever the portfolio
+    # is worth at the start of each year. Spending follows the market down and back up, and the
+    # portfolio is never drawn down to nothing.
+    def __init__(self, percentage):
+        super().__init__()
+        self._percentage = as_fraction(percentage)
+        logging.info("Drawdown Mad Fientist %age = {:.4}".format(self._percentage))
+
+    def kernel_rule(self):
+        return 'mf', [self._percentage]
+
+    def withdraw(self, state, total_values, prev_withdrawals, inflations):
+        return self._percentage * total_values
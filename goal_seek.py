@@ -0,0 +1,181 @@
+import json
+import logging
+import os
+import click
+import numpy as np
+from account_manager import AccountManager
+from batch_simulator import _simulate
+from convergence import wilson_interval
+from drawdown import Drawdown
+from loader_withdraw import WithdrawAlgo
+from rate_generator import SAMPLING_MODES
+from simulator import RETURN_SOURCES, create_rate_generator
+from tax_manager import TAX_MODELS, TaxManager
+
+# Paths simulated per candidate before checking whether it is already decided
+PATH_CHUNK = 500
+# Candidates evaluated together in each round of the search
+CANDIDATES_PER_ROUND = 8
+
+
+class _CandidateAmounts(Drawdown):
+    # How-much rule for a batch holding several candidates: row r withdraws amounts[r] every year
+    def __init__(self, amounts):
+        super().__init__()
+        self.amounts = amounts
+
+    def withdraw(self, state, total_values, prev_withdrawals, inflations):
+        return self.amounts
+
+
+class GoalSeek:
+    # Finds the largest constant withdrawal that at least `required` of a fixed set of return paths
+    # survive. A constant percentage is the same thing as a constant dollar amount here (every path
+    # starts from the same balance), so the search is always in dollars.
+    def __init__(self, years, account_manager, withdraw_algo, tax_manager, rates, chunk_size=PATH_CHUNK):
+        self.years = years
+        self.account_manager = account_manager
+        self.withdraw_algo = withdraw_algo
+        self.tax_manager = tax_manager
+        self.rates = rates
+        self.iterations = len(rates[0])
+        self.chunk_size = chunk_size
+        self.start_value = round(account_manager.get_total_value())
+        # Paths simulated, and paths a search without early rejection would have simulated
+        self.path_evaluations = 0
+        self.full_evaluations = 0
+
+    def meets(self, amounts, required):
+        # Whether each candidate amount has at least `required` surviving paths. All candidates run
+        # as one batch, chunk by chunk of paths, and leave it once decided: either enough paths
+        # have failed to rule the candidate out, or enough have survived to accept it.
+        amounts = np.asarray(amounts, dtype=np.float64)
+        successes = np.zeros(len(amounts), dtype=np.int64)
+        failures = np.zeros(len(amounts), dtype=np.int64)
+        decided = np.zeros(len(amounts), dtype=bool)
+        for first in range(0, self.iterations, self.chunk_size):
+            active = np.flatnonzero(~decided)
+            if not len(active):
+                break
+            count = min(self.chunk_size, self.iterations - first)
+            rates = tuple(np.tile(r[first:first + count], (len(active), 1)) for r in self.rates)
+            how_much = _CandidateAmounts(np.repeat(amounts[active], count))
+            values = _simulate(self.years, self.account_manager, how_much, self.withdraw_algo, self.tax_manager,
+                               rates)[0]
+            survived = (values[:, -1] >= 1).reshape(len(active), count).sum(axis=1)
+            successes[active] += survived
+            failures[active] += count - survived
+            decided[active] = (successes[active] >= required) | (failures[active] > self.iterations - required)
+            self.path_evaluations += len(active) * count
+        self.full_evaluations += len(amounts) * self.iterations
+        return successes >= required
+
+    def max_amount(self, required, tolerance, low=0.0, high=None):
+        # low must pass (no withdrawal always does) and high must fail; each round narrows the
+        # bracket to the gap between the best passing and the first failing candidate.
+        # Survival only gets rarer as the amount grows, so passing candidates all come first.
+        if high is None:
+            high = max(self.start_value / 10, tolerance)
+        while self.meets([high], required)[0]:
+            low, high = high, 2 * high
+        while high - low > tolerance:
+            candidates = np.linspace(low, high, CANDIDATES_PER_ROUND + 2)[1:-1]
+            passed = self.meets(candidates, required)
+            if passed.any():
+                low = candidates[passed].max()
+            if not passed.all():
+                high = candidates[~passed].min()
+            logging.info("Goal seek bracket ${:,.2f} - ${:,.2f}".format(low, high))
+        return low, high
+
+
+def required_successes(iterations, passes):
+    # Smallest success count s for which passes(s) holds; passes must be monotone in s
+    low, high = 0, iterations + 1
+    while low < high:
+        mid = (low + high) // 2
+        if passes(mid):
+            high = mid
+        else:
+            low = mid + 1
+    return low
+
+
+def solve(goal_seek, target, confidence, tolerance):
+    # The amount that meets the target on these paths, plus a band: from the largest amount whose
+    # Wilson interval lies wholly above the target up to the largest whose interval still reaches it
+    n = goal_seek.iterations
+    point = required_successes(n, lambda s: s >= target * n)
+    lower = required_successes(n, lambda s: wilson_interval(s, n, confidence)[0] >= target)
+    upper = required_successes(n, lambda s: wilson_interval(s, n, confidence)[1] >= target)
+    if lower > n:
+        raise RuntimeError('{} iterations are too few to be {:g}% confident of {:g}% success'
+                           .format(n, 100 * confidence, 100 * target))
+
+    amount, fail_amount = goal_seek.max_amount(point, tolerance)
+    band_low = goal_seek.max_amount(lower, tolerance, high=fail_amount)[0]
+    band_high = goal_seek.max_amount(upper, tolerance, low=amount)[0]
+    return amount, band_low, band_high
+
+
+@click.command()
+@click.argument('balances', type=click.Path(exists=True))
+@click.argument('withdraws', type=click.Path(exists=True))
+@click.option('--target', type=click.FloatRange(0, 100, min_open=True, max_open=True), default=90,
+              help='Success rate to meet, in percent')
+@click.option('--type', 'hm_type', type=click.Choice(['c%', 'c$']), default='c%',
+              help='Solve for a constant percentage or a constant dollar amount')
+@click.option('--start', type=click.INT, default=48, help='Age at the start of the simulation')
+@click.option('--end', type=click.INT, default=90, help='Age at the end of the simulation')
+@click.option('--iterations', type=click.IntRange(1), default=10000, help='Return paths to test every candidate on')
+@click.option('--tolerance', type=click.FloatRange(min=0, min_open=True), default=None,
+              help='Stop once the answer is known to within this (default 0.01 for c%, 100 for c$)')
+@click.option('--confidence', type=click.FloatRange(0, 1, min_open=True, max_open=True), default=0.95,
+              help='Confidence level of the reported band')
+@click.option('--sampling', type=click.Choice(SAMPLING_MODES), default='random')
+@click.option('--returns', type=click.Choice(RETURN_SOURCES), default='normal')
+@click.option('--history-file', type=click.Path(exists=True), default=None,
+              help='CSV of annual returns for --returns historical or bootstrap')
+@click.option('--lognormal/--no-lognormal', default=False, help='Draw log-normal returns')
+@click.option('--tax-model', type=click.Choice(TAX_MODELS), default='flat')
+@click.option('--summary-file', type=click.Path(), default=None, help='Also write the result as JSON here')
+@click.option('-s', '--seed', default=0, help='Random number seed')
+def goal_seek_cli(balances, withdraws, target, hm_type, start, end, iterations, tolerance, confidence, sampling,
+                  returns, history_file, lognormal, tax_model, summary_file, seed):
+    os.makedirs('logs', exist_ok=True)
+    logging.basicConfig(filename='logs/goal_seek.log', filemode='w', format='%(levelname)s %(filename)s %(message)s',
+                        level=logging.INFO)
+
+    tax_manager = TaxManager(tax_model)
+    account_manager = AccountManager(tax_manager)
+    account_manager.toggle_logging()
+    account_manager.load_accounts(balances)
+    seed = seed if seed else np.random.SeedSequence().entropy
+    the_years = range(start, end)
+
+    # One fixed set of paths for every candidate
+    rate_generator = create_rate_generator(sampling, returns, history_file, lognormal=lognormal)
+    rates = rate_generator.generate_matrices(iterations, len(the_years), seed)
+    goal_seek = GoalSeek(the_years, account_manager, WithdrawAlgo(withdraws), tax_manager, rates)
+
+    # Percentages are searched as dollars of the starting balance
+    scale = 100 / goal_seek.start_value if hm_type == 'c%' else 1
+    if tolerance is None:
+        tolerance = 0.01 if hm_type == 'c%' else 100
+    amounts = solve(goal_seek, target / 100, confidence, tolerance / scale)
+    amount, band_low, band_high = [a * scale for a in amounts]
+
+    unit = '{:.2f}%' if hm_type == 'c%' else '${:,.0f}'
+    print(("Largest {} meeting {:g}% success: " + unit + " ({:g}% band " + unit + " - " + unit + ")")
+          .format(hm_type, target, amount, 100 * confidence, band_low, band_high))
+    print("Simulated {:,} candidate paths instead of {:,} ({:.0%} saved by early rejection)"
+          .format(goal_seek.path_evaluations, goal_seek.full_evaluations,
+                  1 - goal_seek.path_evaluations / goal_seek.full_evaluations))
+    if summary_file:
+        with open(summary_file, 'w') as fp:
+            json.dump({'type': hm_type, 'target': target, 'iterations': iterations, 'seed': seed,
+                       'amount': amount, 'confidence': confidence, 'band': [band_low, band_high]}, fp, indent=2)
+
+
+if __name__ == '__main__':
+    goal_seek_cli()
@@ -0,0 +1,112 @@
+import csv
+import logging
+import os
+import numpy as np
+from rate_generator import RateGenerator
+
+# Ways to turn the history into return paths:
+#   historical  consecutive years starting from a different year for each iteration (wrapping round)
+#   bootstrap   stationary block bootstrap: runs of consecutive years with random lengths and starts
+HISTORICAL_MODES = ['historical', 'bootstrap']
+# Average run length for the block bootstrap, in years
+BLOCK_SIZE = 5
+# Columns of the compiled file; the rate columns are in the same order as RateGenerator's matrices
+COLUMNS = ['year', 'inflation', 'stocks', 'bonds']
+
+
+def compiled_path(csv_path):
+    return os.path.splitext(csv_path)[0] + '.returns.npy'
+
+
+def compile_history(csv_path):
+    # Parse the CSV (year, stocks, bonds, inflation columns in any order; returns as fractions or
+    # with a % sign) into a (years, 4) float array saved next to it, unless that is already up to date.
+    # Returns the path of the compiled file.
+    path = compiled_path(csv_path)
+    if os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(csv_path):
+        return path
+
+    rows = []
+    with open(csv_path, newline='') as fp:
+        reader = csv.DictReader(fp)
+        fields = {name.strip().lower(): name for name in reader.fieldnames or []}
+        missing = [c for c in COLUMNS if c not in fields]
+        if missing:
+            raise RuntimeError('{} is missing columns: {}'.format(csv_path, ', '.join(missing)))
+        for line in reader:
+            rows.append([_parse_return(line[fields[c]]) if c != 'year' else float(line[fields[c]])
+                         for c in COLUMNS])
+    if not rows:
+        raise RuntimeError('No returns in {}'.format(csv_path))
+
+    data = np.array(sorted(rows), dtype=np.float64)
+    logging.info("Compiled {} years of returns from {} into {}".format(len(data), csv_path, path))
+    np.save(path, data)
+    return path
+
+
+def _parse_return(text):
+    text = text.strip()
+    if text.endswith('%'):
+        return float(text[:-1]) / 100
+    return float(text)
+
+
+class HistoricalRateGenerator:
+    # Same interface as RateGenerator, serving rates from a history of annual returns instead of
+    # normal draws. The history is memory-mapped from its compiled file, and every iteration's
+    # path comes from its own (seed, iteration) stream, so chunking and workers don't change results.
+    def __init__(self, csv_path, mode='bootstrap', block_size=BLOCK_SIZE):
+        if mode not in HISTORICAL_MODES:
+            raise RuntimeError('Invalid historical mode: {}'.format(mode))
+        self.csv_path = csv_path
+        self.mode = mode
+        self.block_size = block_size
+        self.data = np.load(compile_history(csv_path), mmap_mode='r')
+        self.years = self.data[:, 0]
+        means = self.data[:, 1:].mean(axis=0)
+        stddevs = self.data[:, 1:].std(axis=0)
+        self.inflation, self.stocks, self.bonds = [(m, s) for m, s in zip(means.tolist(), stddevs.tolist())]
+
+    def __getstate__(self):
+        # Workers map the compiled file themselves rather than receiving a copy of the data
+        state = dict(self.__dict__)
+        del state['data'], state['years']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.data = np.load(compiled_path(self.csv_path), mmap_mode='r')
+        self.years = self.data[:, 0]
+
+    def generate_matrices(self, iterations, years, seed, first_iteration=0):
+        return self.generate_matrices_for(range(first_iteration, first_iteration + iterations), years, seed)
+
+    def generate_matrices_for(self, iteration_ids, years, seed):
+        positions = self.positions(iteration_ids, years, seed)
+        return tuple(np.asarray(self.data[:, col])[positions] for col in range(1, len(COLUMNS)))
+
+    def mean_matrices(self, years):
+        return tuple(np.full((1, years), mean) for mean, _ in [self.inflation, self.stocks, self.bonds])
+
+    def positions(self, iteration_ids, years, seed):
+        # (iterations, years) indexes into the history
+        iteration_ids = np.asarray(iteration_ids, dtype=np.int64)
+        length = len(self.data)
+        offsets = np.arange(years)
+        if self.mode == 'historical':
+            # Every starting year in turn; no randomness, so the seed doesn't matter
+            return (iteration_ids[:, np.newaxis] % length + offsets) % length
+
+        # Each year starts a new run with probability 1 / block_size (always in the first year),
+        # at a uniformly random year; otherwise it carries on to the next year of the current run
+        draws = np.empty((len(iteration_ids), years, 2))
+        for i, iteration in enumerate(iteration_ids.tolist()):
+            draws[i] = RateGenerator.iteration_generator(seed, iteration).random((years, 2))
+        jumps = draws[:, :, 0] < 1 / self.block_size
+        jumps[:, 0] = True
+        starts = (draws[:, :, 1] * length).astype(np.int64)
+        # The year each run started, and where in the history it started
+        run_start = np.maximum.accumulate(np.where(jumps, offsets, 0), axis=1)
+        first_position = np.take_along_axis(starts, run_start, axis=1)
+        return (first_position + offsets - run_start) % length
@@ -0,0 +1,175 @@
+import logging
+import numpy as np
+from account import Account, HOLDINGS, HOLDING_INDEX
+
+# Numba is optional: without it the functions below stay plain Python (only useful for checking
+# them) and callers stay on the NumPy engine
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+CASH, STOCKS, BONDS = [HOLDING_INDEX[h] for h in HOLDINGS]
+NUM_HOLDINGS = len(HOLDINGS)
+# Compiled code reads module constants, not class attributes
+THRESHOLD = Account.THRESHOLD
+# Drawdown.kernel_rule() codes the year loop knows, as the small ints it switches on
+RULES = {'c%': 0, 'c$': 1, 'gr': 2, 'mf': 3, 'bk': 4}
+# What the year loop reports instead of raising, which compiled code can't do with a useful message
+OK, OVER_WITHDRAWN, STRANDED = 0, 1, 2
+
+
+def _compile(function):
+    # Compiled on first call and cached on disk (next to this file, or in NUMBA_CACHE_DIR), so
+    # later runs load the machine code instead of compiling again
+    return njit(cache=True, nogil=True)(function) if njit is not None else function
+
+
+def available():
+    return njit is not None
+
+
+@_compile
+def _pairwise_sum(a, start, n):
+    # numpy's summation order for a contiguous float64 array, so totals round exactly as
+    # AccountManager.get_total_value's do
+    if n < 8:
+        res = 0.0
+        for i in range(start, start + n):
+            res += a[i]
+        return res
+    if n <= 128:
+        r0, r1, r2, r3 = a[start], a[start + 1], a[start + 2], a[start + 3]
+        r4, r5, r6, r7 = a[start + 4], a[start + 5], a[start + 6], a[start + 7]
+        i = 8
+        while i < n - n % 8:
+            j = start + i
+            r0 += a[j]
+            r1 += a[j + 1]
+            r2 += a[j + 2]
+            r3 += a[j + 3]
+            r4 += a[j + 4]
+            r5 += a[j + 5]
+            r6 += a[j + 6]
+            r7 += a[j + 7]
+            i += 8
+        res = ((r0 + r1) + (r2 + r3)) + ((r4 + r5) + (r6 + r7))
+        while i < n:
+            res += a[start + i]
+            i += 1
+        return res
+    n2 = n // 2
+    n2 -= n2 % 8
+    return _pairwise_sum(a, start, n2) + _pairwise_sum(a, start + n2, n - n2)
+
+
+@_compile
+def _round_cents(x):
+    # np.round(x, 2) for one value
+    return np.rint(x * 100.0) / 100.0
+
+
+@_compile
+def _year_loop(balances, slots, slot_rates, rule, params, inflations, stock_returns, bond_returns, values):
+    # The batch engine's year loop, one iteration at a time and one account at a time, for flat
+    # taxes and the built-in drawdown rules. balances is (iterations, accounts * asset_class) and is
+    # updated in place; values gets each iteration's total per year. Returns (status, iteration,
+    # slot index, amount still wanted) so the caller can raise Account.withdraw's errors.
+    iterations, num_years = values.shape
+    width = balances.shape[1]
+    for i in range(iterations):
+        row = balances[i]
+        prev_withdrawal = 0.0
+        prev_inflation = 0.0
+        # The drawdown rule's state: the amount it carries (the withdrawal, or the buckets' planned
+        # spending) and the value it compares against (last year's, or the starting one)
+        kept = 0.0
+        last_value = 0.0
+        for y in range(num_years):
+            total = np.rint(_pairwise_sum(row, 0, width))
+            values[i, y] = total
+
+            # How much, as the Drawdown classes work it out for one iteration; rule is a RULES value
+            p = params[0]
+            if y == 0:
+                kept = p * total
+                last_value = total
+            if rule == 0:
+                requested = kept
+            elif rule == 1:
+                requested = p
+            elif rule == 2:
+                requested = kept
+                if total * (1 + prev_inflation) < last_value - prev_withdrawal:
+                    requested = requested / (1 + prev_inflation)
+                if requested > p * (1 + params[1]) * total:
+                    requested = requested * (1 - params[2])
+                elif requested < p * (1 - params[1]) * total:
+                    requested = requested * (1 + params[2])
+                kept = requested
+                last_value = total
+            elif rule == 3:
+                requested = p * total
+            else:
+                requested = 0.0
+                for b in range(3):
+                    if total >= params[2 + 2 * b] * last_value:
+                        requested += params[1 + 2 * b] * kept
+            prev_withdrawal = requested
+            prev_inflation = inflations[i, y]
+
+            # The withdraw strategy's cascade with its checks, as WithdrawalPlan runs it
+            remaining = requested
+            for k in range(len(slots)):
+                first = slots[k] * NUM_HOLDINGS
+                rate = slot_rates[k]
+                amount_pre = np.rint(remaining / (1 - rate))
+                total_post = 0.0
+                for h in range(NUM_HOLDINGS):
+                    taken = min(row[first + h], amount_pre)
+                    row[first + h] -= taken
+                    amount_pre -= taken
+                    total_post += taken - np.rint(rate * taken)
+                remaining = remaining - total_post
+                if remaining < -THRESHOLD:
+                    return OVER_WITHDRAWN, i, k, remaining
+                if remaining > THRESHOLD and amount_pre <= 0:
+                    for h in range(NUM_HOLDINGS):
+                        if row[first + h] > 0:
+                            return STRANDED, i, k, remaining
+
+            # One year's returns then inflation, rounded to cents
+            for first in range(0, width, NUM_HOLDINGS):
+                row[first + STOCKS] = _round_cents(row[first + STOCKS] * (1 + stock_returns[i, y]))
+                row[first + BONDS] = _round_cents(row[first + BONDS] * (1 + bond_returns[i, y]))
+                row[first + STOCKS] = _round_cents(row[first + STOCKS] / (1 + inflations[i, y]))
+                row[first + BONDS] = _round_cents(row[first + BONDS] / (1 + inflations[i, y]))
+    return OK, 0, 0, 0.0
+
+
+def run_year_loop(start_balances, plan, how_much_alg, rates):
+    # Values per (iteration, year) from the compiled year loop, or None when it can't run this
+    # simulation (no Numba, progressive taxes, or a drawdown rule it doesn't know) and the caller
+    # should use the NumPy engine. Results are the same either way.
+    if njit is None:
+        logging.info("Numba is not installed, using the NumPy engine")
+        return None
+    rule = how_much_alg.kernel_rule()
+    if rule is None or rule[0] not in RULES or plan.tax_manager.is_progressive():
+        logging.info("No compiled year loop for this drawdown or tax model, using the NumPy engine")
+        return None
+
+    inflations, stock_returns, bond_returns = rates
+    iterations, num_years = inflations.shape
+    balances = np.repeat(start_balances.reshape(1, -1), iterations, axis=0)
+    values = np.empty((iterations, num_years))
+    status, i, k, remaining = _year_loop(balances, plan.slots, np.array(plan.slot_rates, dtype=np.float64),
+                                         RULES[rule[0]], np.array(rule[1], dtype=np.float64),
+                                         np.ascontiguousarray(inflations), np.ascontiguousarray(stock_returns),
+                                         np.ascontiguousarray(bond_returns), values)
+    if status == OVER_WITHDRAWN:
+        raise RuntimeError('Withholding more than asked: {}, {} over'.format(plan.order[k], -remaining))
+    if status == STRANDED:
+        left_in = balances[i].reshape(start_balances.shape)[plan.order[k]]
+        raise RuntimeError('Money still remaining: {}, {}'.format(remaining, dict(zip(HOLDINGS, left_in.tolist()))))
+    return values
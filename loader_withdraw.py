@@ -10,6 +10,12 @@ class WithdrawAlgo:
         with open(fname) as f:
             self._strategy = json.load(f)
 
+    def get_strategy(self):
+        return self._strategy
+
+    def get_account_names(self):
+        return [account_json['account'] for account_json in self._strategy]
+
     def _run_withdrawal(self, accounts, amount_post):
         remaining_amount_post = amount_post
         total_tax_paid = 0
@@ -26,13 +32,15 @@ class WithdrawAlgo:
     def withdraw(self, account_manager, amount_requested):
         amount_remaining = amount_requested
         total_tax_paid = 0
+        log_accounts = logging.getLogger().isEnabledFor(logging.INFO)
         for account_json in self._strategy:
             name = account_json['account']
             # Get the account with matching name
             account = account_manager.get_account_by_name(name)
             # See how much money we can get from this account including taxes
             amount_withdrawn, tax_paid = account.withdraw(amount_remaining)
-            logging.info("[{}] withdraw ${:,.2f} tax ${:,.2f}".format(name, amount_withdrawn, tax_paid))
+            if log_accounts:
+                logging.info("[{}] withdraw ${:,.2f} tax ${:,.2f}".format(name, amount_withdrawn, tax_paid))
             amount_remaining -= amount_withdrawn
             total_tax_paid += tax_paid
             # Did we get what we needed?
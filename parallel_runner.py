@@ -0,0 +1,165 @@
+import logging
+import numpy as np
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from multiprocessing import shared_memory
+from account_manager import AccountManager
+from batch_simulator import iterate_batch_chunks
+from result_aggregator import ResultAggregator, aggregate_chunks
+from tax_manager import TaxManager
+
+# Each worker gets this many tasks; every task returns one partial aggregate
+TASKS_PER_WORKER = 4
+
+# Per-worker state, built once by _init_worker
+_WORKER = {}
+
+
+class SharedPartials:
+    # Fixed-size slots for partial ResultAggregators, all backed by one shared memory block, so
+    # workers hand back their results without pickling them. Views into it must not outlive close().
+    def __init__(self, slots, num_years):
+        layout = ResultAggregator(num_years)
+        self.dtype = _partial_dtype(num_years, layout.bands.num_buckets, layout.max_sample_paths)
+        self.shm = shared_memory.SharedMemory(create=True, size=max(slots * self.dtype.itemsize, 1))
+        self.block = _partial_views(self.shm, slots, self.dtype)
+        self.settings = {'num_years': num_years, 'max_sample_paths': layout.max_sample_paths,
+                         'relative_accuracy': layout.bands.relative_accuracy}
+
+    def read(self, slot):
+        # A copy of the partial in slot, so the slot can take the next task's
+        record = self.block[slot]
+        samples = record['num_samples']
+        arrays = {name: record[name] for name in self.dtype.names}
+        arrays['sample_ids'] = arrays['sample_ids'][:samples]
+        arrays['sample_paths'] = arrays['sample_paths'][:samples]
+        return ResultAggregator.from_arrays(dict(arrays, **self.settings))
+
+    def close(self):
+        self.block = None
+        self.shm.close()
+        self.shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def _partial_dtype(num_years, num_buckets, max_sample_paths):
+    # One partial aggregate as a record: ResultAggregator.to_arrays, with the path sample padded
+    # to its maximum size and num_samples saying how much of it is used
+    return np.dtype([
+        ('iterations', np.int64),
+        ('failures', np.int64),
+        ('failure_years', np.int64, (num_years,)),
+        ('terminal_counts', np.int64, (1, num_buckets)),
+        ('band_counts', np.int64, (num_years, num_buckets)),
+        ('num_samples', np.int64),
+        ('sample_ids', np.int64, (max_sample_paths,)),
+        ('sample_paths', np.float64, (max_sample_paths, num_years)),
+        ('control_count', np.int64),
+        ('control_sums', np.float64, (3,)),
+    ])
+
+
+def _partial_views(shm, slots, dtype):
+    return np.ndarray((slots,), dtype=dtype, buffer=shm.buf)
+
+
+def _store_partial(block, slot, partial):
+    arrays = partial.to_arrays()
+    samples = len(arrays['sample_ids'])
+    for name in block.dtype.names:
+        if name == 'num_samples':
+            block[name][slot] = samples
+        elif name in ('sample_ids', 'sample_paths'):
+            block[name][slot][:samples] = arrays[name]
+        else:
+            block[name][slot] = arrays[name]
+
+
+def _init_worker(template, withdraw_algo, howmuch_algo, rate_generator=None, control=None, tax_manager=None,
+                 jit=False):
+    tax_manager = tax_manager if tax_manager is not None else TaxManager()
+    account_manager = AccountManager(tax_manager)
+    account_manager.load_template(template)
+    _WORKER.update({
+        'tax_manager': tax_manager,
+        'account_manager': account_manager,
+        'howmuch_algo': howmuch_algo,
+        'withdraw_algo': withdraw_algo,
+        'rate_generator': rate_generator,
+        'control': control,
+        'jit': jit,
+    })
+
+
+def _aggregate_range(shm_name, dtype, slot, years, seed, first_iteration, count, trace_policy):
+    # Leaves the partial aggregate in its slot of the shared block and returns the iterations to trace
+    chunks = iterate_batch_chunks(count, years, _WORKER['account_manager'], _WORKER['howmuch_algo'],
+                                  _WORKER['withdraw_algo'], _WORKER['tax_manager'], seed, first_iteration,
+                                  rate_generator=_WORKER['rate_generator'], control=_WORKER['control'],
+                                  jit=_WORKER['jit'])
+    partial, trace_ids = aggregate_chunks(chunks, len(years), trace_policy)
+    # Pool workers share the parent's resource tracker, so attaching doesn't take ownership
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        block = _partial_views(shm, len(shm.buf) // dtype.itemsize, dtype)
+        _store_partial(block, slot, partial)
+        del block
+    finally:
+        shm.close()
+    return trace_ids
+
+
+def run_parallel_aggregation(iterations, years, template, withdraw_algo, howmuch_algo, seed, workers,
+                             trace_policy=None, stop_when=None, task_size=None, rate_generator=None, control=None,
+                             tax_manager=None, jit=False):
+    # Workers reduce their iterations to partial ResultAggregators, which are merged here in
+    # iteration order. Each task in flight has its own slot in a SharedPartials block for its
+    # partial, so only the task's arguments and trace ids are pickled, and the slot is reused for
+    # the next task once merged. Only a few tasks are in flight at a time. stop_when(aggregator)
+    # is checked after each merge, like aggregate_chunks does, so with a fixed task_size an early
+    # stop lands on the same iteration as a single-process run.
+    # Returns the aggregator and the iterations to trace.
+    if task_size is None:
+        task_size = max(1, -(-iterations // (workers * TASKS_PER_WORKER)))
+    ranges = iter([(first, min(task_size, iterations - first)) for first in range(0, iterations, task_size)])
+    logging.info("Aggregating up to {} iterations in tasks of {} on {} workers".format(iterations, task_size, workers))
+
+    aggregator = ResultAggregator(len(years))
+    trace_ids = []
+    in_flight = 2 * workers
+    with SharedPartials(in_flight, len(years)) as shared, \
+            ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                initargs=(template, withdraw_algo, howmuch_algo, rate_generator, control,
+                                          tax_manager, jit)) as pool:
+        def submit(slot, first, count):
+            future = pool.submit(_aggregate_range, shared.shm.name, shared.dtype, slot, years, seed, first, count,
+                                 trace_policy)
+            return slot, future
+
+        pending = deque(submit(slot, first, count)
+                        for slot, (first, count) in enumerate(islice(ranges, in_flight)))
+        try:
+            while pending:
+                slot, future = pending.popleft()
+                trace_ids.append(future.result())
+                aggregator.merge(shared.read(slot))
+                if stop_when is not None and stop_when(aggregator):
+                    break
+                for first, count in islice(ranges, 1):
+                    pending.append(submit(slot, first, count))
+        finally:
+            # Stopping early, or stop_when raised (e.g. a cancelled GUI run): drop the queued tasks.
+            # Leaving the with waits for the running ones, so none writes to the block once it's gone.
+            for _, future in pending:
+                future.cancel()
+
+    trace_ids = np.concatenate(trace_ids) if trace_ids else np.zeros(0, dtype=np.int64)
+    if trace_policy is not None:
+        trace_ids = trace_policy.limit(trace_ids)
+    return aggregator, trace_ids
@@ -0,0 +1,84 @@
+import numpy as np
+
+# matplotlib is imported inside the functions so headless runs never load it
+PLOT_MODES = ['fan', 'heatmap', 'paths']
+FAN_PERCENTILES = [5, 25, 50, 75, 95]
+HEATMAP_BINS = 100
+
+
+def create_figure(aggregator, the_years, mode='fan'):
+    # Everything drawn comes from the aggregator, so the cost doesn't grow with the iteration count
+    import matplotlib.figure
+    from matplotlib.ticker import FuncFormatter
+
+    fig = matplotlib.figure.Figure(layout='tight')
+    plot1 = fig.add_subplot(111, xlabel='Years', xlim=(the_years[0], the_years[-1] + 1), ylabel='Amount')
+
+    if mode == 'fan':
+        _plot_fan(plot1, aggregator, the_years)
+    elif mode == 'heatmap':
+        _plot_heatmap(fig, plot1, aggregator, the_years)
+    elif mode == 'paths':
+        _plot_paths(plot1, aggregator, the_years)
+    else:
+        raise RuntimeError('Invalid plot mode: {}'.format(mode))
+
+    plot1.set_ylim(bottom=0)
+    plot1.yaxis.set_major_formatter(FuncFormatter(_format_dollars))
+    return fig
+
+
+def _format_dollars(value, pos=None):
+    if abs(value) >= 1e6:
+        return '${:,.1f}M'.format(value / 1e6)
+    return '${:,.0f}K'.format(value / 1e3)
+
+
+def _plot_fan(plot1, aggregator, the_years):
+    p5, p25, p50, p75, p95 = aggregator.percentile_bands(FAN_PERCENTILES)
+    plot1.fill_between(the_years, p5, p95, color='tab:blue', alpha=0.2, linewidth=0, label='5-95%')
+    plot1.fill_between(the_years, p25, p75, color='tab:blue', alpha=0.4, linewidth=0, label='25-75%')
+    plot1.plot(the_years, p50, color='tab:blue', label='Median')
+    plot1.legend(loc='upper left')
+
+
+def _plot_heatmap(fig, plot1, aggregator, the_years):
+    from matplotlib.colors import PowerNorm
+
+    # Share of iterations at each value, year by year, up to the highest 95th percentile
+    top = np.nanmax(aggregator.percentile_bands([95])) * 1.05
+    edges = np.linspace(0, top if top > 0 else 1, HEATMAP_BINS + 1)
+    counts = aggregator.bands.histogram(edges)
+    density = counts / np.maximum(1, aggregator.iterations)
+    year_edges = np.arange(the_years[0], the_years[-1] + 2)
+    # A power norm keeps the spread-out years visible next to the start year and the zero row
+    mesh = plot1.pcolormesh(year_edges, edges, density.T, cmap='viridis', shading='flat',
+                            norm=PowerNorm(gamma=0.3, vmin=0, vmax=density.max() or 1))
+    fig.colorbar(mesh, ax=plot1, label='Share of iterations')
+
+
+def _plot_paths(plot1, aggregator, the_years):
+    # One LineCollection for the whole sample instead of a Line2D per iteration
+    from matplotlib.collections import LineCollection
+
+    paths = aggregator.sample_paths
+    segments = np.stack([np.broadcast_to(np.asarray(the_years, dtype=np.float64), paths.shape), paths], axis=-1)
+    lines = LineCollection(segments, array=np.arange(len(paths)), cmap='tab20', linewidths=0.8, alpha=0.8)
+    plot1.add_collection(lines)
+    plot1.autoscale_view()
+    plot1.set_title('{} of {} iterations'.format(len(paths), aggregator.iterations))
+
+
+def create_sweep_figure(rows, columns, success_rates, row_label, column_label):
+    # Success rate heatmap over a two-parameter sweep; success_rates is (len(rows), len(columns))
+    import matplotlib.figure
+
+    fig = matplotlib.figure.Figure(layout='tight')
+    plot1 = fig.add_subplot(111, xlabel=column_label, ylabel=row_label)
+    mesh = plot1.imshow(success_rates, cmap='RdYlGn', vmin=0, vmax=100, origin='lower', aspect='auto')
+    plot1.set_xticks(range(len(columns)), [str(c) for c in columns])
+    plot1.set_yticks(range(len(rows)), [str(r) for r in rows])
+    for (i, j), rate in np.ndenumerate(success_rates):
+        plot1.text(j, i, '{:.0f}%'.format(rate), ha='center', va='center', fontsize=8)
+    fig.colorbar(mesh, ax=plot1, label='Success rate (%)')
+    return fig
@@ -0,0 +1,36 @@
+import numpy as np
+from account import HOLDINGS, FIELDS
+
+
+class PortfolioTemplate:
+    # Parsed starting portfolio. Built once from the balances file and never modified;
+    # AccountManager.reset() restores its accounts from the snapshot below.
+
+    def __init__(self, data):
+        self.names = tuple(d['name'] for d in data)
+        self.types = tuple(d['type'] for d in data)
+
+        # (accounts, holdings, fields) flattened, read-only
+        snapshot = np.zeros((len(data), len(HOLDINGS), len(FIELDS)), dtype=np.float64)
+        for a, the_data in enumerate(data):
+            for h, holding in enumerate(HOLDINGS):
+                if holding in the_data['holdings']:
+                    for f, field in enumerate(FIELDS):
+                        snapshot[a, h, f] = the_data['holdings'][holding][field]
+        self.snapshot = snapshot.ravel()
+        self.snapshot.setflags(write=False)
+
+    def __len__(self):
+        return len(self.names)
+
+    def get_account_snapshot(self, index):
+        return self.snapshot.reshape(len(self), len(HOLDINGS), len(FIELDS))[index]
+
+    def get_account_defs(self):
+        # Fresh, mutable account definitions in the format Account expects
+        return [{
+            'name': name,
+            'type': the_type,
+            'holdings': {holding: dict(zip(FIELDS, values.tolist()))
+                         for holding, values in zip(HOLDINGS, self.get_account_snapshot(a))},
+        } for a, (name, the_type) in enumerate(zip(self.names, self.types))]
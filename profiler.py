@@ -0,0 +1,201 @@
+import functools
+import logging
+import os
+import time
+import tracemalloc
+import batch_simulator
+import jit_kernel
+from account import Account
+from account_manager import AccountManager
+from drawdown_buckets import DrawdownBuckets
+from drawdown_const_dollars import DrawdownConstDollars
+from drawdown_const_percentage import DrawdownConstPercentage
+from drawdown_guardrails import DrawdownGuardrails
+from drawdown_mad_fientist import DrawdownMadFientist
+from historical_returns import HistoricalRateGenerator
+from loader_withdraw import WithdrawAlgo
+from rate_generator import RateGenerator
+from result_aggregator import ResultAggregator
+from result_cache import ResultCache
+from trace_store import TraceStore
+
+# (owner, attribute, phase): what gets timed. The profiler swaps each attribute for a timing wrapper
+# while it runs and puts the original back afterwards, so when it isn't running nothing is wrapped
+# and there is no overhead at all. Functions are patched in the module that calls them, since
+# `from x import f` makes a copy of the name; None stands for the retire module that is running.
+# Work done inside process pool workers isn't seen.
+PHASES = [
+    (AccountManager, 'parse_accounts', 'load balances'),
+    (AccountManager, 'load_template', 'load balances'),
+    (ResultCache, 'load', 'result cache'),
+    (ResultCache, 'store', 'result cache'),
+    (RateGenerator, 'generate_matrices_for', 'rate generation'),
+    (HistoricalRateGenerator, 'generate_matrices_for', 'rate generation'),
+    (None, 'build_control_variate', 'control variate'),
+    (None, 'run_simulation', 'simulate'),
+    (batch_simulator, '_simulate', 'simulate'),
+    (jit_kernel, 'run_year_loop', 'compiled year loop'),
+    (DrawdownConstPercentage, 'withdraw', 'how much'),
+    (DrawdownConstDollars, 'withdraw', 'how much'),
+    (DrawdownGuardrails, 'withdraw', 'how much'),
+    (DrawdownMadFientist, 'withdraw', 'how much'),
+    (DrawdownBuckets, 'withdraw', 'how much'),
+    (WithdrawAlgo, 'withdraw', 'withdraw'),
+    (batch_simulator.WithdrawalPlan, 'withdraw', 'withdraw'),
+    (Account, 'withdraw', 'account withdraw'),
+    (AccountManager, 'get_account_by_name', 'account lookup'),
+    (AccountManager, 'apply_stock_return', 'apply returns'),
+    (AccountManager, 'apply_bond_return', 'apply returns'),
+    (AccountManager, 'apply_inflation', 'apply returns'),
+    (batch_simulator, '_apply_returns', 'apply returns'),
+    (ResultAggregator, 'add', 'aggregate'),
+    (None, 'trace_iterations', 'trace'),
+    (logging.Logger, '_log', 'logging'),
+    (None, 'summarize_results', 'summary'),
+    (None, 'plot_results', 'plot'),
+    (None, 'save_plot', 'plot'),
+]
+MEGABYTE = 2 ** 20
+
+
+class _Frame:
+    __slots__ = ('phase', 'start', 'children', 'peak')
+
+    def __init__(self, phase, start):
+        self.phase = phase
+        self.start = start
+        # Time spent in nested phases, and the highest traced memory seen so far in this one
+        self.children = 0.0
+        self.peak = 0
+
+
+class PhaseProfiler:
+    # Per-phase call counts and times (total, and self time excluding nested phases), plus counters
+    # for bytes written. With memory=True it also tracks the peak traced memory inside each phase.
+    def __init__(self, memory=False, app=None):
+        # app is the retire module itself, which is __main__ rather than `retire` when run as a script
+        if app is None:
+            import retire as app
+        self.app = app
+        self.memory = memory
+        self.calls = {}
+        self.total = {}
+        self.own = {}
+        self.peaks = {}
+        self.counters = {'bytes written': 0}
+        self.wall = 0.0
+        self._stack = []
+        self._patched = []
+        self._started = None
+
+    def start(self):
+        if self.memory:
+            tracemalloc.start()
+        phases = [(owner or self.app, name, phase) for owner, name, phase in PHASES]
+        self._patched = [(owner, name, vars(owner)[name]) for owner, name, _ in phases]
+        for owner, name, phase in phases:
+            setattr(owner, name, self._timed(phase, vars(owner)[name]))
+        # Bytes are counted where they reach the disk
+        self._patched += [(owner, name, vars(owner)[name]) for owner, name in
+                          [(logging.FileHandler, 'emit'), (TraceStore, 'save'), (self.app, 'save_plot')]]
+        logging.FileHandler.emit = self._count_emit(logging.FileHandler.emit)
+        TraceStore.save = self._count_file(TraceStore.save, lambda store, path: path)
+        self.app.save_plot = self._count_file(self.app.save_plot, lambda aggregator, options: options.plot_file)
+        self._stack = [_Frame(None, time.perf_counter())]
+        self._started = self._stack[0].start
+        return self
+
+    def stop(self):
+        self.wall = time.perf_counter() - self._started
+        for owner, name, original in reversed(self._patched):
+            setattr(owner, name, original)
+        self._patched = []
+        if self.memory:
+            self.peaks[None] = self._current_peak(self._stack[0])
+            tracemalloc.stop()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def count(self, counter, amount=1):
+        self.counters[counter] = self.counters.get(counter, 0) + amount
+
+    def _timed(self, phase, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            self._enter(phase)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._exit()
+        return wrapper
+
+    def _count_emit(self, emit):
+        # FileHandler flushes every record, so the stream position moves by what was written
+        @functools.wraps(emit)
+        def wrapper(handler, record):
+            before = handler.stream.tell() if handler.stream else 0
+            emit(handler, record)
+            self.count('bytes written', handler.stream.tell() - before)
+        return wrapper
+
+    def _count_file(self, func, path_of):
+        @functools.wraps(func)
+        def wrapper(*args):
+            result = func(*args)
+            path = path_of(*args)
+            if path and os.path.exists(path):
+                self.count('bytes written', os.path.getsize(path))
+            return result
+        return wrapper
+
+    def _enter(self, phase):
+        frame = _Frame(phase, time.perf_counter())
+        if self.memory:
+            # Fold the peak so far into the enclosing phase, then measure this one from scratch
+            parent = self._stack[-1]
+            parent.peak = self._current_peak(parent)
+            tracemalloc.reset_peak()
+        self._stack.append(frame)
+
+    def _exit(self):
+        frame = self._stack.pop()
+        elapsed = time.perf_counter() - frame.start
+        parent = self._stack[-1]
+        parent.children += elapsed
+        phase = frame.phase
+        self.calls[phase] = self.calls.get(phase, 0) + 1
+        self.own[phase] = self.own.get(phase, 0.0) + elapsed - frame.children
+        # A phase nested in itself (e.g. a wrapped method calling its wrapped twin) only counts once
+        if all(f.phase != phase for f in self._stack):
+            self.total[phase] = self.total.get(phase, 0.0) + elapsed
+        if self.memory:
+            peak = self._current_peak(frame)
+            self.peaks[phase] = max(self.peaks.get(phase, 0), peak)
+            parent.peak = max(parent.peak, peak)
+
+    @staticmethod
+    def _current_peak(frame):
+        return max(frame.peak, tracemalloc.get_traced_memory()[1])
+
+    def report(self):
+        # The breakdown as a table, slowest self time first
+        lines = ['{:<18} {:>11} {:>10} {:>10} {:>7}'.format('phase', 'calls', 'total s', 'self s', 'self %')
+                 + (' {:>9}'.format('peak MB') if self.memory else '')]
+        wall = self.wall or 1e-9
+        for phase in sorted(self.own, key=self.own.get, reverse=True):
+            line = '{:<18} {:>11,} {:>10.3f} {:>10.3f} {:>6.1f}%'.format(
+                phase, self.calls[phase], self.total[phase], self.own[phase], 100 * self.own[phase] / wall)
+            if self.memory:
+                line += ' {:>9.1f}'.format(self.peaks[phase] / MEGABYTE)
+            lines.append(line)
+        other = wall - sum(self.own.values())
+        lines.append('{:<18} {:>11} {:>10} {:>10.3f} {:>6.1f}%'.format('(other)', '', '', other, 100 * other / wall))
+        lines.append('{:<18} {:>11} {:>10.3f}'.format('wall', '', self.wall)
+                     + (' {:>27.1f}'.format(self.peaks[None] / MEGABYTE) if self.memory else ''))
+        for counter, amount in self.counters.items():
+            lines.append('{}: {:,}'.format(counter, amount))
+        return '\n'.join(lines)
@@ -1,11 +1,38 @@
+import warnings
 import numpy as np
 
+# How the standard normal draws behind the returns are produced:
+#   random      independent pseudo-random draws per iteration
+#   antithetic  iterations 2k and 2k+1 share draws, the second with every draw negated
+#   sobol       scrambled Sobol points over the (year, series) dimensions, through the inverse normal CDF
+# Whatever the mode, iteration i's draws depend only on (seed, i), so chunking and workers don't change results.
+SAMPLING_MODES = ['random', 'antithetic', 'sobol']
+# Keeps Sobol points off 0 and 1, where the inverse normal CDF is infinite
+SOBOL_EPSILON = 1e-12
+
 
 class RateGenerator:
-    def __init__(self, stock_mean, stock_stddev, bond_mean, bond_stddev, inflation_mean, inflation_stddev):
+    def __init__(self, stock_mean, stock_stddev, bond_mean, bond_stddev, inflation_mean, inflation_stddev,
+                 sampling='random', correlation=None, lognormal=False):
+        if sampling not in SAMPLING_MODES:
+            raise RuntimeError('Invalid sampling mode: {}'.format(sampling))
+        if sampling == 'sobol':
+            # Checked here so a missing scipy stops the run before anything is simulated
+            try:
+                import scipy.special
+                import scipy.stats.qmc  # noqa: F401
+            except ImportError:
+                raise RuntimeError('Sobol sampling needs scipy installed (pip install scipy)')
         self.stocks = (stock_mean, stock_stddev)
         self.bonds = (bond_mean, bond_stddev)
         self.inflation = (inflation_mean, inflation_stddev)
+        self.sampling = sampling
+        # Log-normal returns keep the same mean and standard deviation but can't fall to -100%
+        self.lognormal = lognormal
+        self.set_correlation(correlation)
+        # ((seed, dimensions), engine): the Sobol engine is kept so consecutive chunks carry on from
+        # where the last one stopped instead of fast-forwarding from the start each time
+        self._sobol = None
 
     def set_stocks_params(self, mean: float, stddev: float = None):
         self.stocks = (mean, stddev)
@@ -16,6 +43,23 @@ class RateGenerator:
     def set_inflation_params(self, mean: float, stddev: float = None):
         self.inflation = (mean, stddev)
 
+    def set_correlation(self, correlation=None):
+        # 3x3 correlation of the inflation, stock and bond draws (in that order), or None for independent
+        self.correlation = None
+        self._cholesky = None
+        if correlation is not None:
+            self.correlation = np.asarray(correlation, dtype=np.float64)
+            try:
+                self._cholesky = np.linalg.cholesky(self.correlation)
+            except np.linalg.LinAlgError:
+                raise RuntimeError('Correlation matrix is not positive definite: {}'.format(correlation))
+
+    @staticmethod
+    def _log_params(mean, stddev):
+        # (mu, sigma) of log(1 + r) that give r the requested mean and standard deviation
+        sigma2 = np.log1p((stddev / (1 + mean)) ** 2)
+        return np.log1p(mean) - sigma2 / 2, np.sqrt(sigma2)
+
     def generate_stock_return(self):
         # If stddev not set, just return mean
         if not self.stocks[1]:
@@ -37,3 +81,84 @@ class RateGenerator:
         # Generate random distribution
         return round(np.random.normal(self.inflation[0], self.inflation[1]), 4)
 
+    def generate_matrices(self, iterations, years, seed, first_iteration=0):
+        # Draw (iterations, years) inflation, stock and bond matrices in one pass. Iteration i
+        # gets its own stream derived from (seed, i), so its returns are the same no matter
+        # which batch or worker it runs in.
+        return self.generate_matrices_for(range(first_iteration, first_iteration + iterations), years, seed)
+
+    def generate_matrices_for(self, iteration_ids, years, seed):
+        # Same as above for any set of iterations, e.g. to re-run just the ones being traced
+        return self.rates_from_normals(self.standard_normals(iteration_ids, years, seed))
+
+    def rates_from_normals(self, draws):
+        # Turn (iterations, years, 3) standard normal draws into this generator's rate matrices, so
+        # the same draws can be reused under different means and deviations
+        iterations, years, _ = draws.shape
+        if self._cholesky is not None:
+            # One batched multiply by the Cholesky factor correlates every (iteration, year) triple
+            draws = draws @ self._cholesky.T
+        rates = []
+        for col, (mean, stddev) in enumerate([self.inflation, self.stocks, self.bonds]):
+            # If stddev not set, just use the mean (the draws are still made to keep streams aligned)
+            if not stddev:
+                rates.append(np.full((iterations, years), mean))
+            elif self.lognormal:
+                mu, sigma = self._log_params(mean, stddev)
+                rates.append(np.round(np.expm1(mu + sigma * draws[:, :, col]), 4))
+            else:
+                rates.append(np.round(mean + stddev * draws[:, :, col], 4))
+        return tuple(rates)
+
+    def mean_matrices(self, years):
+        # The deterministic run: every return at its mean, as (1, years) matrices
+        return tuple(np.full((1, years), mean) for mean, _ in [self.inflation, self.stocks, self.bonds])
+
+    def standard_normals(self, iteration_ids, years, seed):
+        # (iterations, years, 3) draws in inflation, stocks, bonds order
+        iteration_ids = np.asarray(iteration_ids, dtype=np.int64)
+        if self.sampling == 'sobol':
+            return self._sobol_normals(iteration_ids, years, seed)
+
+        draws = np.empty((len(iteration_ids), years, 3))
+        for i, iteration in enumerate(iteration_ids.tolist()):
+            if self.sampling == 'antithetic':
+                draws[i] = self.iteration_generator(seed, iteration // 2).standard_normal((years, 3))
+                if iteration % 2:
+                    np.negative(draws[i], out=draws[i])
+            else:
+                draws[i] = self.iteration_generator(seed, iteration).standard_normal((years, 3))
+        return draws
+
+    def _sobol_normals(self, iteration_ids, years, seed):
+        # Iteration i is point i of one scrambled sequence; year 0 gets the first (best spread) dimensions
+        from scipy.special import ndtri
+
+        points = np.empty((len(iteration_ids), years * 3))
+        starts = [0] + (np.flatnonzero(np.diff(iteration_ids) != 1) + 1).tolist() + [len(iteration_ids)]
+        for start, end in zip(starts[:-1], starts[1:]):
+            if end > start:
+                engine = self._sobol_engine(seed, years * 3, int(iteration_ids[start]))
+                with warnings.catch_warnings():
+                    # Chunks are slices of one long sequence, so their own size needn't be a power of 2
+                    warnings.simplefilter('ignore', UserWarning)
+                    points[start:end] = engine.random(end - start)
+        np.clip(points, SOBOL_EPSILON, 1 - SOBOL_EPSILON, out=points)
+        return ndtri(points).reshape(len(iteration_ids), years, 3)
+
+    def _sobol_engine(self, seed, dimensions, position):
+        from scipy.stats import qmc
+
+        key = (seed, dimensions)
+        if self._sobol is None or self._sobol[0] != key or self._sobol[1].num_generated > position:
+            # seed= rather than rng=, which only scipy 1.15 and later accept; both take a Generator
+            rng = np.random.default_rng(np.random.SeedSequence(seed))
+            self._sobol = (key, qmc.Sobol(dimensions, scramble=True, seed=rng))
+        engine = self._sobol[1]
+        if position > engine.num_generated:
+            engine.fast_forward(position - engine.num_generated)
+        return engine
+
+    @staticmethod
+    def iteration_generator(seed, iteration):
+        return np.random.Generator(np.random.PCG64(np.random.SeedSequence(seed, spawn_key=(iteration,))))
@@ -0,0 +1,217 @@
+import numpy as np
+
+
+class QuantileSketch:
+    # Mergeable quantile sketch over one or more columns (e.g. one per year). Values are counted in
+    # log-spaced buckets, so any quantile comes back within relative_accuracy of the true value.
+    # Values below 1 (ran out of money) share a zero bucket. Memory is O(columns * buckets) no
+    # matter how many values are added, and two sketches with the same settings merge by adding counts.
+    def __init__(self, num_columns, relative_accuracy=0.01, max_value=1e13):
+        self.num_columns = num_columns
+        self.relative_accuracy = relative_accuracy
+        self.max_value = max_value
+        self._gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = np.log(self._gamma)
+        # Bucket 0 is the zero bucket, bucket i > 0 holds (gamma^(i-2), gamma^(i-1)]
+        self.num_buckets = int(np.ceil(np.log(max_value) / self._log_gamma)) + 2
+        self.counts = np.zeros((num_columns, self.num_buckets), dtype=np.int64)
+
+    def _bucket(self, values):
+        buckets = np.zeros(values.shape, dtype=np.int64)
+        positive = values >= 1
+        logs = np.log(np.minimum(values[positive], self.max_value)) / self._log_gamma
+        buckets[positive] = np.ceil(logs).astype(np.int64) + 1
+        return buckets
+
+    def add(self, values):
+        # values is (n, num_columns)
+        values = np.asarray(values, dtype=np.float64).reshape(-1, self.num_columns)
+        flat = self._bucket(values) + np.arange(self.num_columns) * self.num_buckets
+        self.counts += np.bincount(flat.ravel(), minlength=self.counts.size).reshape(self.counts.shape)
+
+    def merge(self, other):
+        if (other.num_columns, other.num_buckets) != (self.num_columns, self.num_buckets):
+            raise RuntimeError('Cannot merge sketches with different settings')
+        self.counts += other.counts
+
+    def count(self):
+        return int(self.counts[0].sum()) if self.num_columns else 0
+
+    def bucket_values(self):
+        # Middle of each bucket (in the relative sense), which keeps the error within relative_accuracy
+        values = 2 * self._gamma ** (np.arange(self.num_buckets) - 1.0) / (self._gamma + 1)
+        values[0] = 0
+        return values
+
+    def quantiles(self, qs):
+        # Returns (len(qs), num_columns); qs are fractions in [0, 1]
+        cumulative = np.cumsum(self.counts, axis=1)
+        totals = cumulative[:, -1]
+        bucket_values = self.bucket_values()
+        result = np.zeros((len(qs), self.num_columns))
+        for i, q in enumerate(qs):
+            rank = np.maximum(1, np.ceil(q * totals))
+            result[i] = bucket_values[(cumulative >= rank[:, np.newaxis]).argmax(axis=1)]
+        result[:, totals == 0] = np.nan
+        return result
+
+    def histogram(self, edges):
+        # Re-bin the counts onto the given value edges: (num_columns, len(edges) - 1). Each bucket's
+        # count is spread evenly over its value range. Values past the last edge are left out.
+        exponents = np.arange(self.num_buckets) - 1.0
+        upper = self._gamma ** exponents
+        lower = self._gamma ** (exponents - 1)
+        upper[0], lower[0] = 1, 0
+        edges = np.asarray(edges, dtype=np.float64)
+        k = np.minimum(np.searchsorted(upper, edges, side='left'), self.num_buckets - 1)
+        fraction = np.clip((edges - lower[k]) / (upper[k] - lower[k]), 0, 1)
+        cumulative = np.cumsum(self.counts, axis=1)
+        below = np.where(k > 0, cumulative[:, k - 1], 0)
+        cdf = below + self.counts[:, k] * fraction
+        return np.diff(cdf, axis=1)
+
+
+def _sample_keys(iteration_ids):
+    # splitmix64 of the iteration number: a fixed pseudo-random priority, so the path sample
+    # is the same however the iterations are chunked or spread across workers
+    with np.errstate(over='ignore'):
+        z = np.asarray(iteration_ids, dtype=np.uint64) + np.uint64(0x9E3779B97F4A7C15)
+        z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return z ^ (z >> np.uint64(31))
+
+
+class ResultAggregator:
+    # Everything the summary and plots need, fed one iteration or one chunk of iterations at a time:
+    # success counts, the year each failed iteration ran out, the ending value distribution,
+    # per-year percentile bands and a bounded sample of whole paths. Memory is O(years).
+    def __init__(self, num_years, max_sample_paths=200, relative_accuracy=0.01):
+        self.num_years = num_years
+        self.max_sample_paths = max_sample_paths
+        self.iterations = 0
+        self.failures = 0
+        # failure_years[y] counts the iterations that first hit zero in year y
+        self.failure_years = np.zeros(num_years, dtype=np.int64)
+        self.terminal = QuantileSketch(1, relative_accuracy)
+        self.bands = QuantileSketch(num_years, relative_accuracy)
+        self.sample_ids = np.zeros(0, dtype=np.int64)
+        self.sample_paths = np.zeros((0, num_years))
+        # For the control variate estimate: how many iterations came with a control value, and the
+        # sums of control, control squared and control * success over them
+        self.control_count = 0
+        self.control_sums = np.zeros(3)
+
+    def add(self, first_iteration, values, controls=None):
+        # values is (n, years) for iterations first_iteration .. first_iteration + n - 1;
+        # controls, if given, holds their (n,) control variate values
+        values = np.asarray(values, dtype=np.float64).reshape(-1, self.num_years)
+        failed = values[:, -1] < 1
+        self.iterations += len(values)
+        self.failures += int(np.count_nonzero(failed))
+        if controls is not None:
+            controls = np.asarray(controls, dtype=np.float64)
+            self.control_count += len(controls)
+            self.control_sums += [controls.sum(), controls @ controls, controls[~failed].sum()]
+        first_zero = (values[failed] < 1).argmax(axis=1)
+        self.failure_years += np.bincount(first_zero, minlength=self.num_years)
+        self.terminal.add(values[:, -1:])
+        self.bands.add(values)
+        ids = np.arange(first_iteration, first_iteration + len(values))
+        self._keep_sample(ids, values)
+
+    def merge(self, other):
+        self.iterations += other.iterations
+        self.failures += other.failures
+        self.failure_years += other.failure_years
+        self.terminal.merge(other.terminal)
+        self.bands.merge(other.bands)
+        self.control_count += other.control_count
+        self.control_sums += other.control_sums
+        self._keep_sample(other.sample_ids, other.sample_paths)
+
+    def to_arrays(self):
+        # Everything needed to rebuild this aggregator, as a dict of arrays (e.g. for np.savez)
+        return {
+            'num_years': self.num_years,
+            'max_sample_paths': self.max_sample_paths,
+            'relative_accuracy': self.bands.relative_accuracy,
+            'iterations': self.iterations,
+            'failures': self.failures,
+            'failure_years': self.failure_years,
+            'terminal_counts': self.terminal.counts,
+            'band_counts': self.bands.counts,
+            'sample_ids': self.sample_ids,
+            'sample_paths': self.sample_paths,
+            'control_count': self.control_count,
+            'control_sums': self.control_sums,
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        aggregator = cls(int(arrays['num_years']), int(arrays['max_sample_paths']), float(arrays['relative_accuracy']))
+        aggregator.iterations = int(arrays['iterations'])
+        aggregator.failures = int(arrays['failures'])
+        aggregator.failure_years = np.array(arrays['failure_years'], dtype=np.int64)
+        aggregator.terminal.counts = np.array(arrays['terminal_counts'], dtype=np.int64)
+        aggregator.bands.counts = np.array(arrays['band_counts'], dtype=np.int64)
+        aggregator.sample_ids = np.array(arrays['sample_ids'], dtype=np.int64)
+        aggregator.sample_paths = np.array(arrays['sample_paths'], dtype=np.float64)
+        aggregator.control_count = int(arrays['control_count'])
+        aggregator.control_sums = np.array(arrays['control_sums'], dtype=np.float64)
+        return aggregator
+
+    def _keep_sample(self, ids, paths):
+        ids = np.concatenate([self.sample_ids, ids])
+        paths = np.concatenate([self.sample_paths, paths])
+        if len(ids) > self.max_sample_paths:
+            keep = np.argpartition(_sample_keys(ids), self.max_sample_paths)[:self.max_sample_paths]
+            ids, paths = ids[keep], paths[keep]
+        order = np.argsort(ids)
+        self.sample_ids, self.sample_paths = ids[order], paths[order]
+
+    def success_rate(self):
+        return 100 * (self.iterations - self.failures) / self.iterations if self.iterations else 0.0
+
+    def control_variate_estimate(self):
+        # (success fraction, standard error) with the control variate's known mean of zero
+        # regressed out, or None if controls weren't collected for every iteration
+        n = self.control_count
+        if n < 2 or n != self.iterations:
+            return None
+        sum_x, sum_xx, sum_xy = self.control_sums
+        mean_y = (n - self.failures) / n
+        mean_x = sum_x / n
+        var_x = sum_xx / n - mean_x * mean_x
+        cov_xy = sum_xy / n - mean_x * mean_y
+        var_y = mean_y * (1 - mean_y)
+        if var_x <= 0:
+            return mean_y, np.sqrt(var_y / n)
+        beta = cov_xy / var_x
+        residual_var = max(0.0, var_y - cov_xy * cov_xy / var_x)
+        return float(np.clip(mean_y - beta * mean_x, 0, 1)), float(np.sqrt(residual_var / (n - 1)))
+
+    def percentile_bands(self, percentiles):
+        # (len(percentiles), years)
+        return self.bands.quantiles([p / 100 for p in percentiles])
+
+    def terminal_percentiles(self, percentiles):
+        return self.terminal.quantiles([p / 100 for p in percentiles])[:, 0]
+
+
+def aggregate_chunks(chunks, num_years, trace_policy=None, stop_when=None):
+    # Feed (first_iteration, values, controls) chunks into a new aggregator, picking the iterations to trace
+    # on the way. stop_when(aggregator) can end the run early; chunks are only produced as they are
+    # consumed, so nothing past that point gets simulated.
+    # Returns the aggregator and the selected iteration numbers.
+    aggregator = ResultAggregator(num_years)
+    trace_ids = []
+    selected = 0
+    for first_iteration, values, controls in chunks:
+        aggregator.add(first_iteration, values, controls)
+        if trace_policy is not None and trace_policy.enabled:
+            ids = trace_policy.select(first_iteration, values, selected)
+            selected += len(ids)
+            trace_ids.append(ids)
+        if stop_when is not None and stop_when(aggregator):
+            break
+    return aggregator, np.concatenate(trace_ids) if trace_ids else np.zeros(0, dtype=np.int64)
@@ -0,0 +1,112 @@
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import zipfile
+import numpy as np
+from result_aggregator import ResultAggregator
+
+# Part of every key: bump whenever a code change alters what a scenario produces, so old entries
+# stop matching instead of being served
+ENGINE_VERSION = 1
+CACHE_DIR = os.path.join('logs', 'cache')
+# Total size of the cached results; the least recently used are evicted past this
+CACHE_SIZE_MB = 256
+SUFFIX = '.npz'
+
+
+class ResultCache:
+    # Aggregated results on disk, one compressed .npz per scenario, named by a hash of everything the
+    # results depend on: the parsed portfolio, the withdraw strategy, the options and the seed.
+    # Engine and worker count aren't part of it since every engine gives the same results.
+    def __init__(self, directory=CACHE_DIR, size_mb=CACHE_SIZE_MB):
+        self.directory = directory
+        self.budget = size_mb * 2 ** 20
+
+    @staticmethod
+    def key(template, withdraw_algo, options):
+        inputs = {
+            'engine_version': ENGINE_VERSION,
+            'accounts': list(zip(template.names, template.types)),
+            'strategy': withdraw_algo.get_strategy(),
+            'start': options.start,
+            'end': options.end,
+            'iterations': options.iterations,
+            'how_much': [options.how_much[0], float(options.how_much[1])],
+            'seed': options.seed,
+            'trace': str(options.trace),
+            'target_precision': options.target_precision,
+            'max_iterations': options.max_iterations,
+            'confidence': options.confidence,
+            'sampling': options.sampling,
+            'control_variate': options.control_variate,
+            'tax_model': options.tax_model,
+            'returns': options.returns,
+            'history': _file_digest(options.history_file) if options.history_file else None,
+            'block_size': options.block_size,
+            'lognormal': options.lognormal,
+            'correlation': np.asarray(options.correlation).tolist() if options.correlation is not None else None,
+        }
+        digest = hashlib.sha256(json.dumps(inputs, sort_keys=True).encode())
+        digest.update(template.snapshot.tobytes())
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + SUFFIX)
+
+    def load(self, key):
+        # (aggregator, trace ids) for a cached scenario, or None
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            with np.load(path) as data:
+                arrays = dict(data)
+            result = ResultAggregator.from_arrays(arrays), arrays['trace_ids']
+        except (OSError, ValueError, EOFError, KeyError, zipfile.BadZipFile) as e:
+            # Truncated, corrupt or from an older layout: a miss, and not worth keeping
+            logging.warning("Ignoring unreadable cache entry {}: {}".format(path, e))
+            with contextlib.suppress(OSError):
+                os.unlink(path)
+            return None
+        # Mark it recently used
+        os.utime(path)
+        logging.info("Using cached results from {}".format(path))
+        return result
+
+    def store(self, key, aggregator, trace_ids):
+        os.makedirs(self.directory, exist_ok=True)
+        # Write under a temporary name and rename, so a reader never sees half a file
+        path = self._path(key)
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        try:
+            with open(tmp, 'wb') as fp:
+                np.savez_compressed(fp, trace_ids=trace_ids, **aggregator.to_arrays())
+            os.replace(tmp, path)
+        except BaseException:
+            # The temp file may never have been created; don't let that hide the real error
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(tmp)
+            raise
+        self.evict()
+
+    def evict(self):
+        # Remove the least recently used entries until the cache fits its budget
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(SUFFIX) and entry.is_file():
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.budget:
+                break
+            os.unlink(path)
+            total -= size
+            logging.info("Evicted {} from the result cache".format(path))
+
+
+def _file_digest(path):
+    with open(path, 'rb') as fp:
+        return hashlib.sha256(fp.read()).hexdigest()
@@ -1,29 +1,73 @@
+import json
 import os.path
 import pprint
 import sys
+import time
 import click
-import matplotlib.figure
+from dataclasses import dataclass, replace
 import numpy as np
 import logging
-import tkinter as tk
-import tkinter.ttk as ttk
-from matplotlib.backends.backend_tkagg import (FigureCanvasTkAgg, NavigationToolbar2Tk)
-from simulator import run_simulation
-from tax_manager import TaxManager
+from simulator import RETURN_SOURCES, correlation_matrix, create_rate_generator, run_simulation
+from rate_generator import SAMPLING_MODES
+from control_variate import build_control_variate
+from batch_simulator import CHUNK_SIZE, iterate_batch_chunks, trace_batch_iterations
+from tax_manager import TAX_MODELS, TaxManager
 from account_manager import AccountManager
-from hmalgo_constant_percentage import HMAlgoConstantPercentage
-from hmalgo_constant_dollars import HMAlgoConstantDollars
 from loader_withdraw import WithdrawAlgo
-
-TAX_MANAGER = TaxManager()
-
-
+from drawdown_factory import DRAWDOWN_CODES, create_drawdown
+from trace_store import TracePolicy, TraceStore
+from result_aggregator import aggregate_chunks
+from result_cache import CACHE_DIR, CACHE_SIZE_MB, ResultCache
+from plotting import PLOT_MODES, create_figure
+from convergence import ADAPTIVE_CHUNK_SIZE, ConvergenceCheck, success_interval
+from account import HOLDINGS
+
+# tkinter and matplotlib are only imported when a window or plot is needed, so headless runs
+# don't need a display and start quickly
+SUMMARY_PERCENTILES = [5, 25, 50, 75, 95]
+# How often the GUI checks on a background run, in milliseconds, and the least time between
+# redraws of its partial plot, in seconds
+POLL_MS = 100
+PLOT_INTERVAL = 1.0
+# How much algorithms offered in the window, as (--how-much code, label)
+HOW_MUCH_CHOICES = [('c%', 'Const %'), ('c$', 'Const $'), ('gr', 'Guardrails %'), ('mf', 'Mad Fientist %'),
+                    ('bk', 'Buckets %')]
+
+
+@dataclass
 class Options:
-    def __init__(self, start, end, iterations, how_much):
-        self.start = start
-        self.end = end
-        self.iterations = iterations
-        self.how_much = how_much
+    start: int
+    end: int
+    iterations: int
+    how_much: tuple
+    engine: str = 'batch'
+    # Without a seed, pick fresh entropy once so every iteration still has its own stream
+    seed: int = None
+    workers: int = 1
+    trace: TracePolicy = None
+    trace_file: str = 'logs/trace.npz'
+    plot_mode: str = 'fan'
+    plot_file: str = None
+    # Percentage points, e.g. 0.5 to stop once the success rate is known to +/-0.5%
+    target_precision: float = None
+    max_iterations: int = 1000000
+    confidence: float = 0.95
+    sampling: str = 'random'
+    control_variate: bool = False
+    tax_model: str = 'flat'
+    returns: str = 'normal'
+    history_file: str = None
+    block_size: int = None
+    lognormal: bool = False
+    # 3x3 inflation/stocks/bonds correlation for --returns correlated, None for the default
+    correlation: np.ndarray = None
+    # Directory of the result cache, or None to always simulate
+    cache_dir: str = None
+    cache_size: int = CACHE_SIZE_MB
+
+    def __post_init__(self):
+        self.seed = self.seed if self.seed else np.random.SeedSequence().entropy
+        self.trace = self.trace if self.trace else TracePolicy()
 
     def __str__(self):
         return pprint.pformat({
@@ -31,83 +75,244 @@ class Options:
             'end': self.end,
             'iterations': self.iterations,
             'how_much': self.how_much,
+            'engine': self.engine,
+            'seed': self.seed,
+            'workers': self.workers,
+            'trace': str(self.trace),
+            'trace_file': self.trace_file,
+            'plot_mode': self.plot_mode,
+            'plot_file': self.plot_file,
+            'target_precision': self.target_precision,
+            'max_iterations': self.max_iterations,
+            'confidence': self.confidence,
+            'sampling': self.sampling,
+            'control_variate': self.control_variate,
+            'tax_model': self.tax_model,
+            'returns': self.returns,
+            'history_file': self.history_file,
+            'block_size': self.block_size,
+            'lognormal': self.lognormal,
+            'correlation': self.correlation,
+            'cache_dir': self.cache_dir,
+            'cache_size': self.cache_size,
         })
 
 
 def howmuch_algo_chooser(how_much):
     hm_type, hm_value = how_much
+    if hm_type not in DRAWDOWN_CODES:
+        raise RuntimeError('Unknown how much algorithm: {}'.format(hm_type))
+
+    return create_drawdown(DRAWDOWN_CODES[hm_type], int(hm_value) if hm_type == 'c$' else float(hm_value))
 
-    if hm_type == 'c%':
-        hm_algo = HMAlgoConstantPercentage(float(hm_value))
-    elif hm_type == 'c$':
-        hm_algo = HMAlgoConstantDollars(int(hm_value))
-    else:
-        hm_algo = None
 
-    return hm_algo
+def iterate_scalar_chunks(account_manager, howmuch_algo, withdraw_algo, the_years, iterations, seed,
+                          chunk_size=CHUNK_SIZE, rate_generator=None, control=None):
+    # Reference engine: one iteration and one year at a time, handed on in chunks
+    chunk = []
+    rates = []
+    for i in range(iterations):
+        # Start each iteration from the loaded balances
+        account_manager.reset()
+
+        values, inflations, stock_returns, bond_returns = \
+            run_simulation(i, the_years, account_manager, howmuch_algo, withdraw_algo, account_manager.tax_manager,
+                           seed, rate_generator=rate_generator)
+        chunk.append(values)
+        rates.append((inflations, stock_returns, bond_returns))
+        if len(chunk) == chunk_size or i == iterations - 1:
+            controls = control.evaluate(*np.array(rates).transpose(1, 0, 2)) if control is not None else None
+            yield i + 1 - len(chunk), np.array(chunk, dtype=np.float64), controls
+            chunk = []
+            rates = []
 
 
 def run_simulator_and_plot_results(window, balances, withdraws, options, result_label=None):
-    max_ytick = 20000000
+    aggregator = run_scenario(balances, withdraws, options)
+    return summarize_and_plot_results(window, aggregator, options, result_label)
+
+
+def run_scenario(balances, withdraws, options, on_chunk=None):
+    # Everything before the summary: load the inputs, simulate (or fetch the results from the cache)
+    # and trace. on_chunk(aggregator), if given, is called as each chunk of results comes in and
+    # may raise to abandon the run.
+    account_manager = AccountManager(TaxManager(options.tax_model))
+    account_manager.toggle_logging()
+    return run_parsed_scenario(account_manager.parse_accounts(balances), WithdrawAlgo(withdraws), options, on_chunk)
+
 
-    account_manager = AccountManager(TAX_MANAGER)
+def run_parsed_scenario(template, withdraw_algo, options, on_chunk=None):
+    # The same from an already parsed portfolio and withdraw strategy, which scenarios can share
+    tax_manager = TaxManager(options.tax_model)
+    account_manager = AccountManager(tax_manager)
     howmuch_algo = howmuch_algo_chooser(options.how_much)
-    withdraw_algo = WithdrawAlgo(withdraws)
 
     the_years = range(options.start, options.end)
 
-    # Run the simulator
-    results = []
-    first_time = True
-    for i in range(options.iterations):
-        results.append({})
-
-        # Load account data
-        if first_time:
-            account_manager.toggle_logging()
-            first_time = False
-        account_manager.load_accounts(balances)
+    # Iterations start from this parsed portfolio
+    account_manager.toggle_logging()
+    account_manager.load_template(template)
+
+    rate_generator = create_rate_generator(options.sampling, options.returns, options.history_file,
+                                           options.block_size, options.lognormal, options.correlation)
+    # A scenario that has been run before goes straight to the summary and plots
+    cache = ResultCache(options.cache_dir, options.cache_size) if options.cache_dir else None
+    key = cache.key(account_manager.template, withdraw_algo, options) if cache else None
+    cached = cache.load(key) if cache else None
+    if cached is not None:
+        aggregator, trace_ids = cached
+    else:
+        aggregator, trace_ids = run_simulations(account_manager, howmuch_algo, withdraw_algo, the_years, options,
+                                                rate_generator, on_chunk)
+        if cache:
+            cache.store(key, aggregator, trace_ids)
+
+    if options.trace.enabled:
+        trace_iterations(account_manager, howmuch_algo, withdraw_algo, trace_ids, options, rate_generator)
+    return aggregator
+
+
+def run_simulations(account_manager, howmuch_algo, withdraw_algo, the_years, options, rate_generator,
+                    on_chunk=None):
+    # Returns the aggregated results and the iterations picked for tracing
+    tax_manager = account_manager.tax_manager
+    control = None
+    if options.control_variate:
+        control = build_control_variate(the_years, account_manager, howmuch_algo, withdraw_algo, tax_manager,
+                                        rate_generator)
+
+    # With a target precision, run small chunks until the success rate has converged (or the cap is hit)
+    if options.target_precision:
+        iterations = options.max_iterations
+        chunk_size = ADAPTIVE_CHUNK_SIZE
+        stop_when = ConvergenceCheck(options.target_precision / 100, options.confidence)
+    else:
+        iterations = options.iterations
+        # Someone watching the progress wants it more often than every CHUNK_SIZE iterations
+        chunk_size = ADAPTIVE_CHUNK_SIZE if on_chunk else CHUNK_SIZE
+        stop_when = None
+    if on_chunk is not None:
+        converged = stop_when
+
+        def stop_when(aggregator):
+            on_chunk(aggregator)
+            return converged is not None and converged(aggregator)
+
+    # Run the simulator, folding each chunk of results into the aggregator as it is produced
+    if options.engine == 'scalar':
+        chunks = iterate_scalar_chunks(account_manager, howmuch_algo, withdraw_algo, the_years, iterations,
+                                       options.seed, chunk_size, rate_generator, control)
+        aggregator, trace_ids = aggregate_chunks(chunks, len(the_years), options.trace, stop_when)
+    elif options.workers > 1:
+        from parallel_runner import run_parallel_aggregation
+
+        aggregator, trace_ids = run_parallel_aggregation(iterations, the_years, account_manager.template,
+                                                         withdraw_algo, howmuch_algo, options.seed,
+                                                         options.workers, options.trace, stop_when,
+                                                         chunk_size if stop_when else None, rate_generator, control,
+                                                         tax_manager, options.engine == 'jit')
+    else:
+        chunks = iterate_batch_chunks(iterations, the_years, account_manager, howmuch_algo,
+                                      withdraw_algo, tax_manager, options.seed, chunk_size=chunk_size,
+                                      rate_generator=rate_generator, control=control, jit=options.engine == 'jit')
+        aggregator, trace_ids = aggregate_chunks(chunks, len(the_years), options.trace, stop_when)
+    return aggregator, trace_ids
 
-        results[i]['values'], results[i]['inflations'], results[i]['stocks'], results[i]['bonds'] = \
-            run_simulation(i, the_years, account_manager, howmuch_algo, withdraw_algo, TAX_MANAGER)
 
+def trace_iterations(account_manager, howmuch_algo, withdraw_algo, iteration_ids, options, rate_generator=None):
+    # Re-run only the iterations picked by the trace policy and save their year records
+    the_years = range(options.start, options.end)
+    trace = TraceStore(account_manager.template.names, HOLDINGS)
+    if options.engine == 'scalar':
+        for i in iteration_ids:
+            account_manager.reset()
+            run_simulation(int(i), the_years, account_manager, howmuch_algo, withdraw_algo, account_manager.tax_manager,
+                           options.seed, trace, rate_generator)
+    elif len(iteration_ids):
+        trace_batch_iterations(iteration_ids, the_years, account_manager, howmuch_algo, withdraw_algo,
+                               account_manager.tax_manager, options.seed, trace, rate_generator)
+    trace.save(options.trace_file)
+
+
+def summarize_and_plot_results(window, aggregator, options, result_label=None):
+    summary = summarize_results(aggregator, options, result_label)
+    # No window means headless: just the summary (and the plot file if one was asked for)
+    if window is not None:
+        plot_results(window, aggregator, options)
+    if options.plot_file:
+        save_plot(aggregator, options)
+    return summary
+
+
+def summarize_results(aggregator, options, result_label=None):
     # Print out summary of results
-    failures = 0
-    for i in range(options.iterations):
-        values = results[i]['values']
-        if values[-1] < 1:
-            failures += 1
-    overall_result = "{:2}% scenarios succeeded"\
-        .format(100 * (float(options.iterations) - failures) / options.iterations)
+    summary = build_summary(aggregator, options)
+    overall_result = "{:2}% scenarios succeeded".format(summary['success_rate'])
     logging.info(result_label)
     print(overall_result)
     if result_label:
         result_label.config(text=overall_result)
 
-    # Plot it all
-    # fig = matplotlib.figure.Figure(figsize = (8, 8), dpi = 100)
-    fig = matplotlib.figure.Figure()
+    estimate = aggregator.control_variate_estimate()
+    if estimate is not None:
+        print("Control variate estimate: {:.2f}% (standard error {:.3f}%)".format(100 * estimate[0], 100 * estimate[1]))
+    low, high = summary['confidence_interval']
+    print("{:g}% confidence interval: {:.2f}% - {:.2f}% after {:,} iterations"
+          .format(100 * options.confidence, low, high, aggregator.iterations))
 
-    # adding the subplot
-    plot1 = fig.add_subplot(111,
-                            xlabel='Years', xlim=(options.start, options.end),
-                            ylabel='Amount', ylim=(0, max_ytick),
-                            yticks=range(0, max_ytick, 1000000))
-    # plotting the graph
-    for i in range(options.iterations):
-        plot1.plot(the_years, results[i]['values'])
+    print("Ending value percentiles: " + ", ".join(
+        "{}%: ${:,.0f}".format(p, v) for p, v in summary['terminal_value_percentiles'].items()))
+    return summary
+
+
+def build_summary(aggregator, options):
+    # The results as a JSON-ready dict, without printing anything
+    estimate = aggregator.control_variate_estimate()
+    low, high = success_interval(aggregator, options.confidence)
+    terminal_percentiles = aggregator.terminal_percentiles(SUMMARY_PERCENTILES)
+    the_years = range(options.start, options.end)
+    bands = aggregator.percentile_bands(SUMMARY_PERCENTILES)
+    return {
+        'iterations': aggregator.iterations,
+        'seed': options.seed,
+        'success_rate': aggregator.success_rate(),
+        'sampling': options.sampling,
+        'returns': options.returns,
+        'tax_model': options.tax_model,
+        'control_variate_estimate': 100 * estimate[0] if estimate is not None else None,
+        'confidence': options.confidence,
+        'confidence_interval': [100 * low, 100 * high],
+        'target_precision': options.target_precision,
+        'failures': aggregator.failures,
+        'failure_years': {year: int(n) for year, n in zip(the_years, aggregator.failure_years) if n},
+        'terminal_value_percentiles': dict(zip(SUMMARY_PERCENTILES, terminal_percentiles.tolist())),
+        'percentile_bands': dict(zip(SUMMARY_PERCENTILES, bands.tolist())),
+    }
+
+
+def plot_results(window, aggregator, options):
+    from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+
+    fig = create_figure(aggregator, range(options.start, options.end), options.plot_mode)
 
     # creating the Tkinter canvas containing the Matplotlib figure
     canvas = FigureCanvasTkAgg(fig, master=window)
     canvas.draw()
-    # placing the canvas on the Tkinter window
+    # placing the canvas on the Tkinter window, in place of the last plot
+    for widget in window.grid_slaves(row=8, column=0):
+        widget.destroy()
     canvas.get_tk_widget().grid(row=8, column=0, columnspan=2)
 
 
+def save_plot(aggregator, options):
+    fig = create_figure(aggregator, range(options.start, options.end), options.plot_mode)
+    fig.savefig(options.plot_file)
+
+
 def validate_and_next_step(root, balances_label, balances, withdraws_label, withdraws,
                            start_label, start, end_label, end,
                            iterations_label, iterations, howmuchtype, howmuchval,
-                           result_label):
+                           result_label, try_button, cancel_button, options):
     elements = [
         { 'label': balances_label, 'entry': balances},
         { 'label': withdraws_label, 'entry': withdraws},
@@ -130,12 +335,56 @@ def validate_and_next_step(root, balances_label, balances, withdraws_label, with
         valid=False
 
     if valid:
+        # Everything else (engine, tax model, returns, trace...) stays as given on the command line
         howmuch = (howmuchtype.get(), float(howmuchval.get()))
-        options = Options(int(start.get()), int(end.get()), int(iterations.get()), howmuch)
-        run_simulator_and_plot_results(root, balances.get(), withdraws.get(), options, result_label)
+        options = replace(options, start=int(start.get()), end=int(end.get()), iterations=int(iterations.get()),
+                          how_much=howmuch)
+        start_background_run(root, balances.get(), withdraws.get(), options, result_label, try_button, cancel_button)
+
+
+def start_background_run(window, balances, withdraws, options, result_label, try_button, cancel_button):
+    # Simulate on a worker thread; the Tk thread polls it for progress so the window stays responsive
+    from background_run import BackgroundRun
+
+    run = BackgroundRun(run_scenario, balances, withdraws, options)
+    try_button.config(state='disabled')
+    cancel_button.config(state='normal', command=run.cancel)
+    result_label.config(text='Running...')
+    run.start()
+    window.after(POLL_MS, poll_background_run, window, run, options, result_label, try_button, cancel_button, 0)
+
+
+def poll_background_run(window, run, options, result_label, try_button, cancel_button, last_plot):
+    latest = None
+    for kind, payload in run.poll():
+        if kind == 'progress':
+            latest = payload
+            continue
+        try_button.config(state='normal')
+        cancel_button.config(state='disabled')
+        if kind == 'done':
+            summarize_and_plot_results(window, payload, options, result_label)
+        elif kind == 'cancelled':
+            result_label.config(text='Cancelled')
+        else:
+            result_label.config(text='Failed: {}'.format(payload))
+        return
+
+    if latest is not None:
+        total = options.max_iterations if options.target_precision else options.iterations
+        result_label.config(text="Running: {:.1f}% succeeded after {:,} of {:,} iterations"
+                            .format(latest.success_rate(), latest.iterations, total))
+        # Redrawing is slow, so the partial plot only catches up every so often
+        if time.monotonic() - last_plot >= PLOT_INTERVAL:
+            plot_results(window, latest, options)
+            last_plot = time.monotonic()
+    window.after(POLL_MS, poll_background_run, window, run, options, result_label, try_button, cancel_button,
+                 last_plot)
 
 
 def run_gui(root, balances, withdraws, options):
+    import tkinter as tk
+
     # create main frame
     frame = tk.Frame(root)
     frame.grid(row=0, column=0)
@@ -187,8 +436,8 @@ def run_gui(root, balances, withdraws, options):
     if options.how_much:
         howmuchtype_var.set(options.how_much[0])
         logging.debug("Setting how much type to: {}".format(howmuchtype_var.get()))
-    tk.Radiobutton(frame, text='Const %', variable=howmuchtype_var, value='c%').grid(row=9, column=0)
-    tk.Radiobutton(frame, text='Const $', variable=howmuchtype_var, value='c$').grid(row=10, column=0)
+    for i, (code, text) in enumerate(HOW_MUCH_CHOICES):
+        tk.Radiobutton(frame, text=text, variable=howmuchtype_var, value=code).grid(row=9 + i, column=0)
     howmuchval_var = tk.StringVar()
     if options.how_much:
         howmuchval_var.set(options.how_much[1])
@@ -197,8 +446,8 @@ def run_gui(root, balances, withdraws, options):
 
     # Results (below button)
     result_label = tk.Label(frame)
-    result_label.grid(row=12, column=0, columnspan=2)
-    # Button to run simulation
+    result_label.grid(row=15, column=0, columnspan=2)
+    # Buttons to run the simulation and to stop it
     btn = tk.Button(frame, text="Try It",
               command=lambda: validate_and_next_step(root,
                                                      balances_label, balances_var,
@@ -207,31 +456,133 @@ def run_gui(root, balances, withdraws, options):
                                                      end_label, end_var,
                                                      iterations_label, iterations_var,
                                                      howmuchtype_var, howmuchval_var,
-                                                     result_label))
-    btn.grid(row=11, column=0, columnspan=2)
+                                                     result_label, btn, cancel_btn, options))
+    btn.grid(row=14, column=0)
+    cancel_btn = tk.Button(frame, text="Cancel", state='disabled')
+    cancel_btn.grid(row=14, column=1)
 
     frame.columnconfigure(0, weight=3)
 
+def parse_trace(ctx, param, value):
+    try:
+        return TracePolicy.parse(value)
+    except RuntimeError as e:
+        raise click.BadParameter(str(e))
+
+
 @click.command()
 @click.argument('balances', type=click.Path(exists=True))
 @click.argument('withdraws', type=click.Path(exists=True))
 @click.option('--start', type=click.INT, default=48, help='Age at the start of the simulation')
 @click.option('--end', type=click.INT, default=90, help='Age at the end of the simulation')
 @click.option('--iterations', type=click.INT, default=100, help='How many iterations to run')
-@click.option('--how-much', '-hm', nargs=2, default=('c%',4.0))
+@click.option('--how-much', '-hm', type=(click.Choice(list(DRAWDOWN_CODES)), float), default=('c%', 4.0),
+              help='Drawdown strategy and its percentage (dollars for c$): constant percentage, constant dollars, '
+                   'guardrails, Mad Fientist (percentage of the current value) or buckets')
+@click.option('--target-precision', type=click.FloatRange(min=0, min_open=True), default=None,
+              help='Instead of --iterations, run until the success rate is known to +/- this many percent')
+@click.option('--max-iterations', type=click.IntRange(1), default=1000000,
+              help='Cap on iterations with --target-precision')
+@click.option('--confidence', type=click.FloatRange(0, 1, min_open=True, max_open=True), default=0.95,
+              help='Confidence level of the reported success rate interval')
+@click.option('--sampling', type=click.Choice(SAMPLING_MODES), default='random',
+              help='How return draws are sampled: plain random, antithetic pairs or scrambled Sobol (needs scipy)')
+@click.option('--control-variate/--no-control-variate', default=False,
+              help='Sharpen the success rate estimate with a control variate from the deterministic run')
+@click.option('--returns', type=click.Choice(RETURN_SOURCES), default='normal',
+              help='Normal draws, consecutive historical years, or a block bootstrap of the history')
+@click.option('--history-file', type=click.Path(exists=True), default=None,
+              help='CSV of annual returns with year, stocks, bonds and inflation columns')
+@click.option('--block-size', type=click.FloatRange(min=1), default=None,
+              help='Average run of consecutive years in the block bootstrap (default 5)')
+@click.option('--lognormal/--no-lognormal', default=False,
+              help='Draw log-normal returns (same mean and deviation, never below -100%)')
+@click.option('--correlation', type=click.FLOAT, nargs=3, default=None,
+              help='Inflation-stocks, inflation-bonds and stocks-bonds correlations for --returns correlated')
+@click.option('--tax-model', type=click.Choice(TAX_MODELS), default='flat',
+              help='Flat per-account rates, or progressive brackets on each year\'s income')
 @click.option('--gui/--no-gui', default=False, help='Launch gui')
+@click.option('--headless', is_flag=True, default=False,
+              help='Print the summary and exit without opening a window (no display needed)')
+@click.option('--summary-file', type=click.Path(), default=None, help='Also write the summary as JSON here')
+@click.option('--plot', 'plot_mode', type=click.Choice(PLOT_MODES), default='fan',
+              help='Percentile fan chart, value-by-year heatmap, or a sample of individual paths')
+@click.option('--plot-file', type=click.Path(), default=None, help='Also save the plot to this image file')
+@click.option('--engine', type=click.Choice(['batch', 'scalar', 'jit']), default='batch',
+              help='Run all iterations at once as arrays, one at a time (reference), or through the year loop '
+                   'compiled with Numba if it is installed (batch otherwise)')
+@click.option('--workers', type=click.IntRange(1), default=1,
+              help='Split the iterations across this many processes (batch and jit engines)')
+@click.option('--trace', default='off', callback=parse_trace,
+              help='Iterations to keep year records for: off, first:N, every:K, failed[:N] or list:A,B,...')
+@click.option('--trace-file', type=click.Path(), default='logs/trace.npz', help='Where to save the trace records')
+@click.option('--cache/--no-cache', default=False,
+              help='Reuse the results of an identical earlier run (same inputs, options and seed)')
+@click.option('--cache-dir', type=click.Path(file_okay=False), default=CACHE_DIR, help='Where --cache keeps results')
+@click.option('--cache-size', type=click.IntRange(1), default=CACHE_SIZE_MB,
+              help='Megabytes of results to keep before evicting the least recently used')
+@click.option('--profile', is_flag=True, default=False,
+              help='Print where the time went, phase by phase (work in --workers processes is not seen)')
+@click.option('--profile-memory', is_flag=True, default=False,
+              help='With --profile, also report peak traced memory per phase (slower)')
 @click.option('--debug', '-d', type=click.IntRange(0, 2, clamp=True), default=0)
 @click.option('-s', '--seed', default=0, help='Random number seed')
-def cli(balances, withdraws, start, end, iterations, how_much, gui, debug, seed):
+def cli(balances, withdraws, start, end, iterations, how_much, target_precision, max_iterations, confidence,
+        sampling, control_variate, returns, history_file, block_size, lognormal, correlation, tax_model, gui,
+        headless, summary_file, plot_mode, plot_file, engine, workers, trace, trace_file, cache, cache_dir,
+        cache_size, profile, profile_memory, debug, seed):
+    if gui and headless:
+        raise click.UsageError('--gui and --headless cannot be used together')
+    if returns in ('historical', 'bootstrap') and not history_file:
+        raise click.UsageError('--returns {} needs --history-file'.format(returns))
+    if returns in ('historical', 'bootstrap') and sampling != 'random':
+        raise click.UsageError('--sampling only applies to normal returns')
+    if returns in ('historical', 'bootstrap') and lognormal:
+        raise click.UsageError('--lognormal only applies to normal returns')
+    if correlation and returns != 'correlated':
+        raise click.UsageError('--correlation needs --returns correlated')
+    if profile_memory and not profile:
+        raise click.UsageError('--profile-memory needs --profile')
+
     level = {0: logging.WARNING, 1: logging.INFO, 2: logging.DEBUG}[debug]
+    os.makedirs('logs', exist_ok=True)
     logging.basicConfig(filename='logs/debug.log', filemode='w',
                         format='%(levelname)s %(filename)s %(message)s',
                         level=level,
                         datefmt='%H:%M:%S')
     logging.info("Loading account data from: {}".format(balances))
 
-    if seed:
-        np.random.seed(int(seed))
+    options = Options(start, end, iterations, how_much, engine, int(seed), workers,
+                      trace, trace_file, plot_mode, plot_file,
+                      target_precision, max_iterations, confidence, sampling, control_variate,
+                      tax_model, returns, history_file, block_size, lognormal,
+                      correlation_matrix(*correlation) if correlation else None,
+                      cache_dir if cache else None, cache_size)
+    logging.debug("Created options: \n{}".format(str(options)))
+
+    profiler = None
+    if profile:
+        # Only imported (and only instrumenting anything) when asked for
+        from profiler import PhaseProfiler
+
+        profiler = PhaseProfiler(profile_memory, sys.modules[__name__]).start()
+    try:
+        run_and_show(balances, withdraws, options, gui, headless, summary_file)
+    finally:
+        if profiler is not None:
+            profiler.stop()
+            print(profiler.report())
+
+
+def run_and_show(balances, withdraws, options, gui, headless, summary_file):
+    if headless:
+        summary = run_simulator_and_plot_results(None, balances, withdraws, options)
+        if summary_file:
+            with open(summary_file, 'w') as fp:
+                json.dump(summary, fp, indent=2)
+        return
+
+    import tkinter as tk
 
     # the main Tkinter window
     window = tk.Tk()
@@ -240,13 +591,17 @@ def cli(balances, withdraws, start, end, iterations, how_much, gui, debug, seed)
     # dimensions of the main window
     window.geometry("800x800")
 
-    options = Options(start, end, iterations, how_much)
-    logging.debug("Created options: \n{}".format(str(options)))
-
     if gui:
         run_gui(window, balances, withdraws, options)
     else:
-        run_simulator_and_plot_results(window, balances, withdraws, options)
+        summary = run_simulator_and_plot_results(window, balances, withdraws, options)
+        if summary_file:
+            with open(summary_file, 'w') as fp:
+                json.dump(summary, fp, indent=2)
 
     # run the gui
     window.mainloop()
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,184 @@
+import functools
+import json
+import logging
+import os
+import time
+import click
+import numpy as np
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from account_manager import AccountManager
+from loader_withdraw import WithdrawAlgo
+from result_cache import CACHE_DIR, CACHE_SIZE_MB
+from retire import Options, build_summary, cli, run_parsed_scenario
+from simulator import correlation_matrix
+from tax_manager import TaxManager
+
+# Fields a scenario line may set besides balances, withdraws and id; missing ones take retire's
+# command line defaults
+SCENARIO_FIELDS = ['start', 'end', 'iterations', 'how_much', 'seed', 'engine', 'target_precision', 'max_iterations',
+                   'confidence', 'sampling', 'control_variate', 'tax_model', 'returns', 'history_file', 'block_size',
+                   'lognormal', 'correlation']
+DEFAULTS = {param.name: param.default for param in cli.params if param.name in SCENARIO_FIELDS}
+# The values retire accepts for its choice options (engine, sampling, tax model, returns)
+CHOICES = {param.name: list(param.type.choices) for param in cli.params
+           if param.name in SCENARIO_FIELDS and isinstance(param.type, click.Choice)}
+# Parsed balances and withdraw files each worker keeps for scenarios that share them
+FILE_CACHE_SIZE = 64
+# Scenarios handed to the pool ahead of time per worker; input is read only as fast as it drains,
+# so a long stream on stdin isn't held in memory
+QUEUE_DEPTH = 2
+LATENCY_PERCENTILES = [50, 95, 99]
+
+
+def _file_version(path):
+    # Cached parses are keyed on this too, so an edited file is read again
+    stat = os.stat(path)
+    return os.path.abspath(path), stat.st_mtime_ns, stat.st_size
+
+
+@functools.lru_cache(maxsize=FILE_CACHE_SIZE)
+def _parse_portfolio(version):
+    account_manager = AccountManager(TaxManager())
+    account_manager.toggle_logging()
+    return account_manager.parse_accounts(version[0])
+
+
+@functools.lru_cache(maxsize=FILE_CACHE_SIZE)
+def _parse_strategy(version):
+    return WithdrawAlgo(version[0])
+
+
+def _cache_hits():
+    return _parse_portfolio.cache_info().hits + _parse_strategy.cache_info().hits
+
+
+def scenario_options(scenario, cache_dir=None, cache_size=CACHE_SIZE_MB):
+    missing = {'balances', 'withdraws'} - set(scenario)
+    if missing:
+        raise RuntimeError('Missing scenario fields: {}'.format(', '.join(sorted(missing))))
+    unknown = set(scenario) - set(SCENARIO_FIELDS) - {'id', 'balances', 'withdraws'}
+    if unknown:
+        raise RuntimeError('Unknown scenario fields: {}'.format(', '.join(sorted(unknown))))
+    fields = dict(DEFAULTS, **{k: v for k, v in scenario.items() if k in SCENARIO_FIELDS})
+    for name, choices in CHOICES.items():
+        if fields[name] not in choices:
+            raise RuntimeError('Invalid scenario {}: {} (expected one of {})'.format(
+                name, fields[name], ', '.join(choices)))
+    if fields['end'] <= fields['start']:
+        raise RuntimeError('Scenario end ({}) must be after start ({})'.format(fields['end'], fields['start']))
+    hm_type, hm_value = fields['how_much']
+    correlation = fields['correlation']
+    return Options(fields['start'], fields['end'], fields['iterations'], (hm_type, float(hm_value)),
+                   fields['engine'], int(fields['seed']), target_precision=fields['target_precision'],
+                   max_iterations=fields['max_iterations'], confidence=fields['confidence'],
+                   sampling=fields['sampling'], control_variate=fields['control_variate'],
+                   tax_model=fields['tax_model'], returns=fields['returns'], history_file=fields['history_file'],
+                   block_size=fields['block_size'], lognormal=fields['lognormal'],
+                   correlation=correlation_matrix(*correlation) if correlation else None,
+                   cache_dir=cache_dir, cache_size=cache_size)
+
+
+def evaluate(scenario, cache_dir=None, cache_size=CACHE_SIZE_MB):
+    # One scenario dict to its result line: the summary retire --summary-file writes, plus how long
+    # the run took here and whether both input files were already parsed (warm). Errors are reported in the
+    # result rather than raised, so one bad scenario doesn't end the batch.
+    started = time.perf_counter()
+    result = {'id': scenario.get('id'), 'worker': os.getpid()}
+    try:
+        options = scenario_options(scenario, cache_dir, cache_size)
+        hits = _cache_hits()
+        template = _parse_portfolio(_file_version(scenario['balances']))
+        withdraw_algo = _parse_strategy(_file_version(scenario['withdraws']))
+        result['warm'] = _cache_hits() - hits == 2
+        result.update(build_summary(run_parsed_scenario(template, withdraw_algo, options), options))
+    except Exception as e:
+        logging.exception("Scenario {} failed".format(result['id']))
+        result['error'] = '{}: {}'.format(type(e).__name__, e)
+    result['seconds'] = time.perf_counter() - started
+    return result
+
+
+def read_scenarios(lines):
+    # (scenario, error) per non-blank line; the id defaults to the line number
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            scenario = json.loads(line)
+            if not isinstance(scenario, dict):
+                raise ValueError('expected a JSON object')
+        except ValueError as e:
+            yield {'id': number}, 'Invalid scenario on line {}: {}'.format(number, e)
+            continue
+        scenario.setdefault('id', number)
+        yield scenario, None
+
+
+def run_service(lines, out, workers, cache_dir=None, cache_size=CACHE_SIZE_MB):
+    # Streams one JSON result line per scenario to out as each finishes (so not in input order) and
+    # returns the latencies: the time from a scenario being read to its result being written
+    latencies = []
+
+    def emit(result, read_at):
+        result['latency'] = time.perf_counter() - read_at
+        latencies.append(result['latency'])
+        out.write(json.dumps(result) + '\n')
+        out.flush()
+
+    if workers == 1:
+        for scenario, error in read_scenarios(lines):
+            read_at = time.perf_counter()
+            emit({'id': scenario['id'], 'error': error} if error else evaluate(scenario, cache_dir, cache_size),
+                 read_at)
+        return latencies
+
+    # The workers stay up for the whole batch, keeping their imports and parsed files warm
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = {}
+        for scenario, error in read_scenarios(lines):
+            read_at = time.perf_counter()
+            if error:
+                emit({'id': scenario['id'], 'error': error}, read_at)
+                continue
+            pending[pool.submit(evaluate, scenario, cache_dir, cache_size)] = read_at
+            while len(pending) >= workers * QUEUE_DEPTH:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    emit(future.result(), pending.pop(future))
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                emit(future.result(), pending.pop(future))
+    return latencies
+
+
+@click.command()
+@click.argument('scenarios', type=click.File('r'), default='-')
+@click.option('--output', '-o', type=click.File('w'), default='-', help='Where to write the result lines')
+@click.option('--workers', type=click.IntRange(1), default=os.cpu_count() or 1,
+              help='Scenarios evaluated at once, each in its own process')
+@click.option('--cache/--no-cache', default=False,
+              help='Reuse the results of identical earlier scenarios (same inputs, options and seed)')
+@click.option('--cache-dir', type=click.Path(file_okay=False), default=CACHE_DIR, help='Where --cache keeps results')
+@click.option('--cache-size', type=click.IntRange(1), default=CACHE_SIZE_MB,
+              help='Megabytes of results to keep before evicting the least recently used')
+def service(scenarios, output, workers, cache, cache_dir, cache_size):
+    # Reads scenarios from a JSON Lines file (or stdin), one object per line, e.g.
+    #   {"id": "smith", "balances": "b.tsv", "withdraws": "w.json", "how_much": ["c%", 4], "seed": 1}
+    # and writes a result line for each as it finishes
+    os.makedirs('logs', exist_ok=True)
+    logging.basicConfig(filename='logs/scenarios.log', filemode='w', format='%(levelname)s %(filename)s %(message)s',
+                        level=logging.WARNING)
+
+    started = time.perf_counter()
+    latencies = run_service(scenarios, output, workers, cache_dir if cache else None, cache_size)
+    elapsed = time.perf_counter() - started
+    if latencies:
+        percentiles = np.percentile(latencies, LATENCY_PERCENTILES)
+        click.echo('{} scenarios in {:.2f}s ({:.1f}/s), latency {}'.format(
+            len(latencies), elapsed, len(latencies) / elapsed,
+            ', '.join('p{}: {:.3f}s'.format(p, v) for p, v in zip(LATENCY_PERCENTILES, percentiles))), err=True)
+
+
+if __name__ == '__main__':
+    service()
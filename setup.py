@@ -9,6 +9,10 @@ setup(
         'numpy',
         'matplotlib'
     ],
+    extras_require={
+        # --sampling sobol
+        'sobol': ['scipy'],
+    },
     entry_points={
         'console_scripts': [
             'retire = retire:cli',
@@ -1,6 +1,4 @@
-import json
 import logging
-import csv
 from rate_generator import RateGenerator
 
 # SPY_MEAN = 0.1151
@@ -11,89 +9,113 @@ BND_MEAN = .0451  # 4.51% from https://www.lazyportfolioetf.com/etf/vanguard-tot
 BND_STDDEV = .0433
 INFLATION_MEAN = 0.03  # 3.0% from https://www.bogleheads.org/forum/viewtopic.php?t=147583
 INFLATION_STDDEV = 0.013  # From above
+# Correlation of annual inflation, stock and bond returns for the correlated model. Rough assumptions
+# (bonds and stocks loosely tied, inflation hurting both, bonds more); adjust with --correlation.
+INFLATION_STOCK_CORRELATION = -0.1
+INFLATION_BOND_CORRELATION = -0.3
+STOCK_BOND_CORRELATION = 0.1
 
 
-def run_simulation(iteration, years, account_manager, how_much_alg, withdraw_alg, tax_manager):
-    prev_withdraw_rate = 0
+# normal:     independent draws from the constants above, with a fixed 2% inflation
+# correlated: joint draws of inflation, stocks and bonds, with inflation from INFLATION_MEAN/STDDEV
+# historical, bootstrap: one of historical_returns' modes over a CSV of annual returns
+RETURN_SOURCES = ['normal', 'correlated', 'historical', 'bootstrap']
+
+
+def correlation_matrix(inflation_stock=INFLATION_STOCK_CORRELATION, inflation_bond=INFLATION_BOND_CORRELATION,
+                       stock_bond=STOCK_BOND_CORRELATION):
+    return [[1.0, inflation_stock, inflation_bond],
+            [inflation_stock, 1.0, stock_bond],
+            [inflation_bond, stock_bond, 1.0]]
+
+
+def create_rate_generator(sampling='random', returns='normal', history_file=None, block_size=None,
+                          lognormal=False, correlation=None):
+    if returns == 'normal':
+        return RateGenerator(SPY_MEAN, SPY_STDDEV, BND_MEAN, BND_STDDEV, 0.02, None, sampling, lognormal=lognormal)
+    if returns == 'correlated':
+        return RateGenerator(SPY_MEAN, SPY_STDDEV, BND_MEAN, BND_STDDEV, INFLATION_MEAN, INFLATION_STDDEV, sampling,
+                             correlation if correlation is not None else correlation_matrix(), lognormal)
+
+    from historical_returns import BLOCK_SIZE, HistoricalRateGenerator
+
+    if not history_file:
+        raise RuntimeError('Historical returns need a history file')
+    return HistoricalRateGenerator(history_file, returns, block_size or BLOCK_SIZE)
+
+
+def run_simulation(iteration, years, account_manager, how_much_alg, withdraw_alg, tax_manager, seed, trace=None,
+                   rate_generator=None):
+    prev_withdrawal = 0
+    prev_inflation = 0
     values_list = []
-    inflation_list = []
-    stock_return_list = []
-    bond_return_list = []
-    log_events = []
     logged = False
-    csv_events = [['Year', 'Total Value', 'Withdraw Request', 'Withdraw Actual', 'Percentage',
-                  'Tax Paid', 'Inflation', 'Stock Return', 'Bond Return']]
-
-    # Create the rate generator with the right params
-    rg = RateGenerator(SPY_MEAN, SPY_STDDEV, BND_MEAN, BND_STDDEV, 0.02, None)
-
-    # Log first year values
-    log_events.append({
-        'Year': 'Start',
-        'Total Value': account_manager.get_total_value(),
-        'Account Values': account_manager.get_accounts_values(),
-    })
-    csv_events.append(['Start', account_manager.get_total_value(), 0, 0, 0, 0, 0, 0, 0])
-
-    logging.info("=================== Iterations {} ====================".format(iteration))
-    for year in years:
-        inflation = rg.generate_inflation()
-        inflation_list.append(inflation)
-        stock_return = rg.generate_stock_return()
-        stock_return_list.append(stock_return)
-        bond_return = rg.generate_bond_return()
-        bond_return_list.append(bond_return)
+    # Per-year messages are only formatted when someone is listening
+    log_years = logging.getLogger().isEnabledFor(logging.INFO)
+    if trace is not None:
+        columns = {name: [] for name in ['withdraw_request', 'withdraw_actual', 'tax_paid']}
+        account_balances = []
+
+    # Generate this iteration's rates up front from its own random stream
+    rg = rate_generator if rate_generator is not None else create_rate_generator()
+    inflation_list, stock_return_list, bond_return_list = \
+        [r[0].tolist() for r in rg.generate_matrices(1, len(years), seed, iteration)]
+
+    if log_years:
+        logging.info("=================== Iterations {} ====================".format(iteration))
+    for y, year in enumerate(years):
+        inflation = inflation_list[y]
+        stock_return = stock_return_list[y]
+        bond_return = bond_return_list[y]
 
         total_value = account_manager.get_total_value()
-        logging.info("Year {}: Total ${:,.2f}. inflation {:.2}% stocks {:.2}% bonds {:.2}%"
-                     .format(year, total_value, 100*inflation, 100*stock_return, 100*bond_return))
+        if log_years:
+            logging.info("Year {}: Total ${:,.2f}. inflation {:.2}% stocks {:.2}% bonds {:.2}%"
+                         .format(year, total_value, 100*inflation, 100*stock_return, 100*bond_return))
 
         values_list.append(total_value)
         num = 5
         if total_value == 0 and not logged:
             logging.warning("!!! Iteration {} hit zero on year {}".format(iteration, year))
-            logging.warning("!!! * First {} inflation: {}".format(num, ", ".join([str(x) for x in inflation_list[:num]])))
-            logging.warning("!!! * First {} stock returns: {}".format(num, ", ".join([str(x) for x in stock_return_list[:num]])))
-            logging.warning("!!! * First {} bond returns: {}".format(num, ", ".join([str(x) for x in bond_return_list[:num]])))
+            first = min(num, y + 1)
+            logging.warning("!!! * First {} inflation: {}"
+                            .format(num, ", ".join([str(x) for x in inflation_list[:first]])))
+            logging.warning("!!! * First {} stock returns: {}"
+                            .format(num, ", ".join([str(x) for x in stock_return_list[:first]])))
+            logging.warning("!!! * First {} bond returns: {}"
+                            .format(num, ", ".join([str(x) for x in bond_return_list[:first]])))
             logged = True
 
-        requested_dollars = how_much_alg.get_how_much_to_withdraw(prev_withdraw_rate, account_manager)
+        if y == 0:
+            how_much_state = how_much_alg.start_one(total_value)
+        requested_dollars = how_much_alg.withdraw_one(how_much_state, total_value, prev_withdrawal, prev_inflation)
+        prev_withdrawal = requested_dollars
+        prev_inflation = inflation
 
+        # Bracket taxes only count this year's withdrawals
+        tax_manager.start_year()
         withdrawal, tax_paid = withdraw_alg.withdraw(account_manager, requested_dollars)
-        total_pre = withdrawal + tax_paid
-        logging.info("         Withdrew ${:,.2f} + taxes ${:,.2f} = ${:,.2f}. Delta ${:,.2f}."
-                     .format(withdrawal, tax_paid, total_pre, withdrawal - requested_dollars))
-
-        percentage_of_portfolio = round(withdrawal / total_value, 4) if total_value else 0
-
-        log_events.append({
-            'Year': year,
-            'Total Value': '${:,.2f}'.format(total_value),
-            'Withdraw Request': '${:,.2f}'.format(requested_dollars),
-            'Withdraw Actual': '${:,.2f}'.format(withdrawal),
-            'Percentage': '{:2}%'.format(round(percentage_of_portfolio * 100, 2)),
-            'Tax Paid': '${:,.2f}'.format(tax_paid),
-            'Inflation': '{:2}%'.format(round(inflation * 100, 2)),
-            'Stock Return': '{:2}%'.format(round(stock_return * 100, 2)),
-            'Bond Return': '{:2}%'.format(round(bond_return * 100, 2)),
-            'Account Values': account_manager.get_accounts_values()
-        })
-        csv_events.append([year, total_value, requested_dollars, withdrawal, round(percentage_of_portfolio, 2),
-                           tax_paid, round(inflation, 2), round(stock_return, 2), round(bond_return, 2)])
+        if log_years:
+            logging.info("         Withdrew ${:,.2f} + taxes ${:,.2f} = ${:,.2f}. Delta ${:,.2f}."
+                         .format(withdrawal, tax_paid, withdrawal + tax_paid, withdrawal - requested_dollars))
+
+        if trace is not None:
+            columns['withdraw_request'].append(requested_dollars)
+            columns['withdraw_actual'].append(withdrawal)
+            columns['tax_paid'].append(tax_paid)
+            account_balances.append(account_manager.get_balances().copy())
 
         account_manager.apply_stock_return(stock_return)
         account_manager.apply_bond_return(bond_return)
         account_manager.apply_inflation(inflation)
 
-        logging.info("------------------------------------------------------------")
+        if log_years:
+            logging.info("------------------------------------------------------------")
 
-    # Save log file
-    with open('logs/events-{}.json'.format(iteration), 'w') as fp:
-        json.dump(log_events, fp, indent=2)
-    with open('logs/events-{}.csv'.format(iteration), 'w', newline='') as fp:
-        c = csv.writer(fp, dialect='excel')
-        for evt in csv_events:
-            c.writerow(evt)
+    if trace is not None:
+        columns.update({'total_value': values_list, 'inflation': inflation_list,
+                        'stock_return': stock_return_list, 'bond_return': bond_return_list})
+        trace.record([iteration], years, columns, [account_balances])
 
     # Return the values
     return values_list, inflation_list, stock_return_list, bond_return_list
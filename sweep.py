@@ -0,0 +1,253 @@
+import functools
+import itertools
+import json
+import logging
+import os
+import click
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from account_manager import AccountManager
+from batch_simulator import _simulate
+from loader_withdraw import WithdrawAlgo
+from rate_generator import SAMPLING_MODES
+from retire import howmuch_algo_chooser
+from simulator import create_rate_generator
+from tax_manager import TAX_MODELS, TaxManager
+
+# Market constants from simulator.py that can be swept, and the (series, mean or stddev) they set
+SWEEP_PARAMETERS = {
+    'SPY_MEAN': ('stocks', 0),
+    'SPY_STDDEV': ('stocks', 1),
+    'BND_MEAN': ('bonds', 0),
+    'BND_STDDEV': ('bonds', 1),
+    'INFLATION_MEAN': ('inflation', 0),
+    'INFLATION_STDDEV': ('inflation', 1),
+}
+# Rate matrices kept per worker; each is 3 * iterations * years floats
+RATE_CACHE_SIZE = 4
+
+# Per-worker state, built once by _init_worker
+_WORKER = {}
+
+
+class Sweep:
+    # A grid of start ages, end ages, how-much rules and market parameter settings. Every cell uses
+    # the same standard normal draws for iteration i (common random numbers), so differences
+    # between cells come from the parameters rather than from the luck of the draw.
+    def __init__(self, starts, ends, how_muchs, markets):
+        self.starts = starts
+        self.ends = ends
+        self.how_muchs = how_muchs
+        # Each market is a tuple of (name, value) overrides
+        self.markets = markets
+
+    def horizons(self):
+        return sorted({end - start for start, end in itertools.product(self.starts, self.ends) if end > start})
+
+    def groups(self):
+        # A simulation over the longest horizon answers every shorter one too, since the first n
+        # years of a path don't depend on how many follow. So there is one run per (how much, market).
+        # Market-major, so consecutive cells share rate matrices
+        return [(how_much, market) for market in self.markets for how_much in self.how_muchs]
+
+    def varying_axes(self):
+        axes = [('start', self.starts), ('end', self.ends), ('how_much', self.how_muchs)]
+        for i, name in enumerate(_market_names(self.markets)):
+            axes.append((name, sorted({market[i][1] for market in self.markets})))
+        return [(name, values) for name, values in axes if len(values) > 1]
+
+
+def _market_names(markets):
+    return [name for name, _ in markets[0]] if markets else []
+
+
+def parse_int_list(ctx, param, value):
+    try:
+        return sorted({int(v) for v in value.split(',')})
+    except ValueError:
+        raise click.BadParameter('expected comma separated integers, e.g. 50,55,60')
+
+
+def parse_markets(ctx, param, value):
+    # NAME=v1,v2 options, expanded into every combination of the values
+    names, values = [], []
+    for spec in value:
+        name, _, numbers = spec.partition('=')
+        if name not in SWEEP_PARAMETERS:
+            raise click.BadParameter('unknown parameter {}, expected one of {}'
+                                     .format(name, ', '.join(SWEEP_PARAMETERS)))
+        try:
+            values.append([float(v) for v in numbers.split(',')])
+        except ValueError:
+            raise click.BadParameter('expected NAME=v1,v2,... for {}'.format(name))
+        names.append(name)
+    return [tuple(zip(names, combo)) for combo in itertools.product(*values)]
+
+
+def market_rate_generator(market, sampling='random', returns='normal', lognormal=False):
+    rg = create_rate_generator(sampling, returns, lognormal=lognormal)
+    for name, value in market:
+        series, field = SWEEP_PARAMETERS[name]
+        params = list(getattr(rg, series))
+        params[field] = value
+        setattr(rg, series, tuple(params))
+    return rg
+
+
+def _init_worker(template, withdraw_algo, tax_manager, model, shm_name, shape):
+    # model is the (sampling, returns, lognormal) arguments of market_rate_generator
+    account_manager = AccountManager(tax_manager)
+    account_manager.load_template(template)
+    _WORKER.update({
+        'account_manager': account_manager,
+        'withdraw_algo': withdraw_algo,
+        'tax_manager': tax_manager,
+        'model': model,
+    })
+    if shm_name is not None:
+        # Pool workers share the parent's resource tracker, so attaching doesn't take ownership
+        _WORKER['shm'] = shared_memory.SharedMemory(name=shm_name)
+        _WORKER['draws'] = np.ndarray(shape, dtype=np.float64, buffer=_WORKER['shm'].buf)
+    _market_rates.cache_clear()
+
+
+@functools.lru_cache(maxsize=RATE_CACHE_SIZE)
+def _market_rates(market):
+    # Cells with the same market settings share their rate matrices
+    return market_rate_generator(market, *_WORKER['model']).rates_from_normals(_WORKER['draws'])
+
+
+def _run_group(how_much, market):
+    # Successes by horizon: counts[n - 1] is how many iterations still had money at the start of year n
+    rates = _market_rates(market)
+    num_years = rates[0].shape[1]
+    values = _simulate(range(num_years), _WORKER['account_manager'], howmuch_algo_chooser(how_much),
+                       _WORKER['withdraw_algo'], _WORKER['tax_manager'], rates)[0]
+    return np.count_nonzero(values >= 1, axis=0)
+
+
+def run_sweep(sweep, template, withdraw_algo, tax_manager, iterations, seed, sampling='random', workers=1,
+              returns='normal', lognormal=False):
+    # Returns {(start, end, how_much, market): success rate in percent}
+    horizons = sweep.horizons()
+    if not horizons:
+        raise RuntimeError('Every end age is before its start age')
+    num_years = horizons[-1]
+    groups = sweep.groups()
+    logging.info("Sweeping {} groups over {} iterations and up to {} years on {} workers"
+                 .format(len(groups), iterations, num_years, workers))
+
+    # Draw once for the longest horizon; shorter horizons use the leading years of the same draws
+    draws = create_rate_generator(sampling).standard_normals(range(iterations), num_years, seed)
+    model = (sampling, returns, lognormal)
+    if workers > 1:
+        shm = shared_memory.SharedMemory(create=True, size=draws.nbytes)
+        try:
+            np.ndarray(draws.shape, dtype=np.float64, buffer=shm.buf)[:] = draws
+            del draws
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                     initargs=(template, withdraw_algo, tax_manager, model, shm.name,
+                                               (iterations, num_years, 3))) as pool:
+                futures = [pool.submit(_run_group, how_much, market) for how_much, market in groups]
+                counts = [future.result() for future in futures]
+        finally:
+            shm.close()
+            shm.unlink()
+    else:
+        _init_worker(template, withdraw_algo, tax_manager, model, None, None)
+        _WORKER['draws'] = draws
+        counts = [_run_group(how_much, market) for how_much, market in groups]
+        _WORKER.clear()
+        _market_rates.cache_clear()
+
+    results = {}
+    for (how_much, market), successes in zip(groups, counts):
+        for start, end in itertools.product(sweep.starts, sweep.ends):
+            if end > start:
+                results[(start, end, how_much, market)] = 100 * successes[end - start - 1] / iterations
+    return results
+
+
+def print_results(sweep, results):
+    names = _market_names(sweep.markets)
+    header = ['start', 'end', 'how_much'] + names + ['success']
+    print('\t'.join(header))
+    for (start, end, how_much, market), rate in results.items():
+        row = [str(start), str(end), _label(how_much)] + ['{:g}'.format(v) for _, v in market]
+        print('\t'.join(row + ['{:.2f}%'.format(rate)]))
+
+
+def save_heatmap(sweep, results, plot_file):
+    from plotting import create_sweep_figure
+
+    axes = sweep.varying_axes()
+    if len(axes) != 2:
+        raise RuntimeError('A heatmap needs exactly two swept parameters, not {}'.format(len(axes)))
+    (row_name, rows), (column_name, columns) = axes
+    grid = np.full((len(rows), len(columns)), np.nan)
+    for key, rate in results.items():
+        cell = _cell_values(sweep, key)
+        grid[rows.index(cell[row_name]), columns.index(cell[column_name])] = rate
+    fig = create_sweep_figure([_label(r) for r in rows], [_label(c) for c in columns], grid, row_name, column_name)
+    fig.savefig(plot_file)
+
+
+def _label(value):
+    # How-much rules are (type, value) tuples
+    return ' '.join(str(v) for v in value) if isinstance(value, tuple) else value
+
+
+def _cell_values(sweep, key):
+    start, end, how_much, market = key
+    return dict([('start', start), ('end', end), ('how_much', how_much)] + list(market))
+
+
+@click.command()
+@click.argument('balances', type=click.Path(exists=True))
+@click.argument('withdraws', type=click.Path(exists=True))
+@click.option('--start', callback=parse_int_list, default='48', help='Start ages, e.g. 50,55')
+@click.option('--end', callback=parse_int_list, default='90', help='End ages, e.g. 90,95')
+@click.option('--how-much', '-hm', nargs=2, multiple=True,
+              help='Withdrawal rule; repeat to sweep, e.g. -hm c% 3.5 -hm c% 4.5')
+@click.option('--param', 'markets', multiple=True, callback=parse_markets,
+              help='Market constant to sweep, e.g. SPY_MEAN=0.07,0.09 ({})'.format(', '.join(SWEEP_PARAMETERS)))
+@click.option('--iterations', type=click.IntRange(1), default=10000, help='Iterations per cell')
+@click.option('--sampling', type=click.Choice(SAMPLING_MODES), default='random')
+@click.option('--returns', type=click.Choice(['normal', 'correlated']), default='normal')
+@click.option('--lognormal/--no-lognormal', default=False, help='Draw log-normal returns')
+@click.option('--tax-model', type=click.Choice(TAX_MODELS), default='flat')
+@click.option('--workers', type=click.IntRange(1), default=1, help='Evaluate cells in this many processes')
+@click.option('--summary-file', type=click.Path(), default=None, help='Also write the results as JSON here')
+@click.option('--plot-file', type=click.Path(), default=None,
+              help='Save a success rate heatmap here (needs exactly two swept parameters)')
+@click.option('-s', '--seed', default=0, help='Random number seed')
+def sweep_cli(balances, withdraws, start, end, how_much, markets, iterations, sampling, returns, lognormal, tax_model,
+              workers, summary_file, plot_file, seed):
+    os.makedirs('logs', exist_ok=True)
+    logging.basicConfig(filename='logs/sweep.log', filemode='w', format='%(levelname)s %(filename)s %(message)s',
+                        level=logging.INFO)
+
+    how_muchs = [(hm_type, float(hm_value)) for hm_type, hm_value in how_much] or [('c%', 4.0)]
+    sweep = Sweep(start, end, how_muchs, markets)
+    if plot_file and len(sweep.varying_axes()) != 2:
+        raise click.UsageError('--plot-file needs exactly two swept parameters')
+    tax_manager = TaxManager(tax_model)
+    account_manager = AccountManager(tax_manager)
+    account_manager.toggle_logging()
+    template = account_manager.parse_accounts(balances)
+    seed = seed if seed else np.random.SeedSequence().entropy
+
+    results = run_sweep(sweep, template, WithdrawAlgo(withdraws), tax_manager, iterations, seed, sampling, workers,
+                        returns, lognormal)
+    print_results(sweep, results)
+    if summary_file:
+        with open(summary_file, 'w') as fp:
+            json.dump({'iterations': iterations, 'seed': seed, 'cells': [
+                dict(_cell_values(sweep, key), success_rate=rate) for key, rate in results.items()]}, fp, indent=2)
+    if plot_file:
+        save_heatmap(sweep, results, plot_file)
+
+
+if __name__ == '__main__':
+    sweep_cli()
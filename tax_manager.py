@@ -1,3 +1,33 @@
+import numpy as np
+
+# flat:        every withdrawal from an account is taxed at one rate for its type
+# progressive: the year's ordinary income and capital gains go through the bracket tables
+TAX_MODELS = ['flat', 'progressive']
+# Rows of the (ordinary, gains) income-so-far arrays
+ORDINARY, GAINS = 0, 1
+
+
+class BracketSchedule:
+    # One progressive table as arrays. Bracket i starts at starts[i] and is taxed at rates[i];
+    # base_tax[i] is owed on all the income below it. Works on scalars or whole arrays of iterations.
+    def __init__(self, table):
+        ends = np.array([row['end'] for row in table], dtype=np.float64)
+        self.rates = np.array([row['rate'] for row in table], dtype=np.float64)
+        self.starts = np.concatenate([[0], ends[:-1]])
+        self.base_tax = np.concatenate([[0], np.cumsum(np.diff(self.starts) * self.rates[:-1])])
+        # What's left after tax at each bracket start, for the inverse
+        self.net_starts = self.starts - self.base_tax
+
+    def tax(self, income):
+        i = np.maximum(np.searchsorted(self.starts, income, side='right') - 1, 0)
+        return self.base_tax[i] + self.rates[i] * (income - self.starts[i])
+
+    def income_for_net(self, net):
+        # Inverse of income - tax(income); it is piecewise linear and increasing, so one lookup does it
+        i = np.maximum(np.searchsorted(self.net_starts, net, side='right') - 1, 0)
+        return self.starts[i] + (net - self.net_starts[i]) / (1 - self.rates[i])
+
+
 class TaxManager:
     CAPITAL_GAINS = 0.15  # 15% for $120,000 income
     INCOME = 0.147  # 14.7% for $120,000
@@ -18,8 +48,20 @@ class TaxManager:
         {'rate': 0.37, 'end': 1000000000000, 'prev_tax': 174253.50},
     ]
 
-    def __init__(self):
-        pass
+    def __init__(self, model='flat'):
+        if model not in TAX_MODELS:
+            raise RuntimeError('Invalid tax model: {}'.format(model))
+        self.model = model
+        self.income_schedule = BracketSchedule(self.INCOME_TAX_TABLE)
+        self.gains_schedule = BracketSchedule(self.CAPITAL_GAINS_TABLE)
+        self.start_year()
+
+    def is_progressive(self):
+        return self.model == 'progressive'
+
+    def start_year(self):
+        # (ordinary, gains) withdrawn so far this year; only the progressive model looks at it
+        self.year_income = [0, 0]
 
     def tax_gains(self, amount):
         return round(self.CAPITAL_GAINS * amount)
@@ -27,22 +69,59 @@ class TaxManager:
     def tax_income(self, amount):
         return round(self.INCOME * amount)
 
-    def get_rate(self, account_type):
+    def get_income_kind(self, account_type):
+        # What a withdrawal counts as: ORDINARY, GAINS, or None when it is tax free
         match account_type:
             case 'Brokerage':
-                return self.CAPITAL_GAINS
+                return GAINS
             case '401k':
-                return self.INCOME
+                return ORDINARY
             case 'RolloverIRA':
-                return self.INCOME
+                return ORDINARY
             case 'RothIRA':
-                return 0
+                return None
             case 'TradIRA':
-                return self.INCOME
+                return ORDINARY
             case _:
                 raise RuntimeError('Unknown account type: {}'.format(account_type))
 
+    def get_rate(self, account_type):
+        kind = self.get_income_kind(account_type)
+        if kind == ORDINARY:
+            return self.INCOME
+        if kind == GAINS:
+            return self.CAPITAL_GAINS
+        return 0
+
+    def tax_on(self, kind, income, amount):
+        # Progressive tax on withdrawing `amount` more of `kind` when `income` (ordinary, gains) has
+        # already come out this year. Gains are stacked on top of ordinary income, as the gains
+        # brackets are; ordinary income taken after some gains doesn't push those gains back up.
+        if kind is None:
+            return np.zeros_like(amount, dtype=np.float64)
+        base, schedule = self._base(kind, income)
+        return schedule.tax(base + amount) - schedule.tax(base)
+
+    def pretax_for(self, kind, income, amount_post):
+        # Closed-form inverse of tax_on: the amount to withdraw to be left with amount_post
+        if kind is None:
+            return np.asarray(amount_post, dtype=np.float64)
+        base, schedule = self._base(kind, income)
+        return schedule.income_for_net(base - schedule.tax(base) + amount_post) - base
+
+    def _base(self, kind, income):
+        if kind == ORDINARY:
+            return income[ORDINARY], self.income_schedule
+        return income[ORDINARY] + income[GAINS], self.gains_schedule
+
     def split_it(self, account_type, amount):
+        if self.is_progressive():
+            kind = self.get_income_kind(account_type)
+            tax = round(float(self.tax_on(kind, self.year_income, amount)))
+            if kind is not None:
+                self.year_income[kind] += amount
+            return amount - tax, tax
+
         rate = self.get_rate(account_type)
         tax = round(rate * amount)
         money_post = amount - tax
@@ -50,6 +129,9 @@ class TaxManager:
         return money_post, tax
 
     def how_much_pretax(self, account_type, amount_post):
+        if self.is_progressive():
+            return round(float(self.pretax_for(self.get_income_kind(account_type), self.year_income, amount_post)))
+
         rate = self.get_rate(account_type)
         return round(amount_post / (1 - rate))
 
@@ -0,0 +1,113 @@
+import logging
+import numpy as np
+
+
+class TracePolicy:
+    # Which iterations get their year-by-year records kept. Specs:
+    #   off          nothing (default)
+    #   first:N      the first N iterations
+    #   every:K      every K-th iteration (0, K, 2K, ...)
+    #   failed[:N]   iterations that ran out of money (at most N of them)
+    #   list:A,B,..  exactly these iterations
+    MODES = ['off', 'first', 'every', 'failed', 'list']
+
+    def __init__(self, mode='off', value=None):
+        if mode not in self.MODES:
+            raise RuntimeError('Invalid trace mode: {}'.format(mode))
+        self.mode = mode
+        self.value = value
+
+    @classmethod
+    def parse(cls, spec):
+        if not spec or spec == 'off':
+            return cls()
+        mode, _, arg = spec.partition(':')
+        try:
+            if mode == 'list':
+                value = sorted({int(x) for x in arg.split(',') if x})
+            elif mode == 'failed':
+                value = int(arg) if arg else None
+            else:
+                value = int(arg)
+        except ValueError:
+            raise RuntimeError('Invalid trace spec: {}'.format(spec))
+        if mode == 'list' and (not value or value[0] < 0):
+            raise RuntimeError('Trace list needs iteration numbers of 0 or more: {}'.format(spec))
+        if mode != 'list' and value is not None and value < 1:
+            raise RuntimeError('Trace count must be at least 1: {}'.format(spec))
+        return cls(mode, value)
+
+    @property
+    def enabled(self):
+        return self.mode != 'off'
+
+    def select(self, first_iteration, values, already_selected=0):
+        # Iteration numbers to trace out of a chunk of results; values is (iterations, years).
+        # already_selected counts the iterations picked from earlier chunks.
+        ids = np.arange(first_iteration, first_iteration + len(values))
+        if self.mode == 'first':
+            return ids[ids < self.value]
+        if self.mode == 'every':
+            return ids[ids % self.value == 0]
+        if self.mode == 'list':
+            return ids[np.isin(ids, self.value)]
+        if self.mode == 'failed':
+            selected = ids[values[:, -1] < 1]
+            if self.value is not None:
+                selected = selected[:max(0, self.value - already_selected)]
+            return selected
+        return ids[:0]
+
+    def limit(self, iteration_ids):
+        # Combine selections made separately (e.g. by several workers) back into one
+        iteration_ids = np.unique(iteration_ids)
+        if self.mode == 'failed' and self.value is not None:
+            iteration_ids = iteration_ids[:self.value]
+        return iteration_ids
+
+    def __str__(self):
+        if self.value is None:
+            return self.mode
+        if self.mode == 'list':
+            return 'list:' + ','.join(str(x) for x in self.value)
+        return '{}:{}'.format(self.mode, self.value)
+
+
+class TraceStore:
+    # Raw numeric year records of the traced iterations, saved as one columnar .npz file.
+    # Every column has one row per (iteration, year).
+    COLUMNS = ['total_value', 'withdraw_request', 'withdraw_actual', 'tax_paid',
+               'inflation', 'stock_return', 'bond_return']
+
+    def __init__(self, account_names, holdings):
+        self.account_names = list(account_names)
+        self.holdings = list(holdings)
+        self._chunks = []
+
+    def record(self, iteration_ids, years, columns, account_balances):
+        # columns: name -> (iterations, years); account_balances: (iterations, years, accounts, holdings)
+        # holding the balances right after that year's withdrawal
+        iteration_ids = np.asarray(iteration_ids)
+        num_years = len(years)
+        chunk = {
+            'iteration': np.repeat(iteration_ids, num_years),
+            'year': np.tile(np.asarray(years), len(iteration_ids)),
+            'account_balances': np.asarray(account_balances).reshape(-1, len(self.account_names), len(self.holdings)),
+        }
+        for name in self.COLUMNS:
+            chunk[name] = np.asarray(columns[name], dtype=np.float64).reshape(-1)
+        self._chunks.append(chunk)
+
+    def __len__(self):
+        return sum(len(chunk['iteration']) for chunk in self._chunks)
+
+    def save(self, path):
+        names = ['iteration', 'year', 'account_balances'] + self.COLUMNS
+        if self._chunks:
+            data = {name: np.concatenate([chunk[name] for chunk in self._chunks]) for name in names}
+        else:
+            data = {name: np.zeros(0) for name in names}
+            data['account_balances'] = np.zeros((0, len(self.account_names), len(self.holdings)))
+        np.savez_compressed(path, account_names=np.array(self.account_names),
+                            holdings=np.array(self.holdings), **data)
+        logging.info("Saved {} trace records to {}".format(len(self), path))
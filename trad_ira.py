@@ -2,8 +2,10 @@ from account import Account
 
 
 class TradIRA(Account):
-    def __init__(self, info, tax_manager):
-        super().__init__(info, tax_manager)
+    __slots__ = ()
+
+    def __init__(self, info, tax_manager, year=-1, state=None):
+        super().__init__(info, tax_manager, year, state)
 
     @staticmethod
     def get_is_tax_paid():
@@ -0,0 +1,184 @@
+import json
+import logging
+import os
+import threading
+import time
+import click
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from account_manager import AccountManager
+from batch_simulator import _simulate
+from result_aggregator import ResultAggregator
+from retire import build_summary, howmuch_algo_chooser
+from scenario_service import _file_version, _parse_portfolio, _parse_strategy, scenario_options
+from simulator import create_rate_generator
+from tax_manager import TaxManager
+
+HOST = '127.0.0.1'
+PORT = 8765
+# Memory for parsed portfolios and return matrices; one 10,000 iteration, 40 year set of returns
+# is about 10MB
+MEMORY_MB = 512
+# Scenarios that don't pick a seed all share this one, so what-ifs compare on the same paths
+SEED = 1
+# Options that need more than one pass over the paths, which the server doesn't do
+UNSUPPORTED = {'target_precision': None, 'control_variate': False, 'engine': 'batch'}
+
+
+class MemoryCache:
+    # In-memory LRU with a budget in bytes. Values are built outside the lock, so two requests
+    # missing the same key at once may both build it; the first to finish is kept.
+    def __init__(self, size_mb=MEMORY_MB):
+        self.budget = size_mb * 2 ** 20
+        self.total = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, build, size_of):
+        # (value, whether it was cached)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key][0], True
+        value = build()
+        nbytes = size_of(value)
+        with self._lock:
+            self.misses += 1
+            if key not in self._entries:
+                self._entries[key] = (value, nbytes)
+                self.total += nbytes
+                # Keep at least the newest entry even if it is over budget on its own
+                while self.total > self.budget and len(self._entries) > 1:
+                    _, (_, evicted) = self._entries.popitem(last=False)
+                    self.total -= evicted
+        return value, False
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'megabytes': self.total / 2 ** 20, 'budget_megabytes':
+                    self.budget / 2 ** 20, 'hits': self.hits, 'misses': self.misses}
+
+
+class WhatIf:
+    # Answers scenarios from cached inputs: the parsed portfolio and withdraw strategy, and the
+    # return matrices for the scenario's return model, seed, iterations and horizon. A scenario that
+    # differs from an earlier one only in how much it withdraws, its tax model or its strategy
+    # reruns just the simulation over the same paths.
+    def __init__(self, size_mb=MEMORY_MB, seed=SEED):
+        self.cache = MemoryCache(size_mb)
+        self.seed = seed
+
+    def evaluate(self, scenario):
+        for name, default in UNSUPPORTED.items():
+            if scenario.get(name, default) != default:
+                raise RuntimeError('{} is not supported by the what-if server'.format(name))
+        options = scenario_options(dict(scenario, seed=scenario.get('seed') or self.seed))
+        the_years = range(options.start, options.end)
+
+        balances = _file_version(scenario['balances'])
+        template, portfolio_cached = self.cache.get(
+            ('portfolio', balances), lambda: _parse_portfolio.__wrapped__(balances), lambda t: t.snapshot.nbytes)
+        withdraws = _file_version(scenario['withdraws'])
+        withdraw_algo, _ = self.cache.get(
+            ('strategy', withdraws), lambda: _parse_strategy.__wrapped__(withdraws),
+            lambda w: len(json.dumps(w.get_strategy())))
+        rates, rates_cached = self.cache.get(self._rates_key(options, len(the_years)),
+                                             lambda: self._generate_rates(options, len(the_years)),
+                                             lambda r: sum(m.nbytes for m in r))
+
+        account_manager = AccountManager(TaxManager(options.tax_model))
+        account_manager.toggle_logging()
+        account_manager.load_template(template)
+        values = _simulate(the_years, account_manager, howmuch_algo_chooser(options.how_much), withdraw_algo,
+                           account_manager.tax_manager, rates)[0]
+        aggregator = ResultAggregator(len(the_years))
+        aggregator.add(0, values, None)
+        summary = build_summary(aggregator, options)
+        summary['cached'] = {'portfolio': portfolio_cached, 'returns': rates_cached}
+        return summary
+
+    @staticmethod
+    def _rates_key(options, num_years):
+        history = _file_version(options.history_file) if options.history_file else None
+        correlation = tuple(map(tuple, options.correlation)) if options.correlation is not None else None
+        return ('returns', options.sampling, options.returns, history, options.block_size, options.lognormal,
+                correlation, options.seed, options.iterations, num_years)
+
+    @staticmethod
+    def _generate_rates(options, num_years):
+        # The same matrices the batch engine draws for this seed, so answers match retire's
+        rate_generator = create_rate_generator(options.sampling, options.returns, options.history_file,
+                                               options.block_size, options.lognormal, options.correlation)
+        return rate_generator.generate_matrices(options.iterations, num_years, options.seed, 0)
+
+
+class WhatIfHandler(BaseHTTPRequestHandler):
+    # POST /whatif with a scenario as scenario_service reads them, or {"base": {...}, "delta": {...}}
+    # to have the delta's fields applied over the base. GET /stats reports the cache.
+    whatif = None
+
+    def do_POST(self):
+        if self.path != '/whatif':
+            return self._reply(404, {'error': 'Unknown path {}'.format(self.path)})
+        started = time.perf_counter()
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            scenario = dict(body['base'], **body.get('delta', {})) if 'base' in body else body
+            result = self.whatif.evaluate(scenario)
+        except (RuntimeError, ValueError, TypeError, KeyError, OSError) as e:
+            logging.warning("Bad what-if request: {}".format(e))
+            return self._reply(400, {'error': '{}: {}'.format(type(e).__name__, e)})
+        except Exception as e:
+            logging.exception("What-if request failed")
+            return self._reply(500, {'error': '{}: {}'.format(type(e).__name__, e)})
+        result['seconds'] = time.perf_counter() - started
+        self._reply(200, result)
+
+    def do_GET(self):
+        if self.path != '/stats':
+            return self._reply(404, {'error': 'Unknown path {}'.format(self.path)})
+        self._reply(200, self.whatif.cache.stats())
+
+    def _reply(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.info("%s " + format, self.address_string(), *args)
+
+
+def create_server(host=HOST, port=PORT, size_mb=MEMORY_MB, seed=SEED):
+    # A server bound to host:port (0 picks a free port), not yet serving
+    handler = type('Handler', (WhatIfHandler,), {'whatif': WhatIf(size_mb, seed)})
+    return ThreadingHTTPServer((host, port), handler)
+
+
+@click.command()
+@click.option('--host', default=HOST, help='Address to listen on (local only by default)')
+@click.option('--port', type=click.IntRange(0, 65535), default=PORT)
+@click.option('--memory', type=click.IntRange(1), default=MEMORY_MB,
+              help='Megabytes of portfolios and return matrices to keep before evicting the least recently used')
+@click.option('-s', '--seed', default=SEED, help='Seed for scenarios that do not give one')
+def serve(host, port, memory, seed):
+    os.makedirs('logs', exist_ok=True)
+    logging.basicConfig(filename='logs/whatif.log', filemode='w', format='%(levelname)s %(filename)s %(message)s',
+                        level=logging.WARNING)
+    server = create_server(host, port, memory, seed)
+    click.echo('Serving what-ifs on http://{}:{}/whatif'.format(*server.server_address[:2]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    serve()